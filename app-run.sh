@@ -13,5 +13,5 @@ echo "Try these commands in another terminal to test the web server:"
 echo "curl http://0.0.0.0:5050/healthz"
 echo 'curl -X POST -H "Content-Type: application/json" http://0.0.0.0:5050/predict -d "@input.json"'
 echo ""
-gunicorn --bind 0.0.0.0:5050 --timeout=150 app.app:app -w 1
+gunicorn --bind 0.0.0.0:5050 --timeout=150 -w 1
 echo "Done"
\ No newline at end of file
@@ -1,43 +1,179 @@
-from flask import Flask, jsonify, request
+"""Prediction service (WSGI)
 
+Run with gunicorn, whose gunicorn.conf.py creates the app once in the
+master process, then forks the workers:
+
+    gunicorn --bind 0.0.0.0:5050
+
+or app.app:app, created on first use, with any other WSGI server.
+"""
+
+from flask import Flask, Response, jsonify, request
+
+import logging
 import os
-import json
-import pandas as pd
 
+from custsegm import metrics
 from custsegm.predictor import Predictor
+from custsegm.registry import ModelNotFound, ModelRegistry
+
+
+NO_DEFAULT_MODEL = {"error": "No default model: see /models/<name>/predict"}, 404
+
+
+def create_app(predictor: Predictor = None,
+               registry: ModelRegistry = None,
+               preload: bool = False) -> Flask:
+    """Returns the Flask application serving predictor
+
+    predictor, by default the model set by the environment, is loaded and
+    warmed up if not already, and registry defaults to the named models
+    under MODELS_ROOT if set.
+    With preload, the app is created in the master process of a forking
+    server: background threads, which forking does not copy, are left to
+    start_worker() in each worker.
+    """
+    app = Flask(__name__)
+
+    # Named models, served under /models/<name>/, if MODELS_ROOT is set
+    if registry is None:
+        registry = ModelRegistry.as_set_by_envvars()
+    if registry:
+        registry.register_metrics()
+
+    if predictor is None:
+        try:
+            predictor = Predictor.as_set_by_envvars()
+        except ValueError:
+            if registry is None:
+                raise
+            # Named models only
+            predictor = None
+    if predictor:
+        if predictor.model is None:
+            predictor.ready()
+        predictor.register_metrics()
+
+
+    @app.route("/", methods=["GET", "POST"])
+    def index():
+        if request.method == "POST":
+            return predict()
+        else:
+            return healthz()
+
+    @app.route('/predict',methods=['POST','GET'])
+    def predict():
+        if predictor is None:
+            return NO_DEFAULT_MODEL
+        try:
+            #predict
+            vertex_ai_output = predictor.predict_from_json(request.get_data())
+
+            with metrics.stage("encode"):
+                return jsonify(vertex_ai_output)
+        except Exception as e:
+            metrics.ERRORS.inc()
+            return jsonify({"error": str(e)})
+
+    @app.route('/model')
+    def model():
+        if predictor is None:
+            return NO_DEFAULT_MODEL
+        return jsonify(predictor.model_info())
+
+    @app.route('/drift')
+    def drift():
+        if predictor is None:
+            return NO_DEFAULT_MODEL
+        # Rows scored by this worker process since the model was loaded
+        return jsonify(predictor.drift_report())
+
+    @app.route('/models')
+    def models():
+        if registry is None:
+            return jsonify({"error": "MODELS_ROOT not set"}), 404
+        return jsonify(registry.info())
+
+    @app.route('/models/<name>/predict', methods=['POST'])
+    def predict_named(name):
+        try:
+            model = named(name)
+        except ModelNotFound as e:
+            return jsonify({"error": e.args[0]}), 404
+        try:
+            vertex_ai_output = model.predict_from_json(request.get_data())
+
+            with metrics.stage("encode"):
+                return jsonify(vertex_ai_output)
+        except Exception as e:
+            metrics.ERRORS.inc()
+            return jsonify({"error": str(e)})
+
+    @app.route('/models/<name>')
+    def model_named(name):
+        try:
+            model = named(name)
+        except ModelNotFound as e:
+            return jsonify({"error": e.args[0]}), 404
+        return jsonify(model.model_info())
+
+    @app.route('/models/<name>/drift')
+    def drift_named(name):
+        try:
+            model = named(name)
+        except ModelNotFound as e:
+            return jsonify({"error": e.args[0]}), 404
+        return jsonify(model.drift_report())
+
+    def named(name) -> Predictor:
+        if registry is None:
+            raise ModelNotFound("MODELS_ROOT not set")
+        return registry.get(name)
+
+    @app.route('/metrics')
+    def metrics_():
+        # Metrics of this worker process only
+        return Response(metrics.REGISTRY.render(), mimetype="text/plain; version=0.0.4")
 
+    @app.route('/healthz')
+    def healthz():
+        return jsonify("OK")
 
-app = Flask(__name__)
 
-predictor = Predictor.as_set_by_envvars()
-predictor.ready()
+    app.predictor = predictor
+    app.registry = registry
+    if not preload:
+        start_worker(app)
+    logging.debug("WSGI app created")
+    return app
 
 
-@app.route("/", methods=["GET", "POST"])
-def index():
-    if request.method == "POST":
-        return predict()
-    else:
-        return healthz()
-    
-@app.route('/predict',methods=['POST','GET'])
-def predict():
-    try:
-        req = request.json.get('instances')
+def start_worker(app: Flask) -> None:
+    """Starts the background work of the process serving app
 
-        #predict
-        vertex_ai_input = req
-        vertex_ai_output = predictor.predict_from_vertex_ai(vertex_ai_input)
+    That is polling for new model artifacts every MODEL_POLL_SECONDS, to
+    swap them in without restarting.
+    """
+    MODEL_POLL_SECONDS = float(os.getenv("MODEL_POLL_SECONDS", "0"))
+    if app.predictor and MODEL_POLL_SECONDS > 0:
+        app.predictor.start_polling(MODEL_POLL_SECONDS)
 
-        return jsonify(vertex_ai_output)
-    except Exception as e:
-        return jsonify({"error": str(e)})
 
-@app.route('/healthz')
-def healthz():
-    return jsonify("OK")
+def __getattr__(name: str):
+    # app.app:app, created on first use rather than on import, so that
+    # importing the module does not load a model
+    if name == "app":
+        try:
+            globals()["app"] = create_app()
+        except AttributeError as e:
+            # Raised from here, it would be taken for a missing attribute
+            # and reported as "cannot import name 'app'"
+            raise RuntimeError(f"Creating the app failed: {e!r}") from e
+        return globals()["app"]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 if __name__=='__main__':
     #app.run(host='0.0.0.0')
-    app.run(debug=True)
+    create_app().run(debug=True)
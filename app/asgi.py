@@ -0,0 +1,178 @@
+"""Asynchronous (ASGI) prediction service, batching concurrent requests
+
+Run with any ASGI server, e.g.:
+
+    uvicorn --factory app.asgi:create_app --host 0.0.0.0 --port 5050
+
+Same routes as app/app.py, plus /batching with the micro-batching metrics,
+which /metrics exposes too.
+"""
+
+import asyncio
+import json
+import logging
+import os
+
+from custsegm import metrics
+from custsegm.batching import MicroBatcher, Overloaded
+from custsegm.decoding import DecodedRequest
+from custsegm.predictor import Predictor
+from custsegm.registry import ModelNotFound, ModelRegistry
+
+
+def create_app(predictor: Predictor = None,
+               max_batch_size: int = None,
+               max_wait: float = None,
+               max_queue: int = None,
+               registry: ModelRegistry = None):
+    """Returns the ASGI application serving predictor
+
+    Batching limits default to the MAX_BATCH_SIZE, MAX_WAIT_MS and
+    MAX_QUEUE environment variables. The named models of registry, by
+    default those under MODELS_ROOT if set, are served under
+    /models/<name>/, without batching.
+    """
+    if predictor is None:
+        predictor = Predictor.as_set_by_envvars()
+        predictor.ready()
+        MODEL_POLL_SECONDS = float(os.getenv("MODEL_POLL_SECONDS", "0"))
+        if MODEL_POLL_SECONDS > 0:
+            predictor.start_polling(MODEL_POLL_SECONDS)
+
+    def score(columns):
+        # Requests are decoded into lists, joined, then typed once per batch
+        model = predictor.model
+        return predictor.predict_from_columns(model.decoder.typed(columns), model)
+
+    batcher = MicroBatcher(
+        score,
+        max_batch_size=max_batch_size or int(os.getenv("MAX_BATCH_SIZE", "512")),
+        max_wait=max_wait if max_wait is not None else float(os.getenv("MAX_WAIT_MS", "2")) / 1000,
+        max_queue=max_queue or int(os.getenv("MAX_QUEUE", "1024")))
+
+    predictor.register_metrics()
+    if registry is None:
+        registry = ModelRegistry.as_set_by_envvars()
+    if registry is not None:
+        registry.register_metrics()
+    for name in ("requests", "rows", "batches", "rejected", "errors"):
+        metrics.REGISTRY.callback(f"custsegm_batcher_{name}_total", "counter",
+                                  f"Micro-batcher {name}.",
+                                  lambda name=name: batcher.counters[name])
+    metrics.REGISTRY.callback("custsegm_batcher_queue_depth", "gauge",
+                              "Requests waiting to be batched.",
+                              lambda: batcher.queue.qsize() if batcher.queue else 0)
+    metrics.REGISTRY.callback("custsegm_batcher_queue_seconds_total", "counter",
+                              "Time requests spent waiting to be batched, in seconds.",
+                              lambda: batcher.counters["queue_seconds"])
+
+    async def predict(body: bytes):
+        with metrics.stage("decode"):
+            request = predictor.decoder.decode(body, typed=False)
+        metrics.record_request(len(request))
+        if not len(request):
+            return 200, {"predictions": []}
+        if any(Predictor.output_options(request.parameters)):
+            # Rare and shaped differently: not batched with label requests,
+            # but scored off the event loop all the same
+            model = predictor.model
+            typed = DecodedRequest(model.decoder.typed(request.columns), request.parameters)
+            loop = asyncio.get_running_loop()
+            return 200, {"predictions": await loop.run_in_executor(
+                None, predictor.predict_request, typed, model)}
+        try:
+            predictions = await batcher.submit(request.columns)
+        except Overloaded as e:
+            return 503, {"error": str(e)}
+        return 200, {"predictions": predictions.tolist()}
+
+    async def named(path: str, method: str, body: bytes):
+        # /models/<name>[/predict|/drift], loaded and scored off the event loop
+        _, _, name, *rest = path.split("/", 3) + [""]
+        action = rest[0]
+        if (action, method) not in (("predict", "POST"), ("drift", "GET"), ("", "GET")):
+            return 404, {"error": f"Not found: {path}"}
+        loop = asyncio.get_running_loop()
+        try:
+            model = await loop.run_in_executor(None, registry.get, name)
+        except ModelNotFound as e:
+            return 404, {"error": e.args[0]}
+        try:
+            if action == "predict":
+                return 200, await loop.run_in_executor(None, model.predict_from_json, body)
+            if action == "drift":
+                return 200, await loop.run_in_executor(None, model.drift_report)
+            return 200, await loop.run_in_executor(None, model.model_info)
+        except Exception as e:
+            metrics.ERRORS.inc()
+            return 200, {"error": str(e)}
+
+    async def route(method: str, path: str, body: bytes):
+        if registry is not None and path.startswith("/models"):
+            if path.rstrip("/") == "/models":
+                return 200, registry.info()
+            return await named(path, method, body)
+        if path in ("/", "/predict") and method == "POST":
+            try:
+                return await predict(body)
+            except Exception as e:
+                metrics.ERRORS.inc()
+                return 200, {"error": str(e)}
+        if path in ("/", "/healthz", "/predict"):
+            return 200, "OK"
+        if path == "/model":
+            return 200, predictor.model_info()
+        if path == "/drift":
+            return 200, predictor.drift_report()
+        if path == "/batching":
+            return 200, batcher.metrics()
+        if path == "/metrics":
+            return 200, metrics.REGISTRY.render()
+        return 404, {"error": f"Not found: {path}"}
+
+    async def app(scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    batcher.start()
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await batcher.stop()
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+
+        if scope["type"] != "http":
+            return
+
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+
+        status, payload = await route(scope["method"], scope["path"], body)
+        if scope["path"] == "/metrics":
+            content = payload.encode("utf-8")
+            content_type = b"text/plain; version=0.0.4"
+        elif isinstance(payload, dict) and "predictions" in payload:
+            with metrics.stage("encode"):
+                content = json.dumps(payload).encode("utf-8")
+            content_type = b"application/json"
+        else:
+            # Not a prediction: not timed, as in the WSGI app
+            content = json.dumps(payload).encode("utf-8")
+            content_type = b"application/json"
+        headers = [(b"content-type", content_type),
+                   (b"content-length", str(len(content)).encode("ascii"))]
+        if status == 503:
+            headers.append((b"retry-after", b"1"))
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": content})
+
+    app.predictor = predictor
+    app.registry = registry
+    app.batcher = batcher
+    logging.debug("ASGI app created")
+    return app
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+
+"""Command line entry point: python -m custsegm COMMAND ...
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+
+from custsegm.benchmark import CASES, DEFAULT_TOLERANCE, parse_rows
+from custsegm.importtime import SERVING_FORBIDDEN, SERVING_STARTUP
+from custsegm.predictor import Predictor
+from custsegm.scorer import Scorer
+from custsegm.workermem import CONFIGURATIONS
+
+
+def score(args: argparse.Namespace) -> None:
+    if args.model.startswith("gs://"):
+        predictor = Predictor(args.model, None)
+    else:
+        predictor = Predictor(os.path.dirname(args.model) or ".", args.model)
+    predictor.ready()
+
+    start_row = args.start_row
+    if args.resume:
+        start_row = Scorer.rows_written(args.output)
+
+    scorer = Scorer(predictor, chunk_size=args.chunk_size)
+    workers = args.workers or os.cpu_count()
+    scorer.score(args.input, args.output, start_row=start_row, workers=workers)
+
+
+def export(args: argparse.Namespace) -> None:
+    import joblib
+    from custsegm.artifact import export_pipeline
+
+    export_pipeline(joblib.load(args.model), args.output)
+    logging.info(f"Exported {args.model} to {args.output}")
+
+
+def convert(args: argparse.Namespace) -> None:
+    from custsegm.dataset import COLUMNS, Dataset
+
+    rows = Dataset.convert(args.input, args.output, args.chunk_size,
+                           columns=None if args.all_columns else COLUMNS)
+    logging.info(f"Converted {rows} rows of {args.input} to {args.output}")
+
+
+def importtime(args: argparse.Namespace) -> None:
+    from custsegm import importtime
+
+    summary = importtime.report(args.statement, args.top, args.forbid, args.repeat)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print(f"{summary['statement']}: {summary['total_ms']:.1f} ms "
+              f"in {summary['modules']} modules (runs: "
+              f"{', '.join(f'{ms:.1f}' for ms in summary['runs_ms'])} ms)")
+        for package in summary["packages"]:
+            print(f"  {package['ms']:8.1f} ms  {package['package']}")
+
+    failed = False
+    if summary["forbidden_imported"]:
+        print(f"Forbidden modules imported: {', '.join(summary['forbidden_imported'])}",
+              file=sys.stderr)
+        failed = True
+    if args.budget_ms and summary["total_ms"] > args.budget_ms:
+        print(f"Import time over budget of {args.budget_ms} ms", file=sys.stderr)
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+def benchmark(args: argparse.Namespace) -> None:
+    from custsegm import benchmark
+
+    report = benchmark.run(args.cases, args.rows, args.repeat, args.request_rows,
+                           isolate=not args.in_process)
+    for result in report["results"]:
+        print(f"{result['case']:>16} {result['rows']:>10} rows "
+              f"{result['rows_per_sec']:>12.0f} rows/s {result['peak_rss_mb']:>8.0f} MiB")
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+        logging.info(f"Wrote {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = benchmark.compare(report, json.load(baseline), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression['case']} {regression['rows']} rows "
+                  f"{regression['metric']} {regression['baseline']:.1f} -> "
+                  f"{regression['current']:.1f} ({regression['change']:+.0%})",
+                  file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+def workermem(args: argparse.Namespace) -> None:
+    from custsegm import workermem
+
+    report = workermem.run(args.model, args.configurations, args.workers, args.requests,
+                           args.request_rows)
+    for name, result in report["results"].items():
+        worker = result["worker_mb"]
+        print(f"{name:>16} {worker['Private']:>8.1f} MiB private {worker['Pss']:>8.1f} MiB PSS "
+              f"per worker {result['total_pss_mb']:>8.1f} MiB in all")
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+        logging.info(f"Wrote {args.output}")
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(prog="custsegm")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    parser_score = commands.add_parser(
+        "score",
+        help="Score a TSV, CSV or Parquet customer file in chunks.")
+    parser_score.add_argument("input", help="Customer file to score.")
+    parser_score.add_argument("output", help="CSV file to write the cluster labels to.")
+    parser_score.add_argument(
+        "--model",
+        default="model.joblib",
+        help="Local model.joblib or model.csgm file, or GCS directory holding one.")
+    parser_score.add_argument(
+        "--chunk_size",
+        default=100000,
+        type=int,
+        help="Number of rows scored at a time.")
+    parser_score.add_argument(
+        "--start_row",
+        default=0,
+        type=int,
+        help="Input row to start scoring from, appending to the output.")
+    parser_score.add_argument(
+        "--resume",
+        action="store_true",
+        help="Start from the first input row missing from the output.")
+    parser_score.add_argument(
+        "--workers",
+        default=1,
+        type=int,
+        help="Number of worker processes, 0 for one per CPU core.")
+    parser_score.set_defaults(func=score)
+
+    parser_export = commands.add_parser(
+        "export",
+        help="Export a model.joblib pipeline to the model.csgm binary format.")
+    parser_export.add_argument("model", help="model.joblib file to export.")
+    parser_export.add_argument("output", help="model.csgm file to write.")
+    parser_export.set_defaults(func=export)
+
+    parser_convert = commands.add_parser(
+        "convert",
+        help="Convert a TSV customer file to Parquet or Arrow, keeping the model columns.")
+    parser_convert.add_argument("input", help="TSV, Parquet or Arrow file, or gs:// URI, to convert.")
+    parser_convert.add_argument(
+        "output",
+        help="Parquet (.parquet) or Arrow (.arrow) file, or gs:// URI, to write.")
+    parser_convert.add_argument(
+        "--chunk_size",
+        default=1000000,
+        type=int,
+        help="Number of rows converted at a time, and per Parquet row group.")
+    parser_convert.add_argument(
+        "--all_columns",
+        action="store_true",
+        help="Keep all the columns, not only those the model uses.")
+    parser_convert.set_defaults(func=convert)
+
+    parser_importtime = commands.add_parser(
+        "importtime",
+        help="Report the import time of the prediction service startup.")
+    parser_importtime.add_argument(
+        "--statement",
+        default=SERVING_STARTUP,
+        help="Python statement to time, in a fresh interpreter.")
+    parser_importtime.add_argument(
+        "--top",
+        default=15,
+        type=int,
+        help="Number of packages to list.")
+    parser_importtime.add_argument(
+        "--forbid",
+        nargs="*",
+        default=SERVING_FORBIDDEN,
+        help="Modules the statement must not import.")
+    parser_importtime.add_argument(
+        "--budget_ms",
+        type=float,
+        help="Fail when the import time is over this many milliseconds.")
+    parser_importtime.add_argument(
+        "--repeat",
+        default=3,
+        type=int,
+        help="Number of runs, of which the fastest is reported.")
+    parser_importtime.add_argument(
+        "--json",
+        action="store_true",
+        help="Print the report as JSON.")
+    parser_importtime.set_defaults(func=importtime)
+
+    parser_benchmark = commands.add_parser(
+        "benchmark",
+        help="Time training and inference on synthetic customer data.")
+    parser_benchmark.add_argument(
+        "--cases",
+        nargs="*",
+        default=list(CASES),
+        choices=CASES,
+        help="Cases to time.")
+    parser_benchmark.add_argument(
+        "--rows",
+        default=[1000, 10000, 100000],
+        type=parse_rows,
+        help="Comma separated numbers of rows, such as 1k,100k,10M.")
+    parser_benchmark.add_argument(
+        "--repeat",
+        default=3,
+        type=int,
+        help="Number of runs, of which the fastest is reported.")
+    parser_benchmark.add_argument(
+        "--request_rows",
+        default=100,
+        type=int,
+        help="Rows per request of the prediction service cases.")
+    parser_benchmark.add_argument(
+        "--in_process",
+        action="store_true",
+        help="Run all cases in this process rather than one fresh process each.")
+    parser_benchmark.add_argument(
+        "--output",
+        help="JSON file to write the report to.")
+    parser_benchmark.add_argument(
+        "--baseline",
+        help="JSON report to compare with, failing on regressions.")
+    parser_benchmark.add_argument(
+        "--tolerance",
+        default=DEFAULT_TOLERANCE,
+        type=float,
+        help="Throughput drop or peak RSS increase tolerated, as a fraction.")
+    parser_benchmark.set_defaults(func=benchmark)
+
+    parser_workermem = commands.add_parser(
+        "workermem",
+        help="Measure the memory each prediction service worker takes, with and without preloading.")
+    parser_workermem.add_argument(
+        "--model",
+        default="model.joblib",
+        help="Local model.joblib or model.csgm file.")
+    parser_workermem.add_argument(
+        "--configurations",
+        nargs="*",
+        default=list(CONFIGURATIONS),
+        choices=CONFIGURATIONS,
+        help="Configurations to measure.")
+    parser_workermem.add_argument(
+        "--workers",
+        default=4,
+        type=int,
+        help="Number of worker processes forked.")
+    parser_workermem.add_argument(
+        "--requests",
+        default=100,
+        type=int,
+        help="Requests each worker serves before being measured.")
+    parser_workermem.add_argument(
+        "--request_rows",
+        default=100,
+        type=int,
+        help="Rows per request.")
+    parser_workermem.add_argument(
+        "--output",
+        help="JSON file to write the report to.")
+    parser_workermem.set_defaults(func=workermem)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
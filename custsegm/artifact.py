@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+"""Binary model artifact (model.csgm), loaded without sklearn or pickle
+
+Layout, all integers little-endian:
+
+    8 bytes   magic b"CSGMODEL"
+    uint32    format version
+    uint32    length of the JSON header, in bytes
+    JSON header, utf-8
+    arrays, each starting on a 64-byte boundary
+
+The header describes the model (input columns, feature layout, categorical
+vocabularies, preprocessing state) and, for every array, its dtype, shape
+and absolute offset in the file. Arrays are raw little-endian float64, so
+that loading memory-maps the file and reads them in place: worker processes
+serving the same artifact share its pages.
+"""
+
+import json
+import logging
+import mmap
+import os
+import struct
+from datetime import datetime
+from typing import TYPE_CHECKING, Dict, NamedTuple, Optional
+
+import numpy as np
+
+from custsegm.compiled import CompiledPipeline
+
+if TYPE_CHECKING:
+    from custsegm.features import FeatureEngine
+
+MAGIC = b"CSGMODEL"
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+
+_PREAMBLE = struct.Struct("<8sII")
+
+
+class Artifact(NamedTuple):
+    compiled: CompiledPipeline
+    feature_engine: Optional["FeatureEngine"]
+    header: Dict
+
+
+def _aligned(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def write_artifact(path: str,
+                   compiled: CompiledPipeline,
+                   feature_engine: Optional["FeatureEngine"] = None,
+                   metadata: Optional[Dict] = None) -> None:
+    """Writes a compiled pipeline and its preprocessing state to path
+    """
+    arrays = {
+        "mean": compiled.mean,
+        "scale": compiled.scale,
+        "centroids": compiled.centroids,
+    }
+    header = {
+        "format_version": FORMAT_VERSION,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "input_columns": compiled.input_columns,
+        "layout": compiled.layout,
+        "categories": {c: v.tolist() for c, v in compiled.categories.items()},
+        "feature_engine": None,
+        "metadata": metadata or {},
+        "arrays": {},
+    }
+    if feature_engine is not None:
+        header["feature_engine"] = {
+            "as_of_year": feature_engine.as_of_year,
+            "reference_date": None if feature_engine.reference_date_ is None
+                              else str(feature_engine.reference_date_),
+        }
+
+    # Array offsets depend on the header length and the other way round:
+    # grow the room reserved for the header until it fits
+    data = {name: np.ascontiguousarray(a, dtype="<f8") for name, a in arrays.items()}
+    reserved = 0
+    while True:
+        offset = _aligned(_PREAMBLE.size + reserved)
+        for name, a in data.items():
+            header["arrays"][name] = {"dtype": "<f8", "shape": list(a.shape), "offset": offset}
+            offset = _aligned(offset + a.nbytes)
+        encoded = json.dumps(header).encode("utf-8")
+        if len(encoded) <= reserved:
+            break
+        reserved = _aligned(len(encoded))
+
+    # Written aside then renamed over path: predictors may have the previous
+    # artifact memory-mapped, and must never see a partial one
+    partial = f"{path}.partial"
+    with open(partial, "wb") as f:
+        f.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, reserved))
+        f.write(encoded.ljust(reserved))
+        for name, a in data.items():
+            f.seek(header["arrays"][name]["offset"])
+            f.write(a.tobytes())
+        f.truncate(offset)
+    os.replace(partial, path)
+    logging.debug(f"Wrote model artifact {path} of {offset} bytes")
+
+
+def export_pipeline(pipeline, path: str) -> None:
+    """Writes the artifact of a fitted pipeline
+
+    Raises ValueError when the pipeline cannot be compiled exactly.
+    """
+    from custsegm.compiled import compile_pipeline
+
+    compiled = compile_pipeline(pipeline)
+    if compiled is None:
+        raise ValueError("Pipeline cannot be exported, see the warnings logged")
+    metadata = {"n_clusters": compiled.n_clusters}
+    stats = getattr(pipeline, "training_stats_", None)
+    if stats:
+        metadata["training_stats"] = stats
+    write_artifact(path, compiled, getattr(pipeline, "feature_engine_", None), metadata)
+
+
+def read_artifact(path: str) -> Artifact:
+    """Memory-maps an artifact
+
+    Raises ValueError when path is not an artifact of a supported version.
+    """
+    with open(path, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if len(buffer) < _PREAMBLE.size:
+        raise ValueError(f"{path} is not a model artifact")
+    magic, version, header_size = _PREAMBLE.unpack_from(buffer)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a model artifact")
+    if version > FORMAT_VERSION:
+        raise ValueError(f"{path} has format version {version}, "
+                         f"this version reads up to {FORMAT_VERSION}")
+    header = json.loads(bytes(buffer[_PREAMBLE.size:_PREAMBLE.size + header_size]))
+
+    arrays = {}
+    for name, spec in header["arrays"].items():
+        shape = tuple(spec["shape"])
+        count = int(np.prod(shape))
+        arrays[name] = np.frombuffer(buffer, dtype=spec["dtype"], count=count,
+                                     offset=spec["offset"]).reshape(shape)
+
+    compiled = CompiledPipeline(header["input_columns"],
+                                header["layout"],
+                                header["categories"],
+                                arrays["mean"],
+                                arrays["scale"],
+                                arrays["centroids"])
+
+    feature_engine = None
+    state = header.get("feature_engine")
+    if state:
+        # Imports pandas, which raw customer data is preprocessed with
+        from custsegm.features import FeatureEngine
+
+        feature_engine = FeatureEngine(state["as_of_year"])
+        if state["reference_date"] is not None:
+            feature_engine.reference_date_ = np.datetime64(state["reference_date"], "D")
+
+    return Artifact(compiled, feature_engine, header)
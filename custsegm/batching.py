@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+"""Micro-batching of concurrent prediction requests
+"""
+
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from typing import Callable, Dict, List, Mapping, Sequence, Tuple
+
+import numpy as np
+
+
+class Overloaded(Exception):
+    """Raised when the queue of requests waiting to be batched is full"""
+
+
+class MicroBatcher:
+    """Coalesces concurrent requests into batches scored in one call
+
+    Requests are queued as they come. A batch starts with the oldest queued
+    request and takes more until it holds max_batch_size rows or max_wait
+    seconds have passed, then it is scored with a single call of score,
+    in a worker thread so that requests keep being queued meanwhile, and
+    each request gets its own rows of the result back. Requests are
+    columns of values, as arrays or, cheaper to join, as lists.
+
+    At most max_queue requests wait: more are rejected with Overloaded, so
+    that clients back off rather than time out.
+    """
+
+    def __init__(self,
+                 score: Callable[[Mapping[str, Sequence]], np.ndarray],
+                 max_batch_size: int = 512,
+                 max_wait: float = 0.002,
+                 max_queue: int = 1024):
+        self.score = score
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.queue = None
+        self._worker = None
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="micro-batch")
+        self.counters = {
+            "requests": 0,
+            "rows": 0,
+            "batches": 0,
+            "rejected": 0,
+            "errors": 0,
+            "max_queue_depth": 0,
+            "max_batch_rows": 0,
+            "queue_seconds": 0.0,
+            "score_seconds": 0.0,
+        }
+        logging.debug(f"MicroBatcher" +
+                      f" max_batch_size={max_batch_size}" +
+                      f" max_wait={max_wait}" +
+                      f" max_queue={max_queue}.")
+
+
+    def start(self) -> None:
+        if self._worker is None:
+            self.queue = asyncio.Queue(self.max_queue)
+            self._worker = asyncio.ensure_future(self._run())
+
+
+    async def stop(self) -> None:
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+
+    async def submit(self, columns: Dict[str, Sequence]) -> np.ndarray:
+        """Returns the predictions of one request, scored along with others
+
+        Raises Overloaded when too many requests are waiting already.
+        """
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((columns, future, time.perf_counter()))
+        except asyncio.QueueFull:
+            self.counters["rejected"] += 1
+            raise Overloaded(f"{self.max_queue} requests waiting already")
+        self.counters["max_queue_depth"] = max(self.counters["max_queue_depth"],
+                                               self.queue.qsize())
+        return await future
+
+
+    def metrics(self) -> Dict:
+        metrics = dict(self.counters)
+        metrics["queue_depth"] = self.queue.qsize() if self.queue else 0
+        batches = metrics["batches"]
+        metrics["mean_batch_rows"] = metrics["rows"] / batches if batches else 0.0
+        metrics["mean_batch_requests"] = metrics["requests"] / batches if batches else 0.0
+        return metrics
+
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            rows = len(next(iter(batch[0][0].values()), ()))
+            deadline = loop.time() + self.max_wait
+            while rows < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(item)
+                rows += len(next(iter(item[0].values()), ()))
+
+            now = time.perf_counter()
+            self.counters["queue_seconds"] += sum(now - queued for _, _, queued in batch)
+            results = await loop.run_in_executor(self._executor, self._score_batch,
+                                                 [columns for columns, _, _ in batch])
+            self.counters["score_seconds"] += time.perf_counter() - now
+            self.counters["batches"] += 1
+            self.counters["requests"] += len(batch)
+            self.counters["rows"] += rows
+            self.counters["max_batch_rows"] = max(self.counters["max_batch_rows"], rows)
+
+            for (_, future, _), result in zip(batch, results):
+                if future.cancelled():
+                    continue
+                if isinstance(result, Exception):
+                    self.counters["errors"] += 1
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+
+    def _score_batch(self, requests: List[Dict[str, Sequence]]) -> List:
+        """Scores requests with the same columns together
+
+        Returns the predictions, or the exception raised, of every request.
+        When a group of requests fails, its requests are scored one by one
+        so that one bad request does not fail the others.
+        """
+        results = [None] * len(requests)
+        groups = {}
+        for i, columns in enumerate(requests):
+            groups.setdefault(tuple(columns), []).append(i)
+
+        for names, members in groups.items():
+            try:
+                predictions = self.score(self._concatenated(names, [requests[i] for i in members]))
+            except Exception:
+                for i in members:
+                    results[i] = self._score_one(requests[i])
+                continue
+            start = 0
+            for i in members:
+                n = len(next(iter(requests[i].values()), ()))
+                results[i] = predictions[start:start + n]
+                start += n
+        return results
+
+
+    def _score_one(self, columns: Dict[str, Sequence]):
+        try:
+            return self.score(columns)
+        except Exception as e:
+            return e
+
+
+    @staticmethod
+    def _concatenated(names: Tuple[str, ...],
+                      requests: List[Dict[str, Sequence]]) -> Dict[str, Sequence]:
+        if len(requests) == 1 or not names:
+            return requests[0]
+        if isinstance(requests[0][names[0]], list):
+            # Joining lists is much cheaper than joining many small arrays
+            return {name: list(chain.from_iterable(columns[name] for columns in requests))
+                    for name in names}
+        return {name: np.concatenate([columns[name] for columns in requests]) for name in names}
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+"""Training and inference throughput benchmarks, on synthetic customer data
+"""
+
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Sequence
+
+# Timed cases, from the raw customer data to the prediction service
+CASES = ("preprocess", "train", "pipeline_predict", "vertex_ai", "flask")
+
+# Rows the model of the prediction cases is trained on, whatever the rows timed
+TRAINING_ROWS = 5000
+
+# Throughput drop, or peak RSS increase, over which a result is a regression
+DEFAULT_TOLERANCE = 0.2
+
+
+def parse_rows(value: str) -> List[int]:
+    """Parses a comma separated list of row counts such as "1k,100k,10M"
+    """
+    multipliers = {"k": 1000, "m": 1000000}
+    rows = []
+    for token in value.split(","):
+        token = token.strip().lower()
+        multiplier = multipliers.get(token[-1:], 1)
+        rows.append(int(float(token.rstrip("km")) * multiplier))
+    return rows
+
+
+def peak_rss_mb() -> float:
+    """Returns the peak resident set size of this process, in MiB
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kibibytes, macOS bytes
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024
+
+
+def _setup(case: str, data, request_rows: int, workdir: str) -> Callable[[], object]:
+    """Returns the function running case over data, once everything it needs is ready
+    """
+    from custsegm.custsegm import CustomerSegmentation
+    from custsegm.synthetic import make_customers
+
+    segmentation = CustomerSegmentation(as_of_year=2021)
+    if case == "train":
+        return lambda: CustomerSegmentation(as_of_year=2021).train(data)
+
+    pipeline = segmentation.train(make_customers(TRAINING_ROWS, random_state=1))
+    if case == "preprocess":
+        return lambda: segmentation.preprocess(data)
+    if case == "pipeline_predict":
+        features = segmentation.preprocess(data)
+        return lambda: pipeline.predict(features)
+
+    import joblib
+    from custsegm.artifact import export_pipeline
+    from custsegm.predictor import Predictor
+
+    joblib.dump(pipeline, os.path.join(workdir, "model.joblib"))
+    export_pipeline(pipeline, os.path.join(workdir, "model.csgm"))
+    predictor = Predictor(workdir, os.path.join(workdir, "model.csgm"))
+    predictor.ready()
+
+    records = json.loads(data.to_json(orient="records"))
+    requests = [{"instances": records[i:i + request_rows]}
+                for i in range(0, len(records), request_rows)]
+    if case == "vertex_ai":
+        return lambda: [predictor.predict_from_vertex_ai(request) for request in requests]
+
+    if case == "flask":
+        from app.app import create_app
+
+        client = create_app(predictor).test_client()
+        bodies = [json.dumps(request) for request in requests]
+
+        def post_all():
+            for body in bodies:
+                response = client.post("/predict", data=body, content_type="application/json")
+                if "predictions" not in response.get_json():
+                    raise RuntimeError(f"/predict failed: {response.get_json()}")
+        return post_all
+
+    raise ValueError(f"Unknown benchmark case: {case}")
+
+
+def measure(case: str,
+            rows: int,
+            repeat: int = 3,
+            request_rows: int = 100,
+            random_state: int = 0) -> Dict:
+    """Times case over rows synthetic customers, repeat times
+
+    Rows with missing values are dropped beforehand, so slightly fewer
+    rows than asked for are timed. The prediction service cases send the
+    rows in requests of request_rows rows each.
+    """
+    from custsegm.synthetic import make_customers
+
+    data = make_customers(rows, random_state=random_state).dropna().reset_index(drop=True)
+    with tempfile.TemporaryDirectory() as workdir:
+        run = _setup(case, data, request_rows, workdir)
+        runs = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run()
+            runs.append(time.perf_counter() - start)
+
+    seconds = min(runs)
+    result = {
+        "case": case,
+        "rows": len(data),
+        "seconds": seconds,
+        "rows_per_sec": len(data) / seconds if seconds else float("inf"),
+        "peak_rss_mb": peak_rss_mb(),
+        "runs_s": runs,
+    }
+    logging.info(f"{case} {len(data)} rows: {result['rows_per_sec']:.0f} rows/s, "
+                 f"peak RSS {result['peak_rss_mb']:.0f} MiB")
+    return result
+
+
+def run(cases: Sequence[str] = CASES,
+        rows: Sequence[int] = (1000, 10000, 100000),
+        repeat: int = 3,
+        request_rows: int = 100,
+        random_state: int = 0,
+        isolate: bool = True) -> Dict:
+    """Measures every case at every number of rows and returns the report
+
+    Isolated measurements each run in a fresh interpreter, so that their
+    peak RSS is their own. Otherwise the peak RSS only ever grows from one
+    measurement to the next.
+    """
+    for case in cases:
+        if case not in CASES:
+            raise ValueError(f"Unknown benchmark case: {case}")
+
+    import numpy
+    import pandas
+    import sklearn
+
+    results = []
+    for n in rows:
+        for case in cases:
+            args = (case, n, repeat, request_rows, random_state)
+            if isolate:
+                with multiprocessing.get_context("spawn").Pool(1) as pool:
+                    results.append(pool.apply(measure, args))
+            else:
+                results.append(measure(*args))
+
+    return {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "versions": {
+            "numpy": numpy.__version__,
+            "pandas": pandas.__version__,
+            "scikit-learn": sklearn.__version__,
+        },
+        "repeat": repeat,
+        "request_rows": request_rows,
+        "isolated": isolate,
+        "results": results,
+    }
+
+
+def compare(report: Dict, baseline: Dict, tolerance: float = DEFAULT_TOLERANCE) -> List[Dict]:
+    """Returns the regressions of report against baseline
+
+    A result regresses when its throughput is lower, or its peak RSS
+    higher, than the baseline result of the same case and rows by more
+    than tolerance (a fraction). Results missing from either are skipped.
+    """
+    reference = {(result["case"], result["rows"]): result for result in baseline["results"]}
+    regressions = []
+    for result in report["results"]:
+        before = reference.get((result["case"], result["rows"]))
+        if before is None:
+            continue
+        for metric, worse in (("rows_per_sec", -1), ("peak_rss_mb", 1)):
+            if not before[metric]:
+                continue
+            change = result[metric] / before[metric] - 1
+            if worse * change > tolerance:
+                regressions.append({
+                    "case": result["case"],
+                    "rows": result["rows"],
+                    "metric": metric,
+                    "baseline": before[metric],
+                    "current": result[metric],
+                    "change": change,
+                })
+    return regressions
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+"""On-disk cache of model artifacts downloaded from object storage
+"""
+
+import fcntl
+import hashlib
+import logging
+import os
+import tempfile
+from typing import Optional
+
+from custsegm.storage import ObjectInfo, default_storage, md5_of
+
+# Shared by all the processes of a host unless CUSTSEGM_CACHE_DIR says otherwise
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), "custsegm-cache")
+
+
+class ArtifactCache:
+    """Keeps one local copy of every object generation it is asked for
+
+    Cached copies are named after the object URI and generation, so a copy
+    is current as long as the object was not overwritten since. Copies are
+    checked against the MD5 digest of the object when downloaded and when
+    reused. Processes sharing the cache directory take an exclusive file
+    lock per object while fetching it, so that only one downloads it and
+    the others wait for it and then reuse its copy.
+    """
+
+    def __init__(self, directory: str = None, storage=None):
+        self.directory = directory or os.getenv("CUSTSEGM_CACHE_DIR", DEFAULT_CACHE_DIR)
+        self.storage = storage or default_storage()
+        os.makedirs(self.directory, exist_ok=True)
+        logging.debug(f"ArtifactCache directory={self.directory}.")
+
+
+    def fetch(self, uri: str, info: Optional[ObjectInfo] = None) -> str:
+        """Returns the path of an up-to-date local copy of the object at uri
+
+        Raises FileNotFoundError when there is no such object, and IOError
+        when the downloaded copy does not match its digest.
+        """
+        info = info or self.storage.stat(uri)
+        if info is None:
+            raise FileNotFoundError(f"No such object: {uri}")
+
+        key = hashlib.sha256(uri.encode("utf-8")).hexdigest()[:16]
+        extension = os.path.splitext(uri)[1]
+        path = os.path.join(self.directory, f"{key}-{info.generation}{extension}")
+
+        with open(os.path.join(self.directory, f"{key}.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if os.path.isfile(path):
+                    if self.verify(path, info):
+                        logging.debug(f"Using cached copy {path} of {uri}")
+                        return path
+                    logging.warning(f"Cached copy {path} of {uri} is corrupt, downloading it again")
+
+                fd, partial = tempfile.mkstemp(dir=self.directory, prefix=f".{key}-")
+                os.close(fd)
+                try:
+                    self.storage.download(info, partial)
+                    if not self.verify(partial, info):
+                        raise IOError(f"Download of {uri} does not match its MD5 digest")
+                    os.replace(partial, path)
+                finally:
+                    if os.path.exists(partial):
+                        os.remove(partial)
+                self.evict(key, keep=path)
+                return path
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+    @staticmethod
+    def verify(path: str, info: ObjectInfo) -> bool:
+        if os.path.getsize(path) != info.size:
+            return False
+        return info.md5 is None or md5_of(path) == info.md5
+
+
+    def evict(self, key: str, keep: str) -> None:
+        """Removes the copies of older generations of an object
+
+        Processes still using them keep reading them until they close them.
+        """
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith(f"{key}-") and path != keep:
+                logging.debug(f"Evicting cached copy {path}")
+                os.remove(path)
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+"""Nearest-centroid search for models with many clusters
+"""
+
+import logging
+from typing import Tuple
+
+import numpy as np
+
+# From this many clusters on, the predictor assigns rows through a CentroidIndex
+INDEX_MIN_CLUSTERS = 128
+
+# Scores computed at once, a block of rows by every centroid: 256 KiB, which
+# stays in the L2 cache while the block is reduced to its nearest centroids
+BLOCK_VALUES = 1 << 15
+
+# Up to this many nearest centroids are selected one at a time, more at once
+SELECT_MAX = 8
+
+# Rows whose two nearest centroids score closer than this, relative to the
+# squared norms involved, are near ties that rounding could break either way
+TOLERANCE = 1e-9
+
+
+def scores(X: np.ndarray, centroids: np.ndarray, norms: np.ndarray) -> np.ndarray:
+    """Returns what KMeans.predict ranks centroids by, for every row of X
+
+    That is ||c||^2 - 2 x.c: the squared distances less the squared norm
+    of the row, computed in the same order as KMeans.predict.
+    """
+    values = X @ centroids.T
+    values *= -2
+    values += norms
+    return values
+
+
+class CentroidIndex:
+    """Exact nearest centroids of scaled rows, one cache-sized block at a time
+
+    The centroids are stored once as the matrix [-2 C | ||C||^2]^T, so that
+    the scores of a block of rows extended with a column of ones take a
+    single matrix product, and each block is reduced to its nearest
+    centroids while in cache: one pass over the scores instead of four, in
+    memory bounded by the block whatever the numbers of rows and clusters.
+
+    Those scores round differently from KMeans.predict in the last bits:
+    near ties are scored again the way KMeans.predict does, so that labels
+    are the same.
+    """
+
+    def __init__(self, centroids: np.ndarray, block_values: int = BLOCK_VALUES):
+        self.centroids = np.asarray(centroids, dtype=np.float64)
+        self.norms = (self.centroids ** 2).sum(axis=1)
+        k, d = self.centroids.shape
+        self.weights = np.empty((d + 1, k))
+        self.weights[:d] = -2 * self.centroids.T
+        self.weights[d] = self.norms
+        self.block = max(16, block_values // k)
+        logging.debug(f"CentroidIndex of {k} centroids in blocks of {self.block} rows")
+
+
+    @property
+    def n_clusters(self) -> int:
+        return len(self.centroids)
+
+
+    def assign(self, X: np.ndarray) -> np.ndarray:
+        """Returns the index of the nearest centroid of each row
+        """
+        return self.search(X, 1)[0][:, 0]
+
+
+    def search(self, X: np.ndarray, n: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the n nearest centroids of each row, and their distances
+
+        Both arrays have a row per row of X and n columns, nearest first.
+        """
+        X = np.asarray(X, dtype=np.float64)
+        k, d = self.centroids.shape
+        n = min(n, k)
+        n_rows = len(X)
+        labels = np.empty((n_rows, n), dtype=np.int32)
+        best = np.empty((n_rows, n))
+        second = np.full(n_rows, np.inf)
+
+        rows = np.ones((min(self.block, n_rows), d + 1))
+        values = np.empty((len(rows), k))
+        for start in range(0, n_rows, self.block):
+            stop = min(start + self.block, n_rows)
+            m = stop - start
+            rows[:m, :d] = X[start:stop]
+            block = np.matmul(rows[:m], self.weights, out=values[:m])
+            if n <= SELECT_MAX:
+                # Nearest first, one pass over the scores each
+                nearest = np.empty((m, n), dtype=np.int64)
+                for j in range(n):
+                    nearest[:, j] = block.argmin(axis=1)
+                    picked = nearest[:, j:j + 1]
+                    best[start:stop, j:j + 1] = np.take_along_axis(block, picked, axis=1)
+                    np.put_along_axis(block, picked, np.inf, axis=1)
+                # Runner-up, for the near ties
+                second[start:stop] = block.min(axis=1) if n == 1 else best[start:stop, 1]
+            else:
+                nearest = np.argpartition(block, n - 1, axis=1)[:, :n]
+                found = np.take_along_axis(block, nearest, axis=1)
+                order = found.argsort(axis=1, kind="stable")
+                nearest = np.take_along_axis(nearest, order, axis=1)
+                best[start:stop] = np.take_along_axis(found, order, axis=1)
+                second[start:stop] = best[start:stop, 1]
+            labels[start:stop] = nearest
+
+        x_norms = (X ** 2).sum(axis=1)
+        if n_rows and k > 1:
+            ties = np.flatnonzero(second - best[:, 0] <= TOLERANCE * (x_norms + self.norms.max()))
+            if len(ties):
+                exact = scores(X[ties], self.centroids, self.norms)
+                top = np.argsort(exact, axis=1, kind="stable")[:, :n]
+                labels[ties] = top
+                best[ties] = np.take_along_axis(exact, top, axis=1)
+
+        return labels, np.sqrt(np.maximum(best + x_norms[:, None], 0))
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+"""Columns of the raw customer data and of the model features
+
+Kept free of pandas, so that the prediction service can lay out requests
+without importing it.
+"""
+
+# Raw spending columns summed up into "Spent"
+MONETARY_COLUMNS = [
+    "MntWines",
+    "MntFruits",
+    "MntMeatProducts",
+    "MntFishProducts",
+    "MntSweetProducts",
+    "MntGoldProds",
+]
+
+# Raw columns copied as they are into the features
+PASSTHROUGH_COLUMNS = [
+    "Income",
+    "Kidhome",
+    "Teenhome",
+    "Recency",
+    *MONETARY_COLUMNS,
+    "NumDealsPurchases",
+    "NumWebPurchases",
+    "NumCatalogPurchases",
+    "NumStorePurchases",
+    "NumWebVisitsMonth",
+]
+
+# Raw columns the features are derived from
+RAW_COLUMNS = [
+    "Year_Birth",
+    "Education",
+    "Marital_Status",
+    "Dt_Customer",
+    *PASSTHROUGH_COLUMNS,
+]
+
+# Features, in the column order the fitted pipelines expect
+FEATURE_COLUMNS = [
+    "Education",
+    *PASSTHROUGH_COLUMNS,
+    "Customer_For",
+    "Age",
+    "Spent",
+    "Living_With",
+    "Children",
+    "Family_Size",
+    "Is_Parent",
+]
+
+CATEGORICAL_COLUMNS = ["Education", "Living_With"]
+
+# Raw and derived columns holding strings
+TEXT_COLUMNS = ["Education", "Marital_Status", "Dt_Customer", "Living_With"]
+
+NUMERIC_COLUMNS = [c for c in FEATURE_COLUMNS if c not in CATEGORICAL_COLUMNS]
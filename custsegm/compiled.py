@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+"""Numpy-only inference for fitted customer segmentation pipelines
+"""
+
+import logging
+from typing import Dict, Mapping, Optional, Sequence, Tuple
+
+import numpy as np
+
+from custsegm.centroid_index import INDEX_MIN_CLUSTERS, CentroidIndex, scores
+
+
+class CompiledPipeline:
+    """Flat representation of a fitted Pipeline(tr, sts, km)
+
+    The ColumnTransformer/OrdinalEncoder step is reduced to a column layout
+    and one vocabulary per categorical column, in code order (sorted, but
+    for the categories appended by incremental training), the StandardScaler step
+    to its mean/scale vectors and the KMeans step to its centroid matrix, so
+    that predicting is a single numpy kernel:
+
+        argmin_j ||(x - mean) / scale - c_j||^2
+
+    evaluated the way KMeans.predict does, as ||c_j||^2 - 2 (x - mean) / scale . c_j.
+    """
+
+    def __init__(self,
+                 input_columns: Sequence[str],
+                 layout: Sequence[str],
+                 categories: Mapping[str, Sequence],
+                 mean: np.ndarray,
+                 scale: np.ndarray,
+                 centroids: np.ndarray):
+        self.input_columns = list(input_columns)
+        self.layout = list(layout)
+        self.categories = {c: np.asarray(v, dtype=object) for c, v in categories.items()}
+        # Sort order of the vocabularies which are not sorted
+        self.sorters = {c: np.argsort(v, kind="stable") for c, v in self.categories.items()
+                        if not np.all(v[:-1] < v[1:])}
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.scale = np.asarray(scale, dtype=np.float64)
+        self.centroids = np.asarray(centroids, dtype=np.float64)
+        self.centroids_squared_norms = (self.centroids ** 2).sum(axis=1)
+        # Built by build_index(), for models with many clusters
+        self.index = None
+
+
+    @property
+    def n_clusters(self) -> int:
+        return self.centroids.shape[0]
+
+
+    @staticmethod
+    def from_pipeline(pipeline) -> "CompiledPipeline":
+        """Extracts the fitted parameters of a Pipeline(tr, sts, km)
+
+        Raises ValueError when the pipeline has steps that cannot be compiled.
+        """
+        try:
+            transformer = pipeline["tr"]
+            scaler = pipeline["sts"]
+            kmeans = pipeline["km"]
+        except (KeyError, TypeError) as e:
+            raise ValueError(f"Unexpected pipeline steps: {e}")
+
+        # Column names seen at fit time (sklearn >= 1.0, then 0.24)
+        input_columns = getattr(transformer, "feature_names_in_", None)
+        if input_columns is None:
+            input_columns = getattr(transformer, "_df_columns", None)
+        if input_columns is None:
+            raise ValueError("Pipeline was not fitted on a DataFrame")
+        input_columns = [str(c) for c in input_columns]
+
+        layout = []
+        categories = {}
+        for name, step, columns in transformer.transformers_:
+            if isinstance(step, str) and step == "drop":
+                continue
+            names = [input_columns[c] if isinstance(c, (int, np.integer)) else str(c)
+                     for c in columns]
+            if isinstance(step, str) and step == "passthrough":
+                layout.extend(names)
+            elif type(step).__name__ == "OrdinalEncoder":
+                layout.extend(names)
+                categories.update(zip(names, step.categories_))
+            else:
+                raise ValueError(f"Cannot compile transformer {name}={step!r}")
+
+        n_features = len(layout)
+        mean = scaler.mean_ if scaler.with_mean else np.zeros(n_features)
+        scale = scaler.scale_ if scaler.with_std else np.ones(n_features)
+
+        return CompiledPipeline(input_columns, layout, categories,
+                                mean, scale, kmeans.cluster_centers_)
+
+
+    def encode(self, column: str, values: np.ndarray) -> np.ndarray:
+        """Maps categorical values to their ordinal codes
+
+        Raises ValueError for values unknown at fit time, like OrdinalEncoder.
+        """
+        vocabulary = self.categories[column]
+        sorter = self.sorters.get(column)
+        values = np.asarray(values, dtype=object)
+        try:
+            codes = np.searchsorted(vocabulary, values, sorter=sorter)
+        except TypeError:
+            codes = None
+        if codes is not None:
+            found = codes < len(vocabulary)
+            if sorter is not None:
+                codes[found] = sorter[codes[found]]
+            found[found] = vocabulary[codes[found]] == values[found]
+            if found.all():
+                return codes
+            unknown = values[~found]
+        else:
+            unknown = values
+        raise ValueError(f"Found unknown categories {list(unknown[:5])} "
+                         f"in column {column} during transform")
+
+
+    def transform(self, data: Mapping[str, np.ndarray]) -> np.ndarray:
+        """Returns the scaled feature matrix of the given columns
+
+        data can be a DataFrame or any mapping of column names to arrays.
+        """
+        n = len(data[self.layout[0]])
+        X = np.empty((n, len(self.layout)), dtype=np.float64)
+        for i, column in enumerate(self.layout):
+            if column in self.categories:
+                X[:, i] = self.encode(column, data[column])
+            else:
+                X[:, i] = np.asarray(data[column], dtype=np.float64)
+        if not np.isfinite(X).all():
+            # KMeans does not accept missing values either
+            raise ValueError("Input contains NaN, infinity or a value too large")
+        X -= self.mean
+        X /= self.scale
+        return X
+
+
+    def predict(self, data: Mapping[str, np.ndarray]) -> np.ndarray:
+        return self.assign(self.transform(data))
+
+
+    def assign(self, X: np.ndarray) -> np.ndarray:
+        """Returns the index of the nearest centroid of each scaled row
+        """
+        if self.index is not None:
+            return self.index.assign(X)
+        return scores(X, self.centroids, self.centroids_squared_norms).argmin(axis=1).astype(np.int32)
+
+
+    def nearest(self, X: np.ndarray, n: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the n nearest centroids of each scaled row, and their distances
+
+        Both arrays have a row per row of X and n columns (at most
+        n_clusters), nearest first: the first column is assign(X).
+        """
+        return (self.index or CentroidIndex(self.centroids)).search(X, n)
+
+
+    def build_index(self, min_clusters: int = INDEX_MIN_CLUSTERS) -> bool:
+        """Assigns rows through a CentroidIndex from min_clusters clusters on
+
+        The index is checked against the brute force assignment on the
+        probe points first. Returns whether it is used.
+        """
+        if self.n_clusters < min_clusters:
+            return False
+        index = CentroidIndex(self.centroids)
+        X = self.transform(self.probe())
+        expected = scores(X, self.centroids, self.centroids_squared_norms).argmin(axis=1)
+        if not np.array_equal(index.assign(X), expected):
+            logging.warning("Centroid index does not match the brute force assignment")
+            return False
+        self.index = index
+        return True
+
+
+    def probe(self, n_per_cluster: int = 8, random_state: int = 0) -> Dict[str, np.ndarray]:
+        """Returns input columns for the centroids and points scattered around them
+
+        Used to check the compiled representation against the pipeline.
+        """
+        rng = np.random.RandomState(random_state)
+        points = np.repeat(self.centroids, n_per_cluster + 1, axis=0)
+        points += rng.normal(scale=0.5, size=points.shape)
+        points[::n_per_cluster + 1] = self.centroids
+        X = points * self.scale + self.mean
+
+        data = {}
+        for i, column in enumerate(self.layout):
+            if column in self.categories:
+                vocabulary = self.categories[column]
+                codes = np.clip(np.rint(X[:, i]), 0, len(vocabulary) - 1).astype(int)
+                data[column] = vocabulary[codes]
+            else:
+                data[column] = X[:, i]
+        return {column: data[column] for column in self.input_columns}
+
+
+def compile_pipeline(pipeline) -> Optional[CompiledPipeline]:
+    """Compiles a pipeline and checks it predicts exactly like pipeline.predict
+
+    Returns None, so that callers keep using the pipeline, when the pipeline
+    cannot be compiled or the check fails.
+    """
+    import pandas as pd
+
+    try:
+        compiled = CompiledPipeline.from_pipeline(pipeline)
+    except (ValueError, AttributeError) as e:
+        logging.warning(f"Pipeline cannot be compiled: {e}")
+        return None
+
+    probe = compiled.probe()
+    try:
+        expected = pipeline.predict(pd.DataFrame(probe, columns=compiled.input_columns))
+    except Exception as e:
+        # Left to fail on requests, as it would uncompiled, not on loading
+        logging.warning(f"Pipeline cannot be checked, not compiled: {e!r}")
+        return None
+    if not np.array_equal(compiled.predict(probe), expected):
+        logging.warning("Compiled pipeline does not match pipeline.predict")
+        return None
+
+    logging.debug(f"Compiled pipeline with {compiled.n_clusters} clusters "
+                  f"and {len(compiled.layout)} features")
+    return compiled
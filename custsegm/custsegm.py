@@ -3,30 +3,23 @@
 """Customer Personality Analysis
 """
 
+import copy
 import logging
-import os
-from typing import List, Tuple
+import time
+from typing import Callable, Collection, Dict, Iterable, Optional, Tuple
 from datetime import date
-import json
 import numpy as np
 import pandas as pd
 
-from sklearn.preprocessing import OneHotEncoder
 from sklearn.preprocessing import OrdinalEncoder
-from sklearn.preprocessing import LabelEncoder
 from sklearn.preprocessing import StandardScaler
 from sklearn.compose import ColumnTransformer
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
 from sklearn.pipeline import Pipeline
-from sklearn.base import TransformerMixin, BaseEstimator
 
-#import sys
-import warnings
-
-#if not sys.warnoptions:
-#    warnings.simplefilter("ignore")
-
-from pandas.core.common import SettingWithCopyWarning
+from custsegm import metrics
+from custsegm.features import CATEGORICAL_COLUMNS, FeatureEngine
+from custsegm.sampling import STRATA, stratified_sample
 
 
 class CustomerSegmentation:
@@ -37,6 +30,10 @@ class CustomerSegmentation:
                  income_cap: int = 600000,
                  debug: bool = False):
         self.pipeline = pipeline
+        # Preprocessing state fitted along with the pipeline, if any
+        self.feature_engine = getattr(pipeline, "feature_engine_", None)
+        if self.feature_engine and not as_of_year:
+            as_of_year = self.feature_engine.as_of_year
         self.as_of_year = as_of_year or date.today().year
         self.age_cap = age_cap
         self.income_cap = income_cap
@@ -53,94 +50,19 @@ class CustomerSegmentation:
         mode = "training" if training else "prediction"
         logging.debug(f"Preprocess data for {mode}")
 
+        # Derive the features (Customer_For, Age, Spent, Living_With,
+        # Children, Family_Size, Is_Parent and the grouped Education levels)
+        # and, when training, drop missing values and outliers
         if training:
-            data = data.dropna()
-
-        # Create a feature out of "Dt_Customer" that indicates the number of
-        # days a customer is registered in the firm's database
-        warnings.simplefilter(action="ignore", category=SettingWithCopyWarning)
-        data["Dt_Customer"] = pd.to_datetime(data["Dt_Customer"])
-        max_date = data["Dt_Customer"].max()
-        data["Customer_For"] = max_date
-        data["Customer_For"] = (data["Customer_For"] - data["Dt_Customer"]).dt.days
-        data["Customer_For"] = pd.to_numeric(data["Customer_For"], errors="coerce")
-
-        # Age of customer as of today
-        data["Age"] = self.as_of_year - data["Year_Birth"]
-
-        # Total spendings on various items
-        data["Spent"] = data[
-            [
-                "MntWines",
-                "MntFruits",
-                "MntMeatProducts",
-                "MntFishProducts",
-                "MntSweetProducts",
-                "MntGoldProds",
-            ]
-        ].sum(axis=1)
-
-        # Deriving living situation by marital status
-        data["Living_With"] = data["Marital_Status"].replace(
-            {
-                "Married": "Partner",
-                "Together": "Partner",
-                "Absurd": "Alone",
-                "Widow": "Alone",
-                "YOLO": "Alone",
-                "Divorced": "Alone",
-                "Single": "Alone",
-            }
-        )
-
-        # Feature indicating total children living in the household
-        data["Children"] = data["Kidhome"] + data["Teenhome"]
-
-        # Feature for total members in the householde
-        data["Family_Size"] = (
-            data["Living_With"].replace(
-                {"Alone": 1, "Partner": 2}
-            ) + data["Children"]
-        )
-
-        # Feature parenthood
-        data["Is_Parent"] = np.where(data.Children > 0, 1, 0)
-
-        # Segment education levels in three groups
-        data["Education"] = data["Education"].replace(
-            {
-                "Basic": "Undergraduate",
-                "2n Cycle": "Undergraduate",
-                "Graduation": "Graduate",
-                "Master": "Postgraduate",
-                "PhD": "Postgraduate",
-            }
-        )
-
-        # Drop some of the now redundant features
-        redundant = ["Marital_Status", "Dt_Customer", "Year_Birth"]
-        data = data.drop(redundant, axis=1)
-
-        # Drop unused features
-        unused = [
-            "ID",
-            "AcceptedCmp3",
-            "AcceptedCmp4",
-            "AcceptedCmp5",
-            "AcceptedCmp1",
-            "AcceptedCmp2",
-            "Complain",
-            "Response",
-            "Z_CostContact",
-            "Z_Revenue",
-        ]
-        data = data.drop(unused, axis=1, errors="ignore")
+            self.feature_engine = FeatureEngine(self.as_of_year)
+            data = self.feature_engine.fit_transform(data,
+                                                     age_cap=self.age_cap,
+                                                     income_cap=self.income_cap)
+        else:
+            engine = self.feature_engine or FeatureEngine(self.as_of_year)
+            with metrics.stage("preprocess"):
+                data = engine.transform(data)
 
-        if training:
-            # Drop the outliers by setting a cap on age and income
-            data = data[data["Age"] < self.age_cap]
-            data = data[data["Income"] < self.income_cap]
-            
         #if self.debug:
         #    print(f"Preprocessed {mode} data:")
         #    print(data.info())
@@ -151,7 +73,24 @@ class CustomerSegmentation:
 
     def train(self, data: pd.DataFrame, n_clusters: int = 4, random_state: int = 42) -> Pipeline:
         logging.debug(f"Train n_clusters={n_clusters}")
-        
+
+        transformer, scaler, X = self.fit_preprocessing(data)
+        kmeans = KMeans(n_clusters=n_clusters, random_state=random_state)
+        kmeans.fit(X)
+
+        #if self.debug:
+        #    print("Trained data\n", data)
+        #    print("Trained data stats\n", data.describe().T)
+
+        return self.assemble(transformer, scaler, kmeans)
+
+
+    def fit_preprocessing(self, data: pd.DataFrame) -> Tuple[ColumnTransformer, StandardScaler, np.ndarray]:
+        """Preprocesses training data and fits the encoding and scaling steps
+
+        Returns the fitted steps along with the scaled training data, which
+        any number of cluster models can then be fitted on.
+        """
         data = self.preprocess(data, training=True)
 
         #numerical = data.select_dtypes(include=["int64", "float64"]).columns
@@ -165,41 +104,352 @@ class CustomerSegmentation:
             ],
             remainder = "passthrough"
         )
+        scaler = StandardScaler()
+
+        X = scaler.fit_transform(transformer.fit_transform(data))
+        return transformer, scaler, X
 
+
+    def assemble(self, transformer: ColumnTransformer, scaler: StandardScaler, kmeans: KMeans) -> Pipeline:
+        """Puts fitted steps together into the pipeline model artifact
+        """
         pipeline = Pipeline(steps=[
             ('tr', transformer),
-            ('sts', StandardScaler()),
-            ('km', KMeans(n_clusters=n_clusters, random_state=random_state))
+            ('sts', scaler),
+            ('km', kmeans)
         ])
 
-        pipeline.fit_transform(data)
-
-        data["Clusters"] = pipeline["km"].labels_
-
-        #if self.debug:
-        #    print("Trained data\n", data)
-        #    print("Trained data stats\n", data.describe().T)
+        # Keep the fitted preprocessing state inside the model artifact, so
+        # predictions from raw data do not depend on how rows are batched
+        pipeline.feature_engine_ = self.feature_engine
 
         self.pipeline = pipeline
         return pipeline
 
 
+    def train_streaming(self,
+                        chunks: Callable[[], Iterable[pd.DataFrame]],
+                        n_clusters: int = 4,
+                        random_state: int = 42,
+                        batch_size: int = 1024,
+                        n_epochs: int = 3) -> Pipeline:
+        """Trains on data streamed in chunks, never holding all of it in memory
+
+        chunks is called once per pass over the data and must return the
+        same chunks of raw customer data every time. A first pass fits the
+        preprocessing state and gathers the categories, a second one the
+        scaler statistics, and n_epochs more passes fit the clusters with
+        mini-batches of batch_size rows. The result is a pipeline of the same
+        shape as the one of train().
+        """
+        logging.debug(f"Train streaming n_clusters={n_clusters}" +
+                      f" batch_size={batch_size}" +
+                      f" n_epochs={n_epochs}")
+
+        def preprocessed():
+            for chunk in chunks():
+                data = self.feature_engine.transform(chunk,
+                                                     training=True,
+                                                     age_cap=self.age_cap,
+                                                     income_cap=self.income_cap)
+                if len(data):
+                    yield data
+
+        # Preprocessing state and categories
+        self.feature_engine = FeatureEngine(self.as_of_year)
+        categories = {column: set() for column in CATEGORICAL_COLUMNS}
+        sample = None
+        for chunk in chunks():
+            self.feature_engine.partial_fit(chunk)
+            data = self.feature_engine.transform(chunk,
+                                                 training=True,
+                                                 age_cap=self.age_cap,
+                                                 income_cap=self.income_cap)
+            for column, seen in categories.items():
+                seen.update(data[column].unique())
+            if sample is None and len(data):
+                sample = data.head(1)
+        if sample is None:
+            raise ValueError("No training data left after preprocessing")
+
+        # The categories are known, so fitting the encoder on any row
+        # only records the column layout
+        transformer = ColumnTransformer(
+            [
+                ('oe', OrdinalEncoder(categories=[sorted(categories[c])
+                                                  for c in CATEGORICAL_COLUMNS]),
+                 CATEGORICAL_COLUMNS)
+            ],
+            remainder = "passthrough"
+        )
+        transformer.fit(sample)
+
+        # Scaler statistics
+        scaler = StandardScaler()
+        for data in preprocessed():
+            scaler.partial_fit(transformer.transform(data))
+
+        # Clusters
+        kmeans = MiniBatchKMeans(n_clusters=n_clusters,
+                                 random_state=random_state,
+                                 batch_size=batch_size)
+        rng = np.random.RandomState(random_state)
+        for epoch in range(n_epochs):
+            for data in preprocessed():
+                X = scaler.transform(transformer.transform(data))
+                X = X[rng.permutation(len(X))]
+                for start in range(0, len(X), batch_size):
+                    batch = X[start:start + batch_size]
+                    if len(batch) >= n_clusters:
+                        kmeans.partial_fit(batch)
+            logging.debug(f"Trained epoch {epoch + 1}/{n_epochs}")
+
+        return self.assemble(transformer, scaler, kmeans)
+
+
+    def train_incremental(self,
+                          data: pd.DataFrame,
+                          previous: Pipeline,
+                          delta: Optional[pd.DataFrame] = None,
+                          replaced: Collection = ()) -> Tuple[Pipeline, Dict]:
+        """Retrains a previous pipeline, starting from its fitted state
+
+        data is what the clusters are refitted on, typically a sample of the
+        whole dataset plus the new or changed rows; delta, when given, is the
+        new or changed rows alone, which the preprocessing state and scaler
+        statistics of the previous pipeline are updated with, but for the
+        rows whose ID is in replaced: changed customers the previous pipeline
+        was fitted on already. Categories new to the previous pipeline get
+        codes after its own, which keep theirs. KMeans then
+        starts from the previous centroids with a single initialization, and
+        the new clusters are relabelled to match the previous ones, so that
+        cluster IDs stay stable across retrainings.
+
+        Returns the new pipeline and a report of how far centroids moved.
+        """
+        logging.debug(f"Train incremental from previous n_clusters=" +
+                      f"{previous['km'].n_clusters}")
+
+        # Preprocessing state and scaler statistics
+        self.feature_engine = copy.deepcopy(getattr(previous, "feature_engine_", None)) \
+            or FeatureEngine(self.as_of_year)
+        self.as_of_year = self.feature_engine.as_of_year
+        previous_scaler = previous["sts"]
+        scaler = copy.deepcopy(previous_scaler)
+        if delta is not None and len(delta):
+            self.feature_engine.partial_fit(delta)
+            if len(replaced) and "ID" in delta:
+                # Replaced rows are in the scaler statistics already
+                delta = delta[~delta["ID"].isin(np.array(list(replaced)))]
+            delta = self.feature_engine.transform(delta,
+                                                  training=True,
+                                                  age_cap=self.age_cap,
+                                                  income_cap=self.income_cap)
+
+        data = self.feature_engine.transform(data,
+                                             training=True,
+                                             age_cap=self.age_cap,
+                                             income_cap=self.income_cap)
+        transformer = extend_categories(previous["tr"], data)
+        if delta is not None and len(delta):
+            transformer = extend_categories(transformer, delta)
+            scaler.partial_fit(transformer.transform(delta))
+        X = scaler.transform(transformer.transform(data))
+
+        # Previous centroids, in the new scaling
+        previous_centers = previous["km"].cluster_centers_
+        previous_raw = previous_scaler.inverse_transform(previous_centers)
+        init = scaler.transform(previous_raw)
+        kmeans = KMeans(n_clusters=len(init), init=init, n_init=1)
+        kmeans.fit(X)
+        kmeans = relabel(kmeans, init)
+
+        raw = scaler.inverse_transform(kmeans.cluster_centers_)
+        shift = np.linalg.norm(kmeans.cluster_centers_ - init, axis=1)
+        report = {
+            "n_rows": len(X),
+            "n_delta_rows": 0 if delta is None else len(delta),
+            "n_iter": int(kmeans.n_iter_),
+            "inertia": float(kmeans.inertia_),
+            "centroid_shift": shift.tolist(),
+            "max_centroid_shift": float(shift.max()),
+            "centroid_shift_by_feature": (raw - previous_raw).tolist(),
+        }
+        logging.debug(f"Centroids moved by {np.round(shift, 4).tolist()}")
+
+        return self.assemble(transformer, scaler, kmeans), report
+
+
+    def train_subsample(self,
+                        data: pd.DataFrame,
+                        size: int,
+                        holdout: pd.DataFrame = None,
+                        n_clusters: int = 4,
+                        random_state: int = 42,
+                        strata: Iterable[str] = STRATA) -> Tuple[Pipeline, Dict]:
+        """Trains on a stratified subsample of size rows of data
+
+        With holdout, the subsample model is rated as well: a reference
+        model is trained on all of data, and both are compared on the
+        held-out customers (see compare_pipelines), so that the fit time
+        saved can be weighed against the quality lost. The clusters of the
+        subsample model are then relabelled to match those of the reference
+        model.
+
+        Returns the subsample pipeline and the report.
+        """
+        logging.debug(f"Train on a subsample of {size} of {len(data)} rows")
+
+        started = time.perf_counter()
+        sample = stratified_sample(data, size, list(strata), random_state)
+        pipeline = self.train(sample, n_clusters, random_state)
+        sample_seconds = time.perf_counter() - started
+        report = {
+            "n_rows": len(data),
+            "n_sample_rows": len(sample),
+            "sample_seconds": sample_seconds,
+        }
+        if holdout is None:
+            return pipeline, report
+
+        started = time.perf_counter()
+        reference = CustomerSegmentation(as_of_year=self.as_of_year,
+                                         age_cap=self.age_cap,
+                                         income_cap=self.income_cap).train(data, n_clusters, random_state)
+        full_seconds = time.perf_counter() - started
+
+        # Reference centroids, in the scaling of the subsample model
+        reference_raw = reference["sts"].inverse_transform(reference["km"].cluster_centers_)
+        relabel(pipeline["km"], pipeline["sts"].transform(reference_raw))
+
+        report.update({
+            "n_holdout_rows": len(holdout),
+            "full_seconds": full_seconds,
+            "speedup": full_seconds / sample_seconds if sample_seconds else None,
+            **compare_pipelines(reference, pipeline, holdout),
+        })
+        logging.info(f"Subsample model: {report['agreement']:.1%} of held-out customers "
+                     f"in the same cluster, inertia x{report['inertia_ratio']:.3f}, "
+                     f"fitted {report['speedup']:.1f}x faster")
+        return pipeline, report
+
+
     def predict(self, data: pd.DataFrame, preprocess=True):
         logging.debug(f"Predict")
         
         if preprocess:
             data = self.preprocess(data, training=False)
         
+        metrics.record_request(len(data))
+
         if self.debug:
             print("Prediction input:")
             #json_string = data.head(1).reset_index().to_json(orient='records')
             #print(json_string)
             print(data)
         
-        predictions = self.pipeline.predict(data)
+        with metrics.stage("transform"):
+            X = self.pipeline[:-1].transform(data)
+        with metrics.stage("assign"):
+            predictions = self.pipeline[-1].predict(X)
         
         if self.debug:
             print("Prediction output:")
             print(predictions)
             
         return predictions
+
+
+def extend_categories(transformer: ColumnTransformer, data: pd.DataFrame) -> ColumnTransformer:
+    """Returns the fitted transformer, encoding the categories of data it has not seen too
+
+    New categories are appended to those of its OrdinalEncoder steps, so
+    that the categories it knew keep their codes. The transformer is
+    returned as it is when there is none.
+    """
+    extended = None
+    for name, step, columns in transformer.transformers_:
+        if not isinstance(step, OrdinalEncoder):
+            continue
+        for i, column in enumerate(columns):
+            categories = step.categories_[i]
+            values = data[column].dropna().unique()
+            new = sorted(set(values) - set(categories))
+            if not new:
+                continue
+            logging.info(f"New {column} categories: {new}")
+            if extended is None:
+                extended = copy.deepcopy(transformer)
+            encoder = extended.named_transformers_[name]
+            encoder.categories_[i] = np.concatenate([categories, np.array(new, dtype=categories.dtype)])
+    return extended or transformer
+
+
+def relabel(kmeans: KMeans, reference_centers: np.ndarray) -> KMeans:
+    """Reorders the clusters of a fitted KMeans to match reference centroids
+
+    Cluster j of the result is the one closest to reference_centers[j], the
+    pairs minimizing the total distance (Hungarian algorithm).
+    """
+    from scipy.optimize import linear_sum_assignment
+
+    distances = ((reference_centers[:, None, :] - kmeans.cluster_centers_[None, :, :]) ** 2).sum(axis=2)
+    _, order = linear_sum_assignment(distances)
+    if (order != np.arange(len(order))).any():
+        logging.debug(f"Relabelling clusters {order.tolist()}")
+        kmeans.cluster_centers_ = kmeans.cluster_centers_[order]
+        labels = getattr(kmeans, "labels_", None)
+        if labels is not None:
+            kmeans.labels_ = np.argsort(order)[labels].astype(labels.dtype)
+    return kmeans
+
+
+def compare_pipelines(reference: Pipeline, candidate: Pipeline, holdout: pd.DataFrame) -> Dict:
+    """Rates a candidate pipeline against a reference one on held-out raw data
+
+    Both pipelines derive the features of the held-out customers with their
+    own preprocessing state, as they would in production. The report holds:
+    - agreement: share of customers put in matching clusters, clusters being
+      matched one to one to maximize it;
+    - adjusted_rand_index: agreement corrected for chance, 1 at best;
+    - inertia_ratio: inertia of the candidate centroids over that of the
+      reference centroids, both in the reference scaling, 1 at best;
+    - max_centroid_shift: largest distance between matched centroids, in
+      standard deviations of the reference scaling.
+    """
+    from scipy.optimize import linear_sum_assignment
+    from sklearn.metrics import adjusted_rand_score
+
+    holdout = holdout.dropna()
+
+    def features(pipeline):
+        engine = getattr(pipeline, "feature_engine_", None) or FeatureEngine(date.today().year)
+        return engine.transform(holdout)
+
+    X = reference[:-1].transform(features(reference))
+    reference_labels = reference["km"].predict(X)
+    candidate_labels = candidate.predict(features(candidate))
+
+    k = reference["km"].n_clusters
+    confusion = np.zeros((k, candidate["km"].n_clusters), dtype=np.int64)
+    np.add.at(confusion, (reference_labels, candidate_labels), 1)
+    rows, columns = linear_sum_assignment(-confusion)
+    agreement = confusion[rows, columns].sum() / max(len(holdout), 1)
+
+    # Candidate centroids, in the reference scaling
+    centers = reference["sts"].transform(
+        candidate["sts"].inverse_transform(candidate["km"].cluster_centers_))
+
+    def inertia(centers):
+        distances = ((X[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+        return float(distances.min(axis=1).sum())
+
+    reference_inertia = inertia(reference["km"].cluster_centers_)
+    shift = np.linalg.norm(reference["km"].cluster_centers_[rows] - centers[columns], axis=1)
+    return {
+        "agreement": float(agreement),
+        "adjusted_rand_index": float(adjusted_rand_score(reference_labels, candidate_labels)),
+        "reference_inertia": reference_inertia,
+        "inertia_ratio": inertia(centers) / reference_inertia if reference_inertia else None,
+        "max_centroid_shift": float(shift.max()),
+    }
@@ -1,26 +1,153 @@
-from typing import List, Tuple
+from typing import BinaryIO, Iterator, List, Optional, Tuple
 
-import subprocess
 import logging
+import os
+import tempfile
+import numpy as np
 import pandas as pd
 from sklearn.model_selection import train_test_split
 
+from custsegm.features import RAW_COLUMNS, parse_dates
+from custsegm.sampling import split_chunks
+from custsegm.storage import default_project_id, default_storage
+
 import warnings
 
 
+# Columns read by default: the customer ID and the columns the features are
+# derived from. The other columns of the export (AcceptedCmp*, Complain,
+# Response, Z_*) are never loaded.
+COLUMNS = ["ID", *RAW_COLUMNS]
+
+# Narrowest types holding the values of the export. Integer columns with
+# missing values, or values out of range, are kept wider.
+DTYPES = {
+    "ID": "int64",
+    "Year_Birth": "int16",
+    "Education": "category",
+    "Marital_Status": "category",
+    "Income": "float64",
+    "Kidhome": "int8",
+    "Teenhome": "int8",
+    "Recency": "int16",
+    "MntWines": "int32",
+    "MntFruits": "int32",
+    "MntMeatProducts": "int32",
+    "MntFishProducts": "int32",
+    "MntSweetProducts": "int32",
+    "MntGoldProds": "int32",
+    "NumDealsPurchases": "int16",
+    "NumWebPurchases": "int16",
+    "NumCatalogPurchases": "int16",
+    "NumStorePurchases": "int16",
+    "NumWebVisitsMonth": "int16",
+}
+
+# File extensions of the columnar formats, by format
+COLUMNAR_FORMATS = {
+    "parquet": (".parquet", ".pq"),
+    "arrow": (".arrow", ".feather", ".ipc"),
+}
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        import pyarrow.feather
+    except ImportError:
+        raise ImportError("Reading and writing Parquet or Arrow files requires pyarrow")
+    return pyarrow
+
+
 class Dataset():
     
+    @staticmethod
+    def format_of(uri: str) -> str:
+        """Returns the format of a dataset by its extension: parquet, arrow or csv
+        """
+        for format, extensions in COLUMNAR_FORMATS.items():
+            if uri.lower().endswith(extensions):
+                return format
+        return "csv"
+
+
+    @staticmethod
+    def typed(frame: pd.DataFrame) -> pd.DataFrame:
+        """Narrows the columns of a chunk to DTYPES and parses its dates
+        """
+        for name, dtype in DTYPES.items():
+            if name not in frame.columns or frame[name].dtype == dtype:
+                continue
+            values = frame[name]
+            if dtype.startswith("int"):
+                if not pd.api.types.is_numeric_dtype(values) or values.isna().any():
+                    continue
+                bounds = np.iinfo(dtype)
+                if len(values) and (values.min() < bounds.min or values.max() > bounds.max):
+                    continue
+            frame[name] = values.astype(dtype)
+        if "Dt_Customer" in frame.columns and not pd.api.types.is_datetime64_dtype(frame["Dt_Customer"]):
+            frame["Dt_Customer"] = parse_dates(frame["Dt_Customer"].to_numpy())
+        return frame
+
+
+    @staticmethod
+    def open(uri: str, storage=None) -> BinaryIO:
+        """Opens a local file, or streams a gs:// object without a local copy
+        """
+        if uri.startswith("gs://"):
+            return (storage or default_storage()).open(uri)
+        return open(uri, "rb")
+
+
+    @staticmethod
+    def read(uri: str,
+             columns: Optional[List[str]] = COLUMNS,
+             storage=None) -> pd.DataFrame:
+        """Reads a whole TSV, Parquet or Arrow dataset
+
+        Only the given columns are read, when the dataset has them (all of
+        them if columns is None), and they are narrowed to DTYPES.
+        """
+        format = Dataset.format_of(uri)
+        with Dataset.open(uri, storage) as f:
+            if format == "csv":
+                # Tab-separated values, whatever the extension
+                wanted = set(columns) if columns else None
+                df = pd.read_csv(f,
+                                 sep="\t",
+                                 usecols=(lambda c: c in wanted) if wanted else None,
+                                 dtype={name: dtype for name, dtype in DTYPES.items()
+                                        if not dtype.startswith("int")})
+            else:
+                pa = _pyarrow()
+                if format == "parquet":
+                    names = pa.parquet.ParquetFile(f).schema_arrow.names
+                    f.seek(0)
+                    read_table = pa.parquet.read_table
+                else:
+                    names = pa.ipc.open_file(f).schema.names
+                    f.seek(0)
+                    read_table = pa.feather.read_table
+                present = [c for c in names if not columns or c in columns]
+                df = read_table(f, columns=present).to_pandas()
+        return Dataset.typed(df)
+
+
     @staticmethod
     def read_train_test(uri: str,
                         test_size: float = 0.10,
-                        random_state: int = 42
+                        random_state: int = 42,
+                        storage=None,
+                        columns: Optional[List[str]] = COLUMNS
                        ) -> Tuple[pd.DataFrame, pd.DataFrame]:
 
         warnings.filterwarnings(action="ignore", message="unclosed", category=ResourceWarning)
         
-        # Read training dataset (assumed to fit in memory)
-        # as a Tab-Separated-Values (*.tsv) file
-        df = pd.read_csv(uri, sep="\t")
+        # Read training dataset (assumed to fit in memory), as
+        # Tab-Separated-Values (*.tsv) or Parquet/Arrow files
+        df = Dataset.read(uri, columns, storage)
             
         # Remove missing values
         df = df.dropna()
@@ -33,18 +160,149 @@ class Dataset():
         return train_df, test_df
 
 
+    @staticmethod
+    def read_split(uri: str,
+                   test_size: float = 0.10,
+                   train_size: Optional[int] = None,
+                   chunk_size: int = 100000,
+                   storage=None,
+                   columns: Optional[List[str]] = COLUMNS
+                  ) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """Splits a dataset into training and test data while streaming it
+
+        Unlike read_train_test, customers are held out by the hash of their
+        ID, so the split is the same on every run and never needs the whole
+        dataset in memory: with train_size, the training data is a uniform
+        sample of train_size rows and the test data is sampled alike.
+        """
+        return split_chunks(Dataset.read_chunks(uri, chunk_size, storage, columns),
+                            test_size, train_size)
+
+
+    @staticmethod
+    def read_chunks(uri: str,
+                    chunk_size: int = 100000,
+                    storage=None,
+                    columns: Optional[List[str]] = COLUMNS) -> Iterator[pd.DataFrame]:
+        """Yields the training dataset in chunks of at most chunk_size rows
+
+        For datasets that do not fit in memory; see read_train_test and read.
+        Chunks of Parquet datasets do not span row groups.
+        """
+        warnings.filterwarnings(action="ignore", message="unclosed", category=ResourceWarning)
+
+        format = Dataset.format_of(uri)
+        with Dataset.open(uri, storage) as f:
+            if format == "csv":
+                wanted = set(columns) if columns else None
+                for chunk in pd.read_csv(f,
+                                         sep="\t",
+                                         usecols=(lambda c: c in wanted) if wanted else None,
+                                         dtype={name: dtype for name, dtype in DTYPES.items()
+                                                if not dtype.startswith("int")},
+                                         chunksize=chunk_size):
+                    yield Dataset.typed(chunk)
+                return
+
+            pa = _pyarrow()
+            if format == "parquet":
+                parquet = pa.parquet.ParquetFile(f)
+                present = [c for c in parquet.schema_arrow.names if not columns or c in columns]
+                batches = parquet.iter_batches(batch_size=chunk_size, columns=present)
+            else:
+                reader = pa.ipc.open_file(f)
+                present = [c for c in reader.schema.names if not columns or c in columns]
+                batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+            for batch in batches:
+                table = pa.Table.from_batches([batch]).select(present)
+                for start in range(0, table.num_rows, chunk_size):
+                    yield Dataset.typed(table.slice(start, chunk_size).to_pandas())
+
+
+    @staticmethod
+    def convert(source: str,
+                destination: str,
+                chunk_size: int = 1000000,
+                storage=None,
+                columns: Optional[List[str]] = COLUMNS) -> int:
+        """Converts a dataset to Parquet, or Arrow, chunk by chunk
+
+        The columns are pruned and narrowed as when read, and every chunk
+        becomes a row group. Returns the number of rows written.
+        """
+        pa = _pyarrow()
+        format = Dataset.format_of(destination)
+        if format == "csv":
+            raise ValueError(f"Not a Parquet or Arrow file name: {destination}")
+
+        local = destination
+        if destination.startswith("gs://"):
+            fd, local = tempfile.mkstemp(suffix=os.path.splitext(destination)[1])
+            os.close(fd)
+
+        writer = None
+        schema = None
+        rows = 0
+        try:
+            for chunk in Dataset.read_chunks(source, chunk_size, storage, columns):
+                if schema is None:
+                    schema = Dataset.arrow_schema(chunk, dictionaries=format == "parquet")
+                    if format == "parquet":
+                        writer = pa.parquet.ParquetWriter(local, schema)
+                    else:
+                        writer = pa.ipc.new_file(local, schema)
+                table = pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+                if format == "parquet":
+                    writer.write_table(table, row_group_size=chunk_size)
+                else:
+                    writer.write_table(table, max_chunksize=chunk_size)
+                rows += len(chunk)
+                logging.debug(f"Converted {rows} rows of {source}")
+            if writer is not None:
+                writer.close()
+                writer = None
+            if local != destination:
+                (storage or default_storage()).upload(local, destination)
+        finally:
+            if writer is not None:
+                writer.close()
+            if local != destination:
+                os.remove(local)
+        return rows
+
+
+    @staticmethod
+    def arrow_schema(chunk: pd.DataFrame, dictionaries: bool = True):
+        """Returns the Arrow schema of a dataset, from its first chunk
+
+        Columns of DTYPES get their narrow type whatever the chunk, so that
+        later chunks with missing values convert to the same schema.
+        Categorical columns are dictionary encoded, unless dictionaries is
+        false: Arrow IPC files take a single dictionary per column, while
+        the categories of every chunk may differ.
+        """
+        pa = _pyarrow()
+        fields = []
+        for field in pa.Schema.from_pandas(chunk, preserve_index=False):
+            dtype = DTYPES.get(field.name)
+            if dtype == "category":
+                field = field.with_type(pa.dictionary(pa.int32(), pa.string())
+                                        if dictionaries else pa.string())
+            elif dtype:
+                field = field.with_type(pa.from_numpy_dtype(np.dtype(dtype)))
+            elif field.name == "Dt_Customer":
+                field = field.with_type(pa.timestamp("ms"))
+            fields.append(field)
+        return pa.schema(fields)
+
+
     @staticmethod
     def read_train_test_from_default_gcs_bucket(test_size: float = 0.10,
-                                                random_state: int = 42
+                                                random_state: int = 42,
+                                                storage=None
                                                ) -> Tuple[pd.DataFrame, pd.DataFrame]:
-        bashCommand = "gcloud config get-value project"
-        process = subprocess.Popen(bashCommand.split(), stdout=subprocess.PIPE)
-        output, error = process.communicate()
-        if error:
-            logging.error(f"error={error}")
-            raise Exception("Could not find the default GCP project id. Is Google Cloud SDK installed?")
-        project_id = output.decode('utf8').strip()
-        logging.debug(f"project_id={project_id}")
+        # Looked up once per process
+        project_id = default_project_id()
         gcs_path_to_dataset = f"gs://{project_id}-bucket/custom-training/custsegm/data/marketing_campaign.csv"
         logging.debug(f"gcs_path_to_dataset={gcs_path_to_dataset}.")
-        return Dataset.read_train_test(gcs_path_to_dataset, test_size, random_state)
+        return Dataset.read_train_test(gcs_path_to_dataset, test_size, random_state, storage)
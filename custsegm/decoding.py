@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+"""Columnar decoding of Vertex AI prediction requests
+"""
+
+import json
+from itertools import chain
+from operator import itemgetter
+from typing import Any, Collection, Dict, List, NamedTuple, Sequence, Union
+
+import numpy as np
+
+
+class DecodedRequest(NamedTuple):
+    columns: Dict[str, np.ndarray]
+    parameters: Any
+
+    def __len__(self) -> int:
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+
+class _Row:
+    """Placeholder left in the instances list for an instance already decoded"""
+
+
+_ROW = _Row()
+
+
+class RequestDecoder:
+    """Decodes prediction requests straight into typed column arrays
+
+    Three request layouts are accepted:
+
+    * Vertex AI instances: {"instances": [{"Income": 52597, ...}, ...]}
+    * Compact instances: {"instances": [[...], ...], "columns": ["Income", ...]},
+      where "columns" defaults to compact_columns, or else the schema order
+    * Columnar: {"columns": {"Income": [52597, ...], ...}}
+
+    A bare list of instances is accepted too. Requests must hold all the
+    columns of one of the required column sets, if any. The returned columns
+    follow the schema order, hold only the schema columns found in the request, and are
+    float64 arrays except for the categorical ones, which are object arrays.
+    When decoding JSON, the parser hands over the key/value pairs of instance
+    objects without building a dict per instance, and instances sharing the
+    same keys are transposed into columns with list slicing.
+    """
+
+    def __init__(self,
+                 columns: Sequence[str],
+                 categorical: Collection[str] = (),
+                 compact_columns: Sequence[str] = None,
+                 required: Sequence[Sequence[str]] = ()):
+        self.schema = list(columns)
+        self._position = {column: i for i, column in enumerate(self.schema)}
+        self.categorical = set(categorical)
+        self.compact_columns = list(compact_columns or columns)
+        self.required = [list(columns) for columns in required]
+
+
+    def decode(self, body: Union[bytes, str, Dict, List], typed: bool = True) -> DecodedRequest:
+        """Decodes a request into columns
+
+        With typed=False, columns are left as lists of values, for requests
+        to be concatenated cheaply before calling typed() once on them all.
+        """
+        if isinstance(body, (bytes, bytearray, str)):
+            return self.decode_json(body, typed)
+        return self.decode_object(body, typed)
+
+
+    def decode_json(self, body: Union[bytes, str], typed: bool = True) -> DecodedRequest:
+        schema = set(self.schema)
+        rows = []
+
+        def keep_row(pairs):
+            # An instance has schema keys, most often first, but it may start
+            # with others such as ID; columnar objects have lists of values
+            if any(key in schema and not isinstance(value, list) for key, value in pairs):
+                rows.append(pairs)
+                return _ROW
+            return dict(pairs)
+
+        try:
+            payload = json.loads(body, object_pairs_hook=keep_row)
+        except ValueError as e:
+            raise ValueError(f"Invalid JSON request: {e}")
+
+        if not rows:
+            return self.decode_object(payload, typed)
+
+        instances = payload.get("instances") if isinstance(payload, dict) else payload
+        if not isinstance(instances, list) or len(instances) != len(rows):
+            raise ValueError("Instances must all be objects or all be arrays")
+
+        names = [key for key, _ in rows[0]]
+        flat = list(chain.from_iterable(rows))
+        values = list(map(itemgetter(1), flat))
+        if len(flat) == len(rows) * len(names):
+            keys = list(map(itemgetter(0), flat))
+            width = len(names)
+            if keys == names * len(rows):
+                # All instances have the same keys in the same order
+                present = {name: values[i::width] for i, name in enumerate(names)
+                           if name in schema}
+                return DecodedRequest(self._columns(present, typed), self._parameters(payload))
+
+        # Instances with keys in varying order
+        present = {name: [] for name in self.schema}
+        for pairs in rows:
+            for key, value in pairs:
+                column = present.get(key)
+                if column is not None:
+                    column.append(value)
+        present = {c: v for c, v in present.items() if v}
+        for column, v in present.items():
+            if len(v) != len(rows):
+                raise ValueError(f"Column {column} is missing from some instances")
+        return DecodedRequest(self._columns(present, typed), self._parameters(payload))
+
+
+    def decode_object(self, payload: Union[Dict, List], typed: bool = True) -> DecodedRequest:
+        parameters = self._parameters(payload)
+        if isinstance(payload, dict):
+            columns = payload.get("columns")
+            instances = payload.get("instances")
+            if columns is None and instances is None:
+                columns = payload  # bare columns, as accepted by pd.DataFrame
+        else:
+            columns, instances = None, payload
+
+        if isinstance(columns, dict):
+            # Columnar layout
+            present = {c: columns[c] for c in self.schema if c in columns}
+            lengths = {len(v) for v in present.values()}
+            if len(lengths) > 1:
+                raise ValueError("Columns must all have the same length")
+            return DecodedRequest(self._columns(present, typed), parameters)
+
+        if not isinstance(instances, list):
+            raise ValueError("Request has neither instances nor columns")
+        if not instances:
+            return DecodedRequest({}, parameters)
+
+        if isinstance(instances[0], dict):
+            present = {c: [instance.get(c) for instance in instances]
+                       for c in self.schema if c in instances[0]}
+            return DecodedRequest(self._columns(present, typed), parameters)
+
+        # Compact layout: one array of values per instance
+        names = list(columns or self.compact_columns)
+        values = list(chain.from_iterable(instances))
+        if len(values) != len(instances) * len(names) or \
+                any(len(instance) != len(names) for instance in instances):
+            raise ValueError(f"Instances must be arrays of {len(names)} values")
+        width = len(names)
+        present = {c: values[names.index(c)::width] for c in self.schema if c in names}
+        return DecodedRequest(self._columns(present, typed), parameters)
+
+
+    def _columns(self, values: Dict[str, Sequence], typed: bool) -> Dict[str, Sequence]:
+        if self.required:
+            # Reported against the required set the request comes closest to
+            missing = min(([c for c in columns if c not in values] for columns in self.required),
+                          key=len)
+            if missing:
+                raise ValueError(f"Column {missing[0]} is missing")
+        if typed:
+            return self.typed(values)
+        return {column: list(values[column]) for column in sorted(values, key=self._position.get)}
+
+
+    def typed(self, values: Dict[str, Sequence]) -> Dict[str, np.ndarray]:
+        """Returns columns of values as float64 or, if categorical, object arrays
+
+        Raises ValueError when a numeric column holds other values.
+        """
+        typed = {}
+        for column in sorted(values, key=self._position.get):
+            v = values[column]
+            if column in self.categorical:
+                typed[column] = np.array(v, dtype=object)
+            else:
+                try:
+                    typed[column] = np.array(v, dtype=np.float64)
+                except (TypeError, ValueError):
+                    raise ValueError(f"Column {column} must be numeric")
+        return typed
+
+
+    @staticmethod
+    def _parameters(payload: Any) -> Any:
+        return payload.get("parameters") if isinstance(payload, dict) else None
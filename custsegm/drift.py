@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+
+"""Drift of the rows scored away from the training data, from streaming summaries
+"""
+
+import threading
+from typing import TYPE_CHECKING, Dict
+
+import numpy as np
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+# Equal-width bins of the numeric feature sketches, between the training
+# quantiles RANGE, plus a bin below and a bin above them
+N_BINS = 128
+RANGE = (0.001, 0.999)
+
+# The bins are grouped by training deciles into the distribution compared
+N_GROUPS = 10
+
+# Quantiles reported for the numeric features
+QUANTILES = (0.05, 0.5, 0.95)
+
+# Population stability index over which a distribution has drifted
+PSI_THRESHOLD = 0.2
+
+# Floor of the fractions compared, so that empty groups have a finite PSI
+EPSILON = 1e-4
+
+# Rows buffered before being summarized, so that small requests cost a copy.
+# 1-row updates take 4.2 us at 256 rows against 3.8 us at 1024, for a
+# quarter of the memory (46 KiB with 23 features) per model loaded
+BUFFER_ROWS = 256
+
+
+def psi(expected: np.ndarray, actual: np.ndarray) -> float:
+    """Returns the population stability index of actual fractions against expected ones
+    """
+    expected = np.maximum(expected, EPSILON)
+    actual = np.maximum(actual, EPSILON)
+    return float(((actual - expected) * np.log(actual / expected)).sum())
+
+
+def training_stats(pipeline, data: "pd.DataFrame") -> Dict:
+    """Summarizes the training data of a fitted pipeline, for DriftMonitor
+
+    data is raw customer data, preprocessed as when predicting. The
+    summaries are of the scaled features, and serialize to JSON.
+    """
+    from custsegm.compiled import CompiledPipeline
+
+    compiled = CompiledPipeline.from_pipeline(pipeline)
+    engine = getattr(pipeline, "feature_engine_", None)
+    data = data.dropna()
+    if engine is not None:
+        data = engine.transform(data)
+    X = pipeline[:-1].transform(data)
+    labels = pipeline[-1].predict(X)
+
+    features = {}
+    for i, name in enumerate(compiled.layout):
+        column = X[:, i]
+        if name in compiled.categories:
+            vocabulary = compiled.categories[name]
+            codes = np.clip(np.rint(column * compiled.scale[i] + compiled.mean[i]),
+                            0, len(vocabulary) - 1).astype(np.intp)
+            features[name] = {
+                "categories": vocabulary.tolist(),
+                "fractions": (np.bincount(codes, minlength=len(vocabulary)) / len(X)).tolist(),
+                "mean": float(compiled.mean[i]),
+                "scale": float(compiled.scale[i]),
+            }
+        else:
+            low, high = np.quantile(column, RANGE)
+            if high <= low:
+                high = low + 1
+            sketch = _Sketch(np.array([low]), np.array([high]))
+            features[name] = {
+                "mean": float(column.mean()),
+                "std": float(column.std()),
+                "low": float(low),
+                "high": float(high),
+                "fractions": (sketch.counts(column[:, None])[0] / len(X)).tolist(),
+                "quantiles": {str(q): float(np.quantile(column, q)) for q in QUANTILES},
+            }
+
+    return {
+        "n_rows": len(X),
+        "features": features,
+        "clusters": (np.bincount(labels, minlength=compiled.n_clusters) / len(X)).tolist(),
+    }
+
+
+class _Sketch:
+    """Histograms of several columns, each over N_BINS equal-width bins between
+    its low and high bounds, plus the bins below and above them
+    """
+
+    def __init__(self, low: np.ndarray, high: np.ndarray):
+        self.low = low
+        self.inverse_width = N_BINS / (high - low)
+        self.offsets = np.arange(len(low)) * (N_BINS + 2) + 1
+
+
+    def counts(self, values: np.ndarray) -> np.ndarray:
+        """Returns the number of values of every column in every bin
+        """
+        cells = values - self.low
+        cells *= self.inverse_width
+        np.floor(cells, out=cells)
+        np.clip(cells, -1, N_BINS, out=cells)
+        cells = cells.astype(np.intp)
+        cells += self.offsets
+        return np.bincount(cells.ravel(), minlength=len(self.low) * (N_BINS + 2)) \
+                 .reshape(len(self.low), N_BINS + 2)
+
+
+class DriftMonitor:
+    """Constant-memory summaries of the scaled rows a model scores
+
+    Per numeric feature, a running mean and variance and a histogram of
+    fine equal-width bins over the training range (a quantile sketch); per
+    categorical feature, the frequency of every category; and the frequency
+    of every cluster. Rows are buffered and summarized BUFFER_ROWS at a
+    time, in a few vectorized numpy calls whatever the number of features,
+    and report() compares the summaries with the training ones.
+    """
+
+    def __init__(self, stats: Dict):
+        features = list(stats["features"].items())
+        self.numeric = [name for name, s in features if "low" in s]
+        self.categorical = [name for name, s in features if "categories" in s]
+        positions = {name: i for i, (name, _) in enumerate(features)}
+        self._numeric_index = np.array([positions[name] for name in self.numeric], dtype=np.intp)
+        self._categorical_index = np.array([positions[name] for name in self.categorical], dtype=np.intp)
+        self.n_features = len(features)
+        self.training_rows = stats["n_rows"]
+
+        # Only what report() needs of the training stats is kept, as models
+        # may be many: the training bins are reduced to their groups
+        numeric = [stats["features"][name] for name in self.numeric]
+        self._sketch = _Sketch(np.array([s["low"] for s in numeric]),
+                               np.array([s["high"] for s in numeric]))
+        self._training = {}
+        self._groups = []
+        for name, s in zip(self.numeric, numeric):
+            # Bins grouped by training deciles: a group ends at the first
+            # bin where the training fractions add up to the next decile
+            cumulative = np.cumsum(s["fractions"])
+            ends = np.searchsorted(cumulative, np.arange(1, N_GROUPS) / N_GROUPS - 1e-9) + 1
+            groups = np.unique(np.concatenate([[0], ends[ends < N_BINS + 2]]))
+            self._groups.append(groups)
+            self._training[name] = {"mean": s["mean"], "std": s["std"], "quantiles": s["quantiles"],
+                                    "fractions": np.add.reduceat(s["fractions"], groups)}
+
+        categorical = [stats["features"][name] for name in self.categorical]
+        for name, s in zip(self.categorical, categorical):
+            self._training[name] = {"categories": s["categories"], "fractions": s["fractions"]}
+        self._unscale_mean = np.array([s["mean"] for s in categorical])
+        self._unscale = np.array([s["scale"] for s in categorical])
+        self._sizes = np.array([len(s["categories"]) for s in categorical], dtype=np.intp)
+        self._offsets = np.concatenate([[0], np.cumsum(self._sizes)[:-1]]).astype(np.intp)
+        self._training_clusters = stats["clusters"]
+
+        self.count = 0
+        self.mean = np.zeros(len(numeric))
+        self.m2 = np.zeros(len(numeric))
+        self.categories = np.zeros(int(self._sizes.sum()), dtype=np.int64)
+        self.clusters = np.zeros(len(self._training_clusters), dtype=np.int64)
+        # Rows of the cluster frequencies only, as served from a prediction cache
+        self.cached = 0
+        # Allocated on the first rows, as most models may never get any
+        self.bins = None
+        self._buffer = None
+        self._buffered_labels = None
+        self._buffered = 0
+        self._lock = threading.Lock()
+
+
+    def update(self, X: np.ndarray, labels: np.ndarray) -> None:
+        """Adds scaled rows and their clusters to the summaries
+        """
+        n = len(X)
+        with self._lock:
+            if n >= BUFFER_ROWS:
+                self._summarize(X, labels)
+                return
+            if self._buffer is None:
+                self._buffer = np.empty((BUFFER_ROWS, self.n_features))
+                self._buffered_labels = np.empty(BUFFER_ROWS, dtype=np.intp)
+            if self._buffered + n > BUFFER_ROWS:
+                self._flush()
+            self._buffer[self._buffered:self._buffered + n] = X
+            self._buffered_labels[self._buffered:self._buffered + n] = labels
+            self._buffered += n
+
+
+    def update_clusters(self, labels: np.ndarray) -> None:
+        """Adds the clusters of rows whose features are not at hand
+        """
+        with self._lock:
+            self.clusters += np.bincount(labels, minlength=len(self.clusters))
+            self.cached += len(labels)
+
+
+    def _flush(self) -> None:
+        if self._buffered:
+            self._summarize(self._buffer[:self._buffered], self._buffered_labels[:self._buffered])
+            self._buffered = 0
+
+
+    def _summarize(self, X: np.ndarray, labels: np.ndarray) -> None:
+        n = len(X)
+        numeric = X[:, self._numeric_index]
+        batch_mean = numeric.mean(axis=0)
+        batch_m2 = ((numeric - batch_mean) ** 2).sum(axis=0)
+        # Chan et al.'s merge of the batch moments into the running ones
+        total = self.count + n
+        delta = batch_mean - self.mean
+        self.mean += delta * (n / total)
+        self.m2 += batch_m2 + delta ** 2 * (self.count * n / total)
+        self.count = total
+        counts = self._sketch.counts(numeric)
+        if self.bins is None:
+            self.bins = counts
+        else:
+            self.bins += counts
+
+        codes = np.clip(np.rint(X[:, self._categorical_index] * self._unscale + self._unscale_mean),
+                        0, self._sizes - 1).astype(np.intp)
+        codes += self._offsets
+        self.categories += np.bincount(codes.ravel(), minlength=len(self.categories))
+        self.clusters += np.bincount(labels, minlength=len(self.clusters))
+
+
+    def report(self) -> Dict:
+        """Returns the live summaries and drift scores against the training data
+
+        Distributions are scored by their population stability index (PSI),
+        numeric features over their training deciles: over PSI_THRESHOLD,
+        they have drifted. mean_shift is the difference of the means, in
+        training standard deviations. Cached rows count in the cluster
+        frequencies only.
+        """
+        with self._lock:
+            self._flush()
+            count, cached = self.count, self.cached
+            mean, m2 = self.mean.copy(), self.m2.copy()
+            bins = None if self.bins is None else self.bins.copy()
+            categories, clusters = self.categories.copy(), self.clusters.copy()
+
+        report = {"rows": count, "cached_rows": cached, "training_rows": self.training_rows,
+                  "psi_threshold": PSI_THRESHOLD, "max_psi": None, "drifted": [],
+                  "features": {}, "clusters": None}
+        if not count and not cached:
+            return report
+
+        scores = {}
+        if count:
+            for j, name in enumerate(self.numeric):
+                training = self._training[name]
+                fractions = bins[j] / count
+                scores[name] = psi(training["fractions"], np.add.reduceat(fractions, self._groups[j]))
+                report["features"][name] = {
+                    "mean": float(mean[j]),
+                    "std": float(np.sqrt(m2[j] / count)),
+                    "mean_shift": float((mean[j] - training["mean"]) / training["std"])
+                                  if training["std"] else None,
+                    "quantiles": {str(q): self.quantile(j, fractions, q) for q in QUANTILES},
+                    "training_quantiles": training["quantiles"],
+                    "psi": scores[name],
+                }
+            for j, name in enumerate(self.categorical):
+                training = self._training[name]
+                start = self._offsets[j]
+                fractions = categories[start:start + self._sizes[j]] / count
+                scores[name] = psi(np.array(training["fractions"]), fractions)
+                report["features"][name] = {
+                    "fractions": dict(zip(training["categories"], fractions.tolist())),
+                    "training_fractions": dict(zip(training["categories"], training["fractions"])),
+                    "psi": scores[name],
+                }
+
+        fractions = clusters / (count + cached)
+        scores["clusters"] = psi(np.array(self._training_clusters), fractions)
+        report["clusters"] = {
+            "fractions": fractions.tolist(),
+            "training_fractions": self._training_clusters,
+            "psi": scores["clusters"],
+        }
+        report["max_psi"] = max(scores.values())
+        report["drifted"] = [name for name, score in scores.items() if score > PSI_THRESHOLD]
+        return report
+
+
+    def quantile(self, j: int, fractions: np.ndarray, q: float) -> float:
+        """Estimates a quantile of numeric feature j from its sketch
+
+        Values are taken as evenly spread within bins; values beyond the
+        training range are reported at its bounds.
+        """
+        low = self._sketch.low[j]
+        width = 1 / self._sketch.inverse_width[j]
+        cumulative = np.cumsum(fractions)
+        b = int(np.searchsorted(cumulative, q))
+        if b == 0:
+            return float(low)
+        if b > N_BINS:
+            return float(low + N_BINS * width)
+        within = (q - cumulative[b - 1]) / fractions[b] if fractions[b] else 0.0
+        return float(low + (b - 1 + within) * width)
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+
+"""Feature engineering for Customer Personality Analysis
+"""
+
+import logging
+import warnings
+from typing import Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+from custsegm.columns import (CATEGORICAL_COLUMNS, FEATURE_COLUMNS, MONETARY_COLUMNS,
+                              NUMERIC_COLUMNS, PASSTHROUGH_COLUMNS, RAW_COLUMNS, TEXT_COLUMNS)
+
+# Deriving living situation by marital status
+LIVING_WITH = {
+    "Married": "Partner",
+    "Together": "Partner",
+    "Absurd": "Alone",
+    "Widow": "Alone",
+    "YOLO": "Alone",
+    "Divorced": "Alone",
+    "Single": "Alone",
+}
+
+# Members of the household by living situation
+HOUSEHOLD_SIZE = {"Alone": 1, "Partner": 2}
+
+# Segment education levels in three groups
+EDUCATION_LEVELS = {
+    "Basic": "Undergraduate",
+    "2n Cycle": "Undergraduate",
+    "Graduation": "Graduate",
+    "Master": "Postgraduate",
+    "PhD": "Postgraduate",
+}
+
+# Layout of "Dt_Customer" values, e.g. "07-05-2014"
+DATE_LENGTH = 10
+DATE_SEPARATORS = (2, 5)
+
+_ZERO = ord("0")
+
+
+def parse_dates(values: np.ndarray) -> np.ndarray:
+    """Parses "Dt_Customer" values into datetime64[D]
+
+    Values laid out as "NN-NN-YYYY" are decoded byte-wise without any format
+    inference. The first field is read as the month unless it is greater
+    than 12, in which case it is read as the day, just like the format
+    inference of pd.to_datetime did, so that the features of existing models
+    stay the same. Values with any other layout fall back to pd.to_datetime.
+    """
+    values = np.asarray(values)
+    if np.issubdtype(values.dtype, np.datetime64):
+        return values.astype("datetime64[D]")
+
+    dates = np.full(values.shape, np.datetime64("NaT"), dtype="datetime64[D]")
+    try:
+        raw = values.astype(f"S{DATE_LENGTH + 1}")
+    except (UnicodeEncodeError, ValueError):
+        raw = np.zeros(values.shape, dtype=f"S{DATE_LENGTH + 1}")
+    chars = raw.view(np.uint8).reshape(len(raw), DATE_LENGTH + 1)
+    digits = chars[:, :DATE_LENGTH].astype(np.int64) - _ZERO
+
+    well_formed = chars[:, DATE_LENGTH] == 0
+    for i in range(DATE_LENGTH):
+        if i in DATE_SEPARATORS:
+            well_formed &= chars[:, i] == ord("-")
+        else:
+            well_formed &= (digits[:, i] >= 0) & (digits[:, i] <= 9)
+
+    first = digits[:, 0] * 10 + digits[:, 1]
+    second = digits[:, 3] * 10 + digits[:, 4]
+    year = (digits[:, 6] * 1000 + digits[:, 7] * 100 +
+            digits[:, 8] * 10 + digits[:, 9])
+    month_first = first <= 12
+    month = np.where(month_first, first, second)
+    day = np.where(month_first, second, first)
+    well_formed &= (month >= 1) & (month <= 12) & (day >= 1) & (day <= 31)
+
+    months = ((year - 1970) * 12 + month - 1)[well_formed]
+    dates[well_formed] = (months.astype("datetime64[M]").astype("datetime64[D]") +
+                          (day[well_formed] - 1).astype("timedelta64[D]"))
+
+    fallback = ~well_formed & pd.notna(values)
+    if fallback.any():
+        logging.debug(f"Inferring the format of {fallback.sum()} dates")
+        dates[fallback] = pd.to_datetime(values[fallback]).values.astype("datetime64[D]")
+
+    return dates
+
+
+def lookup(values: np.ndarray, table: Dict) -> np.ndarray:
+    """Maps values through a lookup table, leaving unmapped values unchanged
+
+    The table is applied once per distinct value, not once per row.
+    """
+    codes, uniques = pd.factorize(values)
+    mapped = np.empty(len(uniques) + 1, dtype=object)
+    mapped[:-1] = [table.get(u, u) for u in uniques]
+    mapped[-1] = np.nan  # code -1 stands for missing values
+    return mapped[codes]
+
+
+def _latest(dates: np.ndarray) -> np.datetime64:
+    """Returns the latest of some dates, ignoring NaT"""
+    known = dates[~np.isnat(dates)]
+    return known.max() if len(known) else np.datetime64("NaT")
+
+
+class FeatureEngine:
+    """Derives the model features from raw customer data in a single pass
+
+    Every feature is written into one preallocated numeric array; the
+    categorical features are resolved through lookup tables built once per
+    distinct value.
+
+    Fitting captures the data-dependent constants (the reference date of
+    "Customer_For" and the year "Age" is computed at), so that the features of
+    a row no longer depend on the other rows of the batch it comes with.
+    """
+
+    def __init__(self, as_of_year: int):
+        self.as_of_year = as_of_year
+        self.reference_date_ = None
+
+
+    def fit(self, data: pd.DataFrame) -> "FeatureEngine":
+        self.fit_transform(data)
+        return self
+
+
+    def partial_fit(self, data: pd.DataFrame) -> "FeatureEngine":
+        """Updates the fitted state with one more chunk of training data
+        """
+        keep = data.notna().all(axis=1).to_numpy()
+        dates = parse_dates(data["Dt_Customer"].to_numpy()[keep])
+        latest = _latest(dates)
+        if not self.fitted or np.isnat(self.reference_date_) or latest > self.reference_date_:
+            self.reference_date_ = latest
+        return self
+
+
+    def fit_transform(self,
+                      data: pd.DataFrame,
+                      age_cap: Optional[int] = None,
+                      income_cap: Optional[int] = None) -> pd.DataFrame:
+        return self._transform(data, True, age_cap, income_cap, fit=True)
+
+
+    def transform(self,
+                  data: pd.DataFrame,
+                  training: bool = False,
+                  age_cap: Optional[int] = None,
+                  income_cap: Optional[int] = None) -> pd.DataFrame:
+        return self._transform(data, training, age_cap, income_cap)
+
+
+    @property
+    def fitted(self) -> bool:
+        return self.reference_date_ is not None
+
+
+    def _transform(self,
+                   data: pd.DataFrame,
+                   training: bool,
+                   age_cap: Optional[int],
+                   income_cap: Optional[int],
+                   fit: bool = False) -> pd.DataFrame:
+        if training:
+            # Remove missing values
+            keep = data.notna().all(axis=1).to_numpy()
+        else:
+            keep = np.ones(len(data), dtype=bool)
+
+        dates = parse_dates(data["Dt_Customer"].to_numpy())
+        if fit or not self.fitted:
+            reference_date = _latest(dates[keep])
+            if fit:
+                self.reference_date_ = reference_date
+            else:
+                warnings.warn("Unfitted feature engine: Customer_For is relative "
+                              "to the latest Dt_Customer of each batch.")
+        else:
+            reference_date = self.reference_date_
+
+        age = self.as_of_year - data["Year_Birth"].to_numpy(dtype=np.float64)
+        income = data["Income"].to_numpy(dtype=np.float64)
+        if training:
+            # Drop the outliers by setting a cap on age and income
+            if age_cap is not None:
+                keep &= age < age_cap
+            if income_cap is not None:
+                keep &= income < income_cap
+
+        rows = None if keep.all() else np.flatnonzero(keep)
+
+        def column(values: np.ndarray) -> np.ndarray:
+            return values if rows is None else values[rows]
+
+        index = data.index if rows is None else data.index[rows]
+        features = np.empty((len(index), len(NUMERIC_COLUMNS)),
+                            dtype=np.float64, order="F")
+        out = {name: features[:, i] for i, name in enumerate(NUMERIC_COLUMNS)}
+
+        for name in PASSTHROUGH_COLUMNS:
+            out[name][:] = column(data[name].to_numpy(dtype=np.float64))
+
+        # Number of days a customer is registered in the firm's database
+        out["Customer_For"][:] = (reference_date - column(dates)).astype(np.float64)
+        out["Customer_For"][np.isnat(column(dates))] = np.nan
+
+        out["Age"][:] = column(age)
+
+        out["Spent"][:] = 0
+        for name in MONETARY_COLUMNS:
+            out["Spent"] += out[name]
+
+        # Living situation and household size by marital status
+        codes, statuses = pd.factorize(column(data["Marital_Status"].to_numpy()))
+        living = np.empty(len(statuses) + 1, dtype=object)
+        living[:-1] = [LIVING_WITH.get(s, s) for s in statuses]
+        living[-1] = np.nan
+        adults = np.array([HOUSEHOLD_SIZE.get(s, np.nan) for s in living[:-1]] +
+                          [np.nan], dtype=np.float64)
+
+        np.add(out["Kidhome"], out["Teenhome"], out=out["Children"])
+        np.add(adults[codes], out["Children"], out=out["Family_Size"])
+        np.greater(out["Children"], 0, out=out["Is_Parent"])
+
+        frame = pd.DataFrame(features, index=index, columns=NUMERIC_COLUMNS)
+        frame.insert(FEATURE_COLUMNS.index("Education"), "Education",
+                     lookup(column(data["Education"].to_numpy()), EDUCATION_LEVELS))
+        frame.insert(FEATURE_COLUMNS.index("Living_With"), "Living_With",
+                     living[codes])
+        return frame
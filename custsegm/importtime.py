@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+"""Import-time report of a Python statement, from python -X importtime
+"""
+
+import logging
+import subprocess
+import sys
+from typing import Dict, Iterable, List, NamedTuple, Sequence
+
+# Statement timed by default: the startup of the prediction service
+SERVING_STARTUP = "from app.app import app"
+
+# Packages the prediction service must not import when the model is local
+SERVING_FORBIDDEN = ["google.cloud", "custsegm.custsegm", "custsegm.trainer"]
+
+
+class ImportRecord(NamedTuple):
+    module: str
+    self_us: int
+    cumulative_us: int
+    depth: int
+
+
+def parse(lines: Iterable[str]) -> List[ImportRecord]:
+    """Parses the "import time:" lines python -X importtime writes to stderr
+    """
+    records = []
+    for line in lines:
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue  # header line
+        name = fields[2].rstrip()
+        module = name.lstrip()
+        depth = (len(name) - len(module) - 1) // 2
+        records.append(ImportRecord(module, int(fields[0]), int(fields[1]), depth))
+    return records
+
+
+def measure(statement: str = SERVING_STARTUP, python: str = sys.executable) -> List[ImportRecord]:
+    """Runs statement in a fresh interpreter and returns its imports
+
+    Raises RuntimeError when the statement fails.
+    """
+    process = subprocess.run([python, "-X", "importtime", "-c", statement],
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE,
+                             universal_newlines=True)
+    lines = process.stderr.splitlines()
+    if process.returncode:
+        errors = [line for line in lines if not line.startswith("import time:")]
+        raise RuntimeError(f"{statement!r} failed: {' '.join(errors[-3:])}")
+    return parse(lines)
+
+
+def summarize(records: Sequence[ImportRecord],
+              top: int = 15,
+              forbidden: Sequence[str] = ()) -> Dict:
+    """Returns the total import time and where it goes
+
+    Time is attributed to top-level packages by summing the self time of
+    their modules. forbidden lists modules or packages that should not have
+    been imported.
+    """
+    by_package = {}
+    for record in records:
+        package = record.module.split(".")[0]
+        by_package[package] = by_package.get(package, 0) + record.self_us
+    packages = sorted(by_package.items(), key=lambda item: item[1], reverse=True)
+    slowest = sorted(records, key=lambda record: record.self_us, reverse=True)
+
+    imported = [record.module for record in records
+                if any(record.module == f or record.module.startswith(f + ".")
+                       for f in forbidden)]
+    return {
+        "total_ms": sum(record.self_us for record in records) / 1000,
+        "modules": len(records),
+        "packages": [{"package": p, "ms": us / 1000} for p, us in packages[:top]],
+        "slowest_modules": [{"module": r.module, "self_ms": r.self_us / 1000}
+                            for r in slowest[:top]],
+        "forbidden_imported": imported,
+    }
+
+
+def report(statement: str = SERVING_STARTUP,
+           top: int = 15,
+           forbidden: Sequence[str] = SERVING_FORBIDDEN,
+           repeat: int = 3) -> Dict:
+    """Times statement repeat times and summarizes its fastest run
+    """
+    runs = [summarize(measure(statement), top, forbidden) for _ in range(repeat)]
+    summary = min(runs, key=lambda run: run["total_ms"])
+    summary["statement"] = statement
+    summary["runs_ms"] = [run["total_ms"] for run in runs]
+    logging.debug(f"Import time of {statement!r}: {summary['runs_ms']} ms")
+    return summary
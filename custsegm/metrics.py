@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+"""Serving metrics: counters and latency histograms, in Prometheus text format
+"""
+
+import bisect
+import threading
+import time
+from typing import Callable, Dict, Sequence, Tuple
+
+# Upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Upper bounds of the batch size buckets, in rows
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000, 10000, 100000)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Labels, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in labels]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+
+    def observe(self, value: float) -> None:
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+
+    def time(self) -> "_Timer":
+        """Returns a context manager observing the seconds spent in it
+        """
+        return _Timer(self)
+
+
+class _Timer:
+    __slots__ = ("histogram", "started")
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+class MetricsRegistry:
+    """Metrics of one process, by name and labels
+
+    Metrics computed elsewhere (queue depths, cache counters...) are
+    registered as callbacks, read when the metrics are rendered.
+    """
+
+    def __init__(self):
+        self._families = {}  # name -> (type, help, {labels: metric})
+        self._callbacks = {}  # name -> (type, help, callback)
+        self._lock = threading.Lock()
+
+
+    def counter(self, name: str, help: str, **labels: str) -> Counter:
+        return self._metric(name, "counter", help, labels, Counter)
+
+
+    def histogram(self,
+                  name: str,
+                  help: str,
+                  buckets: Sequence[float] = LATENCY_BUCKETS,
+                  **labels: str) -> Histogram:
+        return self._metric(name, "histogram", help, labels, lambda: Histogram(buckets))
+
+
+    def callback(self, name: str, type: str, help: str, callback: Callable[[], float]) -> None:
+        """Registers, or replaces, a metric read from callback when rendering
+        """
+        with self._lock:
+            self._callbacks[name] = (type, help, callback)
+
+
+    def _metric(self, name, type, help, labels, factory):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            _, _, metrics = self._families.setdefault(name, (type, help, {}))
+            metric = metrics.get(key)
+            if metric is None:
+                metric = metrics[key] = factory()
+        return metric
+
+
+    def render(self) -> str:
+        """Returns all metrics in the Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            families = [(name, type, help, dict(metrics))
+                        for name, (type, help, metrics) in sorted(self._families.items())]
+            callbacks = sorted(self._callbacks.items())
+
+        for name, type, help, metrics in families:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {type}")
+            for labels, metric in sorted(metrics.items()):
+                if type == "histogram":
+                    with metric._lock:
+                        counts, total = list(metric.counts), metric.sum
+                    cumulative = 0
+                    for bound, count in zip(metric.buckets + (float("inf"),), counts):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        bucket = _labels(labels, 'le="' + le + '"')
+                        lines.append(f"{name}_bucket{bucket} {cumulative}")
+                    lines.append(f"{name}_sum{_labels(labels)} {total}")
+                    lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+                else:
+                    lines.append(f"{name}{_labels(labels)} {metric.value}")
+
+        for name, (type, help, callback) in callbacks:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {type}")
+            lines.append(f"{name} {float(callback())}")
+        return "\n".join(lines) + "\n"
+
+
+# Metrics of this process
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = "custsegm_stage_seconds"
+
+REQUESTS = REGISTRY.counter("custsegm_requests_total", "Prediction requests scored.")
+ERRORS = REGISTRY.counter("custsegm_request_errors_total", "Prediction requests failed.")
+ROWS = REGISTRY.counter("custsegm_rows_total", "Rows scored.")
+BATCH_ROWS = REGISTRY.histogram("custsegm_batch_rows", "Rows per prediction request.",
+                                buckets=SIZE_BUCKETS)
+
+_stages = {}
+
+
+def stage(name: str) -> _Timer:
+    """Returns a context manager timing a serving stage
+    """
+    histogram = _stages.get(name)
+    if histogram is None:
+        histogram = _stages[name] = REGISTRY.histogram(
+            STAGE_SECONDS, "Latency of serving stages, in seconds.", stage=name)
+    return histogram.time()
+
+
+def record_request(rows: int) -> None:
+    """Counts a prediction request of rows rows
+    """
+    REQUESTS.inc()
+    ROWS.inc(rows)
+    BATCH_ROWS.observe(rows)
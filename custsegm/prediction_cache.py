@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+"""In-process cache of predictions, keyed by feature rows
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from itertools import repeat
+from typing import Dict, Mapping, Sequence, Tuple
+
+import numpy as np
+
+# Estimated memory taken by an entry: its int key, the ordered dict node
+# and, with a ttl, the expiry dict entry and its float
+ENTRY_BYTES = 200
+
+# Multipliers of the splitmix64 finalizer, mixing the row hashes
+_MIX1 = np.uint64(0xBF58476D1CE4E5B9)
+_MIX2 = np.uint64(0x94D049BB133111EB)
+
+
+def _mix(h: np.ndarray) -> np.ndarray:
+    h = (h ^ (h >> np.uint64(30))) * _MIX1
+    h = (h ^ (h >> np.uint64(27))) * _MIX2
+    return h ^ (h >> np.uint64(31))
+
+
+class PredictionCache:
+    """Least recently used predictions of a model, expiring after ttl seconds
+
+    Keys are 64-bit hashes of the feature rows a model takes as input, after
+    preprocessing, so that a hit skips scaling and cluster assignment, and
+    rows of the same customer hit the same entry whether they were sent raw
+    or preprocessed, and whatever other fields they carried. The cache
+    holds the predictions of one model version at a time: looking up rows
+    for another version empties it first. At most max_entries entries,
+    taking at most max_bytes bytes, are kept.
+    """
+
+    def __init__(self,
+                 max_entries: int = 100000,
+                 ttl: float = None,
+                 max_bytes: int = 64 << 20):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.version = None
+        # Labels, least recently used first, and their expiry times if ttl
+        self.entries = OrderedDict()
+        self.expiries = {}
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expirations": 0,
+            "invalidations": 0,
+        }
+        self._lock = threading.Lock()
+        logging.debug(f"PredictionCache" +
+                      f" max_entries={max_entries}" +
+                      f" ttl={ttl}" +
+                      f" max_bytes={max_bytes}.")
+
+
+    @staticmethod
+    def keys(columns: Mapping[str, Sequence], names: Sequence[str] = None) -> np.ndarray:
+        """Returns the key of every row of some columns, or of the named ones
+
+        Rows are hashed a column at a time over the whole batch: numeric
+        values by their float64 bits, other values by their Python hash,
+        which is stable within the process, as the cache is. Keys of rows
+        with different columns never match.
+        """
+        names = list(columns if names is None else names)
+        keys = None
+        for name in names:
+            values = np.asarray(columns[name])
+            if values.dtype == object:
+                bits = np.fromiter(map(hash, values), dtype=np.int64, count=len(values)).view(np.uint64)
+            else:
+                bits = np.ascontiguousarray(values, dtype=np.float64).view(np.uint64)
+            if keys is None:
+                keys = np.full(len(bits), hash(tuple(names)) & 0xFFFFFFFFFFFFFFFF, dtype=np.uint64)
+            keys = _mix(keys ^ bits)
+        return keys
+
+
+    def lookup(self, version: str, keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the cached labels of keys and the mask of the keys missed
+        """
+        keys = keys.tolist()
+        now = time.monotonic()
+        with self._lock:
+            if version != self.version:
+                self._invalidate(version)
+            entries = self.entries
+            labels = np.fromiter(map(entries.get, keys, repeat(-1)), dtype=np.int64, count=len(keys))
+            missed = labels < 0
+            hits = np.flatnonzero(~missed)
+            if self.expiries and len(hits):
+                expiries = np.fromiter(map(self.expiries.__getitem__, (keys[i] for i in hits)),
+                                       dtype=np.float64, count=len(hits))
+                expired = hits[expiries < now]
+                for i in expired.tolist():
+                    if keys[i] in entries:  # unless listed twice
+                        self._remove(keys[i])
+                        self.counters["expirations"] += 1
+                missed[expired] = True
+                hits = hits[expiries >= now]
+            deque(map(entries.move_to_end, (keys[i] for i in hits)), maxlen=0)
+            self.counters["hits"] += len(hits)
+            self.counters["misses"] += len(keys) - len(hits)
+        labels[missed] = 0
+        return labels.astype(np.int32), missed
+
+
+    def store(self, version: str, keys: np.ndarray, labels: np.ndarray) -> None:
+        """Caches the labels predicted by a model version
+        """
+        keys = keys.tolist()
+        with self._lock:
+            if version != self.version:
+                # The model changed since the lookup
+                return
+            entries = self.entries
+            entries.update(zip(keys, labels.tolist()))
+            deque(map(entries.move_to_end, keys), maxlen=0)
+            if self.ttl:
+                self.expiries.update(zip(keys, repeat(time.monotonic() + self.ttl)))
+            limit = min(self.max_entries, self.max_bytes // ENTRY_BYTES)
+            for _ in range(len(entries) - limit):
+                self._remove(next(iter(entries)))
+                self.counters["evictions"] += 1
+
+
+    def metrics(self) -> Dict:
+        with self._lock:
+            metrics = dict(self.counters)
+            metrics["entries"] = len(self.entries)
+        metrics["bytes"] = metrics["entries"] * ENTRY_BYTES
+        lookups = metrics["hits"] + metrics["misses"]
+        metrics["hit_ratio"] = metrics["hits"] / lookups if lookups else 0.0
+        return metrics
+
+
+    def _remove(self, key: int) -> None:
+        del self.entries[key]
+        self.expiries.pop(key, None)
+
+
+    def _invalidate(self, version: str) -> None:
+        if self.version is not None:
+            logging.debug(f"Model changed to {version}, dropping {len(self.entries)} cached predictions")
+            self.counters["invalidations"] += 1
+        self.entries.clear()
+        self.expiries.clear()
+        self.version = version
@@ -1,86 +1,564 @@
 # -*- coding: utf-8 -*-
 
-import argparse
-import json
 import logging
 import os
+import threading
+import time
 import joblib
 from datetime import datetime
-from typing import Any, Dict, List, Tuple, Union
+from typing import TYPE_CHECKING, Any, Dict, List, NamedTuple, Optional, Tuple, Union
 #import numpy.typing as npt
 
-import pandas as pd
-from google.cloud.storage import Client as StorageClient, Blob
-from google.cloud.logging import Client as LogClient
+import numpy as np
+from custsegm.artifact import read_artifact
+from custsegm.cache import ArtifactCache
+from custsegm.compiled import CompiledPipeline, compile_pipeline
+from custsegm import metrics
+from custsegm.decoding import DecodedRequest, RequestDecoder
+from custsegm.drift import DriftMonitor
+from custsegm.columns import FEATURE_COLUMNS, RAW_COLUMNS, TEXT_COLUMNS
+from custsegm.prediction_cache import PredictionCache
+from custsegm.storage import ObjectInfo
+
+# Serving imports as little as it can, as import time is most of a cold
+# start: the Google Cloud SDK is imported when a model is downloaded, and
+# pandas when a model with a feature engine is loaded or, for models that
+# are not compiled, when requests are scored (see python -m custsegm importtime)
+if TYPE_CHECKING:
+    import pandas as pd
+    from custsegm.features import FeatureEngine
+
+class LoadedModel(NamedTuple):
+    """A model loaded by a Predictor, never modified once loaded"""
+    version: str
+    artifact_filename: str
+    pipeline: Any
+    compiled: Optional[CompiledPipeline]
+    feature_engine: Optional["FeatureEngine"]
+    decoder: RequestDecoder
+    # Summaries of the rows scored, for models trained with training stats
+    drift: Optional[DriftMonitor]
+    loaded_at: str
+    load_seconds: float
+
 
 class Predictor:
     def __init__(self,
                  model_dir: str,
-                 artifact_filename: str):
+                 artifact_filename: str,
+                 storage=None,
+                 cache_dir: str = None,
+                 prediction_cache: PredictionCache = None):
         self.model_dir = model_dir
+        self.storage = storage
+        self.cache_dir = cache_dir
+        self._artifact_cache = None
         # If you are in a live tutorial session, you might be using a shared
         # test account or project. To avoid name collisions between users on
         # resources created, you create a timestamp for each instance 
         # session, and append it onto the name of local resources you create
         #TIMESTAMP = datetime.now().strftime("%Y%m%d%H%M%S")
         #self.artifact_filename = f"model-{TIMESTAMP}.joblib"
+        # Without a file name, the artifact downloaded decides: model.csgm
+        # if the model directory has one, else model.joblib
+        self.artifact_filename = artifact_filename
+        # As configured, while artifact_filename follows the model loaded
+        self.artifact_path = artifact_filename
         if artifact_filename:
-            self.artifact_filename = artifact_filename
+            self.artifact_names = [f"model{os.path.splitext(artifact_filename)[1]}"]
         else:
-            self.artifact_filename = "model-used-by-predictor.joblib"
+            self.artifact_names = ["model.csgm", "model.joblib"] # file name required by Vertex AI
+        # Swapped as a whole by reload(): a request reads it once and
+        # finishes on the model it read, whatever reloads meanwhile
+        self.model = None
+        # Optional, for models predicting through their compiled form
+        self.prediction_cache = prediction_cache
+        self.reloads = 0
+        self.last_checked = None
+        self._reload_lock = threading.Lock()
+        self._polling = None
+        self._stop_polling = threading.Event()
         logging.debug(f"Predictor" +
                       f" model_dir={self.model_dir}" +
                       f" artifact_filename={self.artifact_filename}.")
 
 
+    @property
+    def pipeline(self):
+        return self.model.pipeline if self.model else None
+
+
+    @property
+    def compiled(self) -> Optional[CompiledPipeline]:
+        return self.model.compiled if self.model else None
+
+
+    @property
+    def feature_engine(self) -> Optional["FeatureEngine"]:
+        return self.model.feature_engine if self.model else None
+
+
+    @property
+    def decoder(self) -> Optional[RequestDecoder]:
+        return self.model.decoder if self.model else None
+
+
     def ready(self):
         logging.debug("Readying predictor...")
-        
+        self.model = self.load(*self.locate())
+        logging.debug("Predictor is ready.")
+
+
+    def locate(self) -> Tuple[str, Any]:
+        """Returns the version of the latest model artifact and where it is
+
+        The version is the GCS object name and generation, or the local file
+        name, modification time and size. Without an artifact file name,
+        model.csgm comes first, then model.joblib, in the model directory.
+        """
+        self.last_checked = datetime.now().isoformat(timespec="seconds")
+        if self.model_dir.startswith("gs://"):
+            cache = self.artifact_cache()
+            for name in self.artifact_names:
+                storage_path = os.path.join(self.model_dir, name)
+                info = cache.storage.stat(storage_path)
+                if info is not None:
+                    return f"{name}#{info.generation}", info
+            raise FileNotFoundError(f"No model artifact found in {self.model_dir}")
+
+        if self.artifact_path:
+            paths = [self.artifact_path]
+        else:
+            paths = [os.path.join(self.model_dir, name) for name in self.artifact_names]
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            return f"{os.path.basename(path)}@{st.st_mtime_ns}:{st.st_size}", path
+        raise FileNotFoundError(f"No model artifact found in {self.model_dir}")
+
+
+    def load(self, version: str, location: Any) -> LoadedModel:
+        """Loads and warms up a model artifact, without making it active
+        """
+        started = time.perf_counter()
+
         # Import the model
         if self.model_dir.startswith("gs://"):
-            self.download_model_from_gcs()
-            
+            self.artifact_filename = self.download_model_from_gcs(location)
+        else:
+            self.artifact_filename = location
+        artifact_filename = self.artifact_filename
+
         # Load model artifact from local filesystem
-        logging.debug(f"Loading model from local file {self.artifact_filename}")
-        self.pipeline = joblib.load(self.artifact_filename)
-        
-        logging.debug("Predictor is ready.")
+        logging.debug(f"Loading model {version} from local file {artifact_filename}")
+        if artifact_filename.endswith(".csgm"):
+            # Memory-mapped, already compiled model: no sklearn, no unpickling
+            artifact = read_artifact(artifact_filename)
+            pipeline = None
+            compiled = artifact.compiled
+            feature_engine = artifact.feature_engine
+            stats = artifact.header["metadata"].get("training_stats")
+        else:
+            pipeline = joblib.load(artifact_filename)
+            # Flatten the pipeline for the numpy-only inference path
+            compiled = compile_pipeline(pipeline)
+            feature_engine = getattr(pipeline, "feature_engine_", None)
+            stats = getattr(pipeline, "training_stats_", None)
+        decoder = Predictor.request_decoder(compiled, feature_engine)
+        if compiled and compiled.build_index():
+            logging.debug(f"Assigning {compiled.n_clusters} clusters through a centroid index")
+
+        drift = None
+        if stats:
+            n_features = len(compiled.layout) if compiled else pipeline[-1].cluster_centers_.shape[1]
+            if len(stats["features"]) == n_features:
+                drift = DriftMonitor(stats)
+            else:
+                logging.warning(f"Training stats of {version} do not match its features")
+
+        # Warm up, so that the first requests do not pay for it
+        if compiled:
+            compiled.predict(compiled.probe(n_per_cluster=1))
+
+        return LoadedModel(version=version,
+                           artifact_filename=artifact_filename,
+                           pipeline=pipeline,
+                           compiled=compiled,
+                           feature_engine=feature_engine,
+                           decoder=decoder,
+                           drift=drift,
+                           loaded_at=datetime.now().isoformat(timespec="seconds"),
+                           load_seconds=time.perf_counter() - started)
+
+
+    def reload(self) -> bool:
+        """Loads the latest model artifact if it is not the active one
+
+        The new model is loaded and warmed up first, then swapped in.
+        Returns whether it was.
+        """
+        with self._reload_lock:
+            version, location = self.locate()
+            if self.model and version == self.model.version:
+                return False
+            model = self.load(version, location)
+            previous, self.model = self.model, model
+            self.reloads += 1
+        logging.info(f"Reloaded model {previous.version if previous else None} -> "
+                     f"{model.version} in {model.load_seconds:.3f}s")
+        return True
 
 
-    def download_model_from_gcs(self) -> None:
-        """Downloads model.joblib from GCS
+    def start_polling(self, interval: float = 60) -> None:
+        """Checks for a new model artifact every interval seconds, in the background
         """
-        # Download model artifact from Cloud Storage
-        storage_path = os.path.join(self.model_dir, "model.joblib") # file name required by Vertex AI
-        logging.debug(f"Downloading model artifact from GCS bucket {storage_path} to local file {self.artifact_filename}")
-        client = StorageClient()
-        blob = Blob.from_string(storage_path, client=client)
-        blob.download_to_filename(self.artifact_filename)
+        if self._polling:
+            if self._polling.is_alive():
+                return
+            # Forked from the process polling: threads are not copied, and
+            # the lock may have been copied held
+            self._reload_lock = threading.Lock()
+
+        def poll():
+            while not self._stop_polling.wait(interval):
+                try:
+                    self.reload()
+                except Exception as e:
+                    # Keep serving the active model
+                    logging.warning(f"Model reload failed: {e!r}")
+
+        self._stop_polling.clear()
+        self._polling = threading.Thread(target=poll, name="model-polling", daemon=True)
+        self._polling.start()
+        logging.debug(f"Polling {self.model_dir} for new models every {interval}s")
 
 
-    def predict_from_dataframe(self, df: pd.DataFrame):
-        logging.debug(f"Predictor df << {df}")
-        predictions = self.pipeline.predict(df)
-        logging.debug(f"Predictor df >> {predictions}")
+    def stop_polling(self) -> None:
+        if self._polling:
+            self._stop_polling.set()
+            self._polling.join()
+            self._polling = None
+
+
+    def model_info(self) -> Dict:
+        """Describes the active model
+        """
+        model = self.model
+        info = {
+            "model_dir": self.model_dir,
+            "version": model.version if model else None,
+            "loaded_at": model.loaded_at if model else None,
+            "load_seconds": model.load_seconds if model else None,
+            "compiled": bool(model and model.compiled),
+            "centroid_index": bool(model and model.compiled and model.compiled.index),
+            "reloads": self.reloads,
+            "polling": self._polling is not None,
+            "last_checked": self.last_checked,
+        }
+        if model and model.compiled:
+            info["n_clusters"] = model.compiled.n_clusters
+            info["features"] = model.compiled.layout
+        if self.prediction_cache is not None:
+            info["prediction_cache"] = self.prediction_cache.metrics()
+        return info
+
+
+    def drift_report(self) -> Dict:
+        """Compares the rows scored since the active model was loaded with its training data
+
+        See DriftMonitor.report. Models trained without training stats
+        report no rows.
+        """
+        model = self.model
+        if not model or not model.drift:
+            return {"version": model.version if model else None, "rows": 0,
+                    "error": "No training stats to compare with"}
+        return {"version": model.version, **model.drift.report()}
+
+
+    def register_metrics(self, registry: metrics.MetricsRegistry = metrics.REGISTRY) -> None:
+        """Exposes the reload and prediction cache counters along with the other metrics
+        """
+        registry.callback("custsegm_model_reloads_total", "counter",
+                          "Models swapped in by reload().", lambda: self.reloads)
+        registry.callback("custsegm_model_load_seconds", "gauge",
+                          "Load time of the active model, in seconds.",
+                          lambda: self.model.load_seconds if self.model else 0)
+        registry.callback("custsegm_drift_max_psi", "gauge",
+                          "Highest population stability index of the features and clusters scored.",
+                          lambda: self.drift_report().get("max_psi") or 0)
+        cache = self.prediction_cache
+        if cache is not None:
+            for counter in ("hits", "misses", "evictions", "expirations", "invalidations"):
+                registry.callback(f"custsegm_prediction_cache_{counter}_total", "counter",
+                                  f"Prediction cache {counter}.",
+                                  lambda counter=counter: cache.counters[counter])
+            registry.callback("custsegm_prediction_cache_entries", "gauge",
+                              "Predictions cached.", lambda: len(cache.entries))
+            registry.callback("custsegm_prediction_cache_bytes", "gauge",
+                              "Estimated memory taken by the prediction cache, in bytes.",
+                              lambda: cache.bytes)
+
+
+    def artifact_cache(self) -> ArtifactCache:
+        # One cache, hence one storage client, for all the polls and downloads
+        if self._artifact_cache is None:
+            self._artifact_cache = ArtifactCache(self.cache_dir, self.storage)
+            self.storage = self._artifact_cache.storage
+        return self._artifact_cache
+
+
+    def download_model_from_gcs(self, info: ObjectInfo) -> str:
+        """Fetches a model artifact from GCS through the artifact cache
+
+        Returns the path of the local copy.
+        """
+        # Download model artifact from Cloud Storage, unless cached already
+        return self.artifact_cache().fetch(info.uri, info)
+
+
+    @staticmethod
+    def request_decoder(compiled: Optional[CompiledPipeline],
+                        feature_engine: Optional["FeatureEngine"]) -> RequestDecoder:
+        """Returns a decoder of requests into the columns a model expects
+
+        Raw customer columns are accepted too when the model carries its
+        preprocessing state.
+        """
+        columns = compiled.input_columns if compiled else list(FEATURE_COLUMNS)
+        if feature_engine:
+            raw = [c for c in RAW_COLUMNS if c not in columns]
+            required = [columns, RAW_COLUMNS]
+        else:
+            raw = []
+            required = [columns]
+        return RequestDecoder(columns + raw, TEXT_COLUMNS, compact_columns=columns,
+                              required=required)
+
+
+    def predict_from_dataframe(self, df: "pd.DataFrame"):
+        # Payloads are only formatted when debug logging is enabled
+        logging.debug("Predictor df << %s", df)
+        predictions = self.predict_from_columns(df)
+        logging.debug("Predictor df >> %s", predictions)
         return predictions
 
 
+    def predict_from_columns(self,
+                             columns: Dict[str, np.ndarray],
+                             model: LoadedModel = None) -> np.ndarray:
+        """Predicts from a DataFrame or a mapping of column names to arrays
+        """
+        model = model or self.model
+        if self.prediction_cache is not None:
+            return self.predict_cached(columns, model)
+        return self._predict(columns, model)
+
+
+    def _predict(self, columns: Dict[str, np.ndarray], model: LoadedModel) -> np.ndarray:
+        X = self._scaled(columns, model)
+        with metrics.stage("assign"):
+            if model.compiled:
+                labels = model.compiled.assign(X)
+            else:
+                labels = model.pipeline[-1].predict(X)
+        if model.drift:
+            with metrics.stage("drift"):
+                model.drift.update(X, labels)
+        return labels
+
+
+    def nearest_from_columns(self,
+                             columns: Dict[str, np.ndarray],
+                             n: int,
+                             model: LoadedModel = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the n nearest segments of every row, and their distances
+
+        Both arrays have a row per row and n columns (at most the number of
+        segments), nearest first: the first column is what predict_from_columns
+        returns. The prediction cache is not used.
+        """
+        model = model or self.model
+        return self._nearest(self._scaled(columns, model), n, model)
+
+
+    def _nearest(self, X: np.ndarray, n: int, model: LoadedModel) -> Tuple[np.ndarray, np.ndarray]:
+        with metrics.stage("assign"):
+            if model.compiled:
+                return model.compiled.nearest(X, n)
+            distances = model.pipeline[-1].transform(X)
+            nearest = np.argsort(distances, axis=1, kind="stable")[:, :n].astype(np.int32)
+            return nearest, np.take_along_axis(distances, nearest, axis=1)
+
+
+    @staticmethod
+    def _features(columns: Dict[str, np.ndarray], model: LoadedModel) -> Dict[str, np.ndarray]:
+        """Returns the features of the rows, preprocessing raw customer data
+        """
+        engine = model.feature_engine
+        if engine and "Dt_Customer" in columns:
+            # Raw customer data: derive the features with the preprocessing
+            # state fitted along with the pipeline
+            with metrics.stage("preprocess"):
+                import pandas as pd
+                if not isinstance(columns, pd.DataFrame):
+                    columns = pd.DataFrame(columns)
+                columns = engine.transform(columns)
+        return columns
+
+
+    def _scaled(self, columns: Dict[str, np.ndarray], model: LoadedModel) -> np.ndarray:
+        """Returns the scaled features of the rows, the input of the KMeans step
+        """
+        columns = self._features(columns, model)
+        with metrics.stage("transform"):
+            if model.compiled:
+                return model.compiled.transform(columns)
+            import pandas as pd
+            if not isinstance(columns, pd.DataFrame):
+                columns = pd.DataFrame(columns)
+            return model.pipeline[:-1].transform(columns)
+
+
+    def predict_cached(self, columns: Dict[str, np.ndarray], model: LoadedModel) -> np.ndarray:
+        """Predicts only the rows missing from the prediction cache
+
+        Rows are looked up by their features, the model input, once raw
+        customer data is preprocessed.
+        """
+        columns = self._features(columns, model)
+        keys = PredictionCache.keys(
+            columns, model.compiled.input_columns if model.compiled else FEATURE_COLUMNS)
+        labels, missed = self.prediction_cache.lookup(model.version, keys)
+        if model.drift and not missed.all():
+            # The features of the hits are not computed: only their clusters count
+            with metrics.stage("drift"):
+                model.drift.update_clusters(labels[~missed])
+        if missed.any():
+            if not missed.all():
+                if hasattr(columns, "iloc"):
+                    columns = columns.iloc[missed]
+                else:
+                    columns = {c: np.asarray(v)[missed] for c, v in columns.items()}
+            predicted = self._predict(columns, model)
+            labels[missed] = predicted
+            self.prediction_cache.store(model.version, keys[missed], predicted)
+        return labels
+
+
+    def predict_from_json(self, body: Union[bytes, str]) -> Dict:
+        """Predicts from the JSON body of a Vertex AI prediction request
+        """
+        model = self.model
+        with metrics.stage("decode"):
+            request = model.decoder.decode(body)
+        metrics.record_request(len(request))
+        return { "predictions": self.predict_request(request, model) }
+
+
     def predict_from_vertex_ai(self, vertex_ai_input: Union[List, Dict[str, List]]) -> Dict:
-        logging.debug(f"Predictor vertex ai << {vertex_ai_input}")
-        if isinstance(vertex_ai_input, dict) and vertex_ai_input["instances"]:
-            instances = vertex_ai_input["instances"]
-        else:
-            instances = vertex_ai_input
-        df = pd.DataFrame(instances)
-        predictions = self.predict_from_dataframe(df).tolist()
-        vertex_ai_output = { "predictions": predictions }
-        logging.debug(f"Predictor vertex ai >> {vertex_ai_output}")
+        logging.debug("Predictor vertex ai << %s", vertex_ai_input)
+        model = self.model
+        with metrics.stage("decode"):
+            request = model.decoder.decode(vertex_ai_input)
+        metrics.record_request(len(request))
+        vertex_ai_output = { "predictions": self.predict_request(request, model) }
+        logging.debug("Predictor vertex ai >> %s", vertex_ai_output)
         return vertex_ai_output
+
+
+    def predict_request(self, request: DecodedRequest, model: LoadedModel = None) -> List:
+        """Returns the predictions of a decoded request, as asked by its parameters
+
+        A segment per row, or an object per row with its segment and:
+        - with {"top_n": n}, its n nearest segments and their distances;
+        - with {"details": true}, its distance to the segment, the margin
+          to the runner-up segment, its soft membership of the segment
+          against the runner-up, whatever top_n, and its scaled features
+          (in the order of model_info()["features"]).
+        Everything is computed from one transform and one nearest-centroid
+        search.
+        """
+        model = model or self.model
+        n, details = Predictor.output_options(request.parameters)
+        if not n and not details:
+            return self.predict_from_columns(request.columns, model).tolist()
+
+        X = self._scaled(request.columns, model)
+        nearest, distances = self._nearest(X, max(n, 2) if details else n, model)
+        if model.drift:
+            with metrics.stage("drift"):
+                model.drift.update(X, nearest[:, 0])
+        predictions = [{"segment": segment} for segment in nearest[:, 0].tolist()]
+        if n:
+            for prediction, segments, d in zip(predictions,
+                                               nearest[:, :n].tolist(),
+                                               distances[:, :n].tolist()):
+                prediction["nearest"] = segments
+                prediction["distances"] = d
+        if details:
+            if distances.shape[1] > 1:
+                margins = (distances[:, 1] - distances[:, 0]).tolist()
+            else:
+                # A single segment has no runner-up
+                margins = [None] * len(X)
+            for prediction, distance, margin, membership, features in zip(
+                    predictions,
+                    distances[:, 0].tolist(),
+                    margins,
+                    Predictor.memberships(distances[:, :2]).tolist(),
+                    X.tolist()):
+                prediction["distance"] = distance
+                prediction["margin"] = margin
+                prediction["membership"] = membership
+                prediction["features"] = features
+        return predictions
+
+
+    @staticmethod
+    def output_options(parameters: Any) -> Tuple[int, bool]:
+        """Returns the nearest segments (top_n, 0 if none) and details request parameters ask for
+
+        Raises ValueError when top_n is not a positive integer, or details
+        not a boolean.
+        """
+        if not isinstance(parameters, dict):
+            return 0, False
+        n = parameters.get("top_n")
+        if n is None:
+            n = 0
+        elif isinstance(n, bool) or not isinstance(n, int) or n < 1:
+            raise ValueError(f"top_n must be a positive integer, not {n!r}")
+        details = parameters.get("details", False)
+        if not isinstance(details, bool):
+            raise ValueError(f"details must be true or false, not {details!r}")
+        return n, details
+
+
+    @staticmethod
+    def memberships(distances: np.ndarray) -> np.ndarray:
+        """Returns the soft membership of each row to its segment
+
+        Fuzzy c-means memberships (fuzzifier 2) among the segments of
+        distances, nearest first: 1 for a row on its centroid, 0.5 for a row
+        as near to the runner-up. Requests get it among their two nearest
+        segments, so that it does not depend on how many were searched.
+        """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            inverse = 1 / distances ** 2
+            membership = inverse[:, 0] / inverse.sum(axis=1)
+        return np.where(distances[:, 0] > 0, membership, 1.0)
     
     
     @staticmethod
     def as_set_by_envvars():
-        if os.path.isfile("model.joblib"):
+        if os.path.isfile("model.csgm"):
+            logging.debug("Found local model.csgm file.")
+            model_dir = "."
+            artifact_filename = "model.csgm"
+        elif os.path.isfile("model.joblib"):
             logging.debug("Found local model.joblib file.")
             model_dir = "."
             artifact_filename = "model.joblib"
@@ -93,5 +571,14 @@ class Predictor:
             else:
                 raise ValueError("AIP_MODEL_DIR not set.")
         
-        predictor = Predictor(model_dir, artifact_filename)
+        prediction_cache = None
+        PREDICTION_CACHE_SIZE = int(os.getenv("PREDICTION_CACHE_SIZE", "0"))
+        if PREDICTION_CACHE_SIZE > 0:
+            PREDICTION_CACHE_TTL = os.getenv("PREDICTION_CACHE_TTL")
+            PREDICTION_CACHE_MB = float(os.getenv("PREDICTION_CACHE_MB", "64"))
+            prediction_cache = PredictionCache(PREDICTION_CACHE_SIZE,
+                                               float(PREDICTION_CACHE_TTL) if PREDICTION_CACHE_TTL else None,
+                                               int(PREDICTION_CACHE_MB * (1 << 20)))
+
+        predictor = Predictor(model_dir, artifact_filename, prediction_cache=prediction_cache)
         return predictor
\ No newline at end of file
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+
+"""Many named models served by one process, loaded on first use
+"""
+
+import logging
+import os
+import re
+import threading
+import time
+import types
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import numpy as np
+
+from custsegm import metrics
+from custsegm.predictor import LoadedModel, Predictor
+
+# Memory the models of a process may take by default, in MiB
+DEFAULT_MEMORY_MB = 512
+
+# Memory a loaded model takes besides its numpy arrays, in bytes: the
+# Python objects of the pipeline, request decoder and drift summaries
+# (15 to 40 KiB, measured with tracemalloc)
+MODEL_OVERHEAD_BYTES = 128 << 10
+
+# Model names are directory names under the models root, and nothing else
+NAME_PATTERN = re.compile(r"[A-Za-z0-9][A-Za-z0-9_.-]{0,127}")
+
+
+class ModelNotFound(LookupError):
+    """Raised when there is no model of the name asked for
+    """
+
+
+def array_bytes(obj, seen: set = None) -> int:
+    """Returns the bytes of the numpy arrays reachable from obj
+
+    Objects are walked through their attributes and containers. Arrays are
+    counted once, whatever the views of them, and memory-mapped ones not at
+    all.
+    """
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, np.ndarray):
+        root = obj
+        while isinstance(root.base, np.ndarray):
+            root = root.base
+        if root is not obj:
+            if id(root) in seen:
+                return 0
+            seen.add(id(root))
+        # Memory-mapped arrays are views of an mmap
+        return root.nbytes if root.base is None else 0
+    if isinstance(obj, dict):
+        return sum(array_bytes(value, seen) for value in obj.values())
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return sum(array_bytes(value, seen) for value in obj)
+    if hasattr(obj, "__dict__") and not isinstance(obj, (type, types.ModuleType)):
+        return array_bytes(vars(obj), seen)
+    return 0
+
+
+def footprint(model: LoadedModel) -> int:
+    """Estimates the memory a loaded model takes, in bytes
+
+    That is the numpy arrays of the model, unpickled or derived, plus
+    MODEL_OVERHEAD_BYTES for its other Python objects. The arrays of
+    model.csgm artifacts are memory-mapped: their file size is counted,
+    though its pages are shared by all the processes mapping it.
+    """
+    size = array_bytes(model) + MODEL_OVERHEAD_BYTES
+    if model.artifact_filename.endswith(".csgm"):
+        size += os.path.getsize(model.artifact_filename)
+    return size
+
+
+class ModelRegistry:
+    """Named models under a root directory, <root>/<name>/model.csgm (or model.joblib)
+
+    Models are loaded on first use and evicted, least recently used first,
+    when the models loaded take more than memory_budget bytes (the model
+    just used always stays). Prefer model.csgm artifacts: their numeric
+    parameters are memory-mapped from the artifact cache, which the
+    processes of a host share, so every worker maps the same pages instead
+    of unpickling its own copy. With a poll_interval, a model is checked
+    for a new artifact when used, at most every poll_interval seconds.
+    """
+
+    def __init__(self,
+                 root: str,
+                 memory_budget: int = DEFAULT_MEMORY_MB << 20,
+                 storage=None,
+                 cache_dir: str = None,
+                 poll_interval: float = 0):
+        self.root = root.rstrip("/")
+        self.memory_budget = memory_budget
+        self.storage = storage
+        self.cache_dir = cache_dir
+        self.poll_interval = poll_interval
+        # name -> [predictor, footprint, last checked], least recently used first
+        self._models = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+        self.counters = {"loads": 0, "evictions": 0, "reloads": 0}
+        logging.debug(f"ModelRegistry" +
+                      f" root={self.root}" +
+                      f" memory_budget={self.memory_budget}.")
+
+
+    @property
+    def memory(self) -> int:
+        """Estimated memory taken by the models loaded, in bytes
+        """
+        with self._lock:
+            return sum(entry[1] for entry in self._models.values())
+
+
+    def get(self, name: str) -> Predictor:
+        """Returns the predictor of a model, loading it if needed
+
+        Raises ModelNotFound when there is no such model.
+        """
+        if not NAME_PATTERN.fullmatch(name):
+            raise ModelNotFound(f"Invalid model name: {name!r}")
+
+        with self._lock:
+            entry = self._models.get(name)
+            if entry is not None:
+                self._models.move_to_end(name)
+            loading = self._loading.setdefault(name, threading.Lock()) if entry is None else None
+
+        if entry is not None:
+            predictor = entry[0]
+            if self.poll_interval and time.monotonic() - entry[2] >= self.poll_interval:
+                self._reload(name, entry)
+            return predictor
+
+        # Loaded once, however many requests ask for it meanwhile
+        with loading:
+            with self._lock:
+                entry = self._models.get(name)
+            if entry is not None:
+                return entry[0]
+            try:
+                predictor = self._load(name)
+            except Exception:
+                with self._lock:
+                    self._loading.pop(name, None)
+                raise
+            with self._lock:
+                self._models[name] = [predictor, footprint(predictor.model), time.monotonic()]
+                self._loading.pop(name, None)
+                self.counters["loads"] += 1
+                self._evict(keep=name)
+        return predictor
+
+
+    def _load(self, name: str) -> Predictor:
+        model_dir = f"{self.root}/{name}"
+        if model_dir.startswith("gs://"):
+            artifact_filename = None
+        else:
+            for artifact_filename in (os.path.join(model_dir, "model.csgm"),
+                                      os.path.join(model_dir, "model.joblib")):
+                if os.path.isfile(artifact_filename):
+                    break
+            else:
+                raise ModelNotFound(f"No model named {name}")
+
+        predictor = Predictor(model_dir, artifact_filename,
+                              storage=self.storage, cache_dir=self.cache_dir)
+        try:
+            predictor.ready()
+        except FileNotFoundError:
+            raise ModelNotFound(f"No model named {name}")
+        logging.info(f"Loaded model {name} {predictor.model.version} "
+                     f"in {predictor.model.load_seconds:.3f}s")
+        return predictor
+
+
+    def _reload(self, name: str, entry: list) -> None:
+        entry[2] = time.monotonic()
+        try:
+            if entry[0].reload():
+                with self._lock:
+                    entry[1] = footprint(entry[0].model)
+                    self.counters["reloads"] += 1
+                    self._evict(keep=name)
+        except Exception as e:
+            # Keep serving the model loaded
+            logging.warning(f"Model {name} reload failed: {e!r}")
+
+
+    def _evict(self, keep: str) -> None:
+        # Called with the lock held
+        total = sum(entry[1] for entry in self._models.values())
+        for name in list(self._models):
+            if total <= self.memory_budget:
+                break
+            if name == keep:
+                continue
+            total -= self._models.pop(name)[1]
+            self.counters["evictions"] += 1
+            logging.info(f"Evicted model {name}")
+
+
+    def evict(self, name: str) -> bool:
+        """Unloads a model, returning whether it was loaded
+
+        Requests scoring it meanwhile finish on it.
+        """
+        with self._lock:
+            return self._models.pop(name, None) is not None
+
+
+    def info(self) -> Dict:
+        """Describes the models loaded, most recently used last
+        """
+        with self._lock:
+            models = [(name, entry[0], entry[1]) for name, entry in self._models.items()]
+            counters = dict(self.counters)
+        return {
+            "root": self.root,
+            "memory_budget": self.memory_budget,
+            "memory": sum(size for _, _, size in models),
+            **counters,
+            "models": {name: {"version": predictor.model.version,
+                              "loaded_at": predictor.model.loaded_at,
+                              "bytes": size}
+                       for name, predictor, size in models},
+        }
+
+
+    def register_metrics(self, registry: metrics.MetricsRegistry = metrics.REGISTRY) -> None:
+        registry.callback("custsegm_models_loaded", "gauge",
+                          "Named models loaded.", lambda: len(self._models))
+        registry.callback("custsegm_models_bytes", "gauge",
+                          "Estimated memory taken by the named models loaded, in bytes.",
+                          lambda: self.memory)
+        for counter in ("loads", "evictions", "reloads"):
+            registry.callback(f"custsegm_named_model_{counter}_total", "counter",
+                              f"Named model {counter}.",
+                              lambda counter=counter: self.counters[counter])
+
+
+    @staticmethod
+    def as_set_by_envvars() -> Optional["ModelRegistry"]:
+        """Returns the registry of the models under MODELS_ROOT, None if not set
+        """
+        MODELS_ROOT = os.getenv("MODELS_ROOT")
+        if not MODELS_ROOT:
+            return None
+        logging.debug(f"MODELS_ROOT={MODELS_ROOT}")
+        MODELS_MEMORY_MB = float(os.getenv("MODELS_MEMORY_MB", str(DEFAULT_MEMORY_MB)))
+        MODEL_POLL_SECONDS = float(os.getenv("MODEL_POLL_SECONDS", "0"))
+        return ModelRegistry(MODELS_ROOT,
+                             memory_budget=int(MODELS_MEMORY_MB * (1 << 20)),
+                             poll_interval=MODEL_POLL_SECONDS)
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+"""Sampling and splitting of training data too large to hold in memory
+"""
+
+import hashlib
+from typing import Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+
+# Columns fitting subsamples are stratified by: numeric ones by quantile bins
+STRATA = ["Education", "Marital_Status", "Income"]
+
+# Number of quantile bins of the numeric strata columns
+N_BINS = 4
+
+
+class Reservoir:
+    """Uniform random sample of size rows of a stream of chunks
+
+    Reservoir sampling (algorithm R): every row added ends up in the sample
+    with the same probability, holding at most size rows plus one chunk in
+    memory.
+    """
+
+    def __init__(self, size: int, random_state: int = 42):
+        self.size = size
+        self.rng = np.random.RandomState(random_state)
+        self.rows = None
+        self.seen = 0
+
+
+    def add(self, chunk: pd.DataFrame) -> None:
+        n = len(chunk)
+        if not n:
+            return
+        size = self.size
+        if self.rows is None:
+            self.rows = chunk.iloc[:0]
+
+        # Fill the reservoir first
+        fill = min(max(size - len(self.rows), 0), n)
+        if fill:
+            self.rows = pd.concat([self.rows, chunk.iloc[:fill]])
+
+        # Then row number t replaces a random slot with probability size / (t + 1)
+        t = np.arange(self.seen + fill, self.seen + n)
+        slots = (self.rng.random_sample(len(t)) * (t + 1)).astype(np.int64)
+        replace = np.flatnonzero(slots < size)
+        if len(replace):
+            # Later rows win over earlier ones drawing the same slot
+            slots = pd.Series(replace + fill, index=slots[replace])
+            slots = slots[~slots.index.duplicated(keep="last")]
+            keep = np.ones(len(self.rows), dtype=bool)
+            keep[slots.index.to_numpy()] = False
+            self.rows = pd.concat([self.rows[keep], chunk.iloc[slots.to_numpy()]])
+        self.seen += n
+
+
+    def sample(self) -> pd.DataFrame:
+        if self.rows is None:
+            return pd.DataFrame()
+        return self.rows
+
+
+def reservoir_sample(chunks: Iterable[pd.DataFrame],
+                     size: int,
+                     random_state: int = 42) -> pd.DataFrame:
+    """Returns a uniform random sample of size rows of a stream of chunks
+
+    See Reservoir: a single pass over the stream.
+    """
+    reservoir = Reservoir(size, random_state)
+    for chunk in chunks:
+        reservoir.add(chunk)
+    return reservoir.sample()
+
+
+def _splitmix64(values: np.ndarray) -> np.ndarray:
+    """Mixes 64-bit integers into well-spread 64-bit hashes"""
+    with np.errstate(over="ignore"):
+        z = values + np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+
+def in_holdout(ids, test_size: float = 0.10, salt: str = "custsegm") -> np.ndarray:
+    """Returns which customers, by ID, belong to the held-out test set
+
+    A customer is held out when the hash of its ID falls in the first
+    test_size fraction of the hash range. The split depends on the IDs and
+    salt only: a customer stays on the same side across chunks, reruns,
+    and datasets growing with new customers.
+    """
+    ids = np.asarray(ids)
+    key = hashlib.md5(salt.encode("utf-8")).digest()
+    if np.issubdtype(ids.dtype, np.integer):
+        hashes = _splitmix64(ids.astype(np.int64).view(np.uint64) ^
+                             np.frombuffer(key[:8], dtype=np.uint64)[0])
+    else:
+        hashes = pd.util.hash_array(ids.astype(str).astype(object),
+                                    hash_key=key.hex()[:16], categorize=False)
+    # test_size * 2**64 does not fit in a uint64 from test_size = 1 on
+    threshold = int(test_size * 2.0 ** 64)
+    if threshold >= 2 ** 64:
+        return np.ones(len(hashes), dtype=bool)
+    return hashes < np.uint64(max(threshold, 0))
+
+
+def split_chunks(chunks: Iterable[pd.DataFrame],
+                 test_size: float = 0.10,
+                 train_size: Optional[int] = None,
+                 id_column: str = "ID",
+                 random_state: int = 42):
+    """Splits a stream of chunks into training and test rows, by customer ID
+
+    Rows with missing values are dropped. When train_size is given, the
+    training rows are reservoir sampled down to train_size rows and the test
+    rows down to the same proportion, so that memory stays bounded whatever
+    the length of the stream. Returns the training and test rows.
+    """
+    if train_size is None:
+        train, test = [], []
+        for chunk in chunks:
+            chunk = chunk.dropna()
+            holdout = in_holdout(chunk[id_column].to_numpy(), test_size)
+            train.append(chunk[~holdout])
+            test.append(chunk[holdout])
+        if not train:
+            return pd.DataFrame(), pd.DataFrame()
+        return pd.concat(train), pd.concat(test)
+
+    test_sample_size = int(np.ceil(train_size * test_size / (1 - test_size)))
+    train = Reservoir(train_size, random_state)
+    test = Reservoir(test_sample_size, random_state + 1)
+    for chunk in chunks:
+        chunk = chunk.dropna()
+        holdout = in_holdout(chunk[id_column].to_numpy(), test_size)
+        train.add(chunk[~holdout])
+        test.add(chunk[holdout])
+    return train.sample(), test.sample()
+
+
+def strata_of(data: pd.DataFrame, strata: List[str] = STRATA, n_bins: int = N_BINS) -> np.ndarray:
+    """Returns the stratum number of every row
+
+    Strata are the combinations of the values of the strata columns, numeric
+    columns being cut into n_bins quantile bins first. Missing values make a
+    stratum of their own.
+    """
+    codes = np.zeros(len(data), dtype=np.int64)
+    for name in strata:
+        values = data[name]
+        if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+            edges = np.unique(np.nanquantile(values.to_numpy(dtype=np.float64),
+                                             np.linspace(0, 1, n_bins + 1)[1:-1]))
+            column = np.searchsorted(edges, values.to_numpy(dtype=np.float64), side="right")
+            column[values.isna().to_numpy()] = len(edges) + 1
+            n_values = len(edges) + 2
+        else:
+            column, uniques = pd.factorize(values.to_numpy())
+            column = column + 1  # missing values are -1
+            n_values = len(uniques) + 1
+        codes = codes * n_values + column
+    return pd.factorize(codes)[0]
+
+
+def stratified_sample(data: pd.DataFrame,
+                      size: int,
+                      strata: List[str] = STRATA,
+                      random_state: int = 42) -> pd.DataFrame:
+    """Returns a random sample of size rows of data, stratified by strata
+
+    Every stratum gets its share of the sample in proportion to its share of
+    data, rounded so that the shares add up to size (largest remainders),
+    which keeps rare customer profiles as frequent in the sample as in data.
+    Rows keep their order.
+    """
+    n = len(data)
+    if size >= n:
+        return data
+    codes = strata_of(data, strata)
+    counts = np.bincount(codes)
+    quotas = counts * size / n
+    shares = np.floor(quotas).astype(np.int64)
+    remainders = np.argsort(shares - quotas, kind="stable")[:size - shares.sum()]
+    shares[remainders] += 1
+
+    # First rows of every stratum in a random order
+    rng = np.random.RandomState(random_state)
+    order = rng.permutation(n)
+    shuffled = codes[order]
+    rank = pd.Series(shuffled).groupby(shuffled).cumcount().to_numpy()
+    chosen = np.sort(order[rank < shares[shuffled]])
+    return data.iloc[chosen]
@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+
+"""Batch scoring of customer files
+"""
+
+import csv
+import logging
+import os
+import time
+from datetime import date
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from custsegm.dataset import Dataset
+from custsegm.features import FEATURE_COLUMNS, RAW_COLUMNS, FeatureEngine
+from custsegm.predictor import Predictor
+
+
+# Label written for rows that cannot be scored because of missing values
+MISSING_LABEL = -1
+
+# Size of the blocks read when looking for shard boundaries
+BLOCK_SIZE = 1 << 24
+
+# Scorer of each worker process, set up once by _init_worker
+_worker_scorer = None
+
+
+def _init_worker(model_dir: str, artifact_filename: str, chunk_size: int) -> None:
+    global _worker_scorer
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(1)  # one process per core already
+    except ImportError:
+        pass
+    predictor = Predictor(model_dir, artifact_filename)
+    predictor.ready()
+    _worker_scorer = Scorer(predictor, chunk_size)
+
+
+def _score_shard(shard: "Shard") -> Tuple[np.ndarray, np.ndarray]:
+    chunk = shard.read()
+    ids = chunk["ID"].to_numpy() if "ID" in chunk.columns else np.full(len(chunk), "")
+    return ids, _worker_scorer.score_chunk(chunk)
+
+
+class Shard:
+    """Rows of an input file a worker process reads and scores on its own
+
+    A shard is described by its location in the file only (a byte offset in
+    a delimited text file, a row group in a Parquet file), so that no data
+    crosses the process boundary but the labels coming back.
+    """
+
+    def __init__(self,
+                 path: str,
+                 first_row: int,
+                 n_rows: int,
+                 columns: List[str],
+                 offset: int = 0,
+                 sep: str = None,
+                 names: List[str] = None,
+                 row_group: int = None,
+                 skip: int = 0):
+        self.path = path
+        self.first_row = first_row
+        self.n_rows = n_rows
+        self.columns = columns
+        self.offset = offset
+        self.sep = sep
+        self.names = names
+        self.row_group = row_group
+        self.skip = skip
+
+
+    def read(self) -> pd.DataFrame:
+        wanted = set(self.columns)
+        if self.row_group is not None:
+            import pyarrow.parquet as pq
+            parquet = pq.ParquetFile(self.path)
+            names = [c for c in parquet.schema_arrow.names if c in wanted]
+            table = parquet.read_row_group(self.row_group, columns=names)
+            chunk = table.slice(self.skip).to_pandas()
+        else:
+            with open(self.path, "rb") as f:
+                f.seek(self.offset)
+                chunk = pd.read_csv(f,
+                                    sep=self.sep,
+                                    header=None,
+                                    names=self.names,
+                                    usecols=lambda c: c in wanted,
+                                    nrows=self.n_rows)
+        chunk.index = pd.RangeIndex(self.first_row, self.first_row + len(chunk))
+        return chunk
+
+
+class Scorer:
+    """Scores customer files chunk by chunk with a ready Predictor
+
+    The input is streamed in chunks of chunk_size rows, each chunk is
+    preprocessed (when it holds raw customer data) and predicted on its own,
+    and its labels are appended to the output before the next chunk is read,
+    so that peak memory depends on chunk_size only.
+
+    The output is a CSV file with the input row number, the customer ID (when
+    the input has one) and the cluster label of every row. Rows with missing
+    values are labelled -1.
+    """
+
+    def __init__(self,
+                 predictor: Predictor,
+                 chunk_size: int = 100000):
+        self.predictor = predictor
+        self.chunk_size = chunk_size
+        logging.debug(f"Scorer chunk_size={chunk_size}.")
+
+
+    @staticmethod
+    def read_chunks(path: str,
+                    chunk_size: int,
+                    start_row: int = 0,
+                    columns: Optional[list] = None) -> Iterator[pd.DataFrame]:
+        """Yields the rows of a TSV, CSV or Parquet file from start_row on
+
+        Only the given columns are read, when the input has them. Chunks are
+        indexed by input row number.
+        """
+        wanted = set(columns) if columns else None
+        if Dataset.format_of(path) == "parquet":
+            try:
+                import pyarrow.parquet as pq
+            except ImportError:
+                raise ImportError("Reading Parquet files requires pyarrow")
+            parquet = pq.ParquetFile(path)
+            names = [c for c in parquet.schema_arrow.names if not wanted or c in wanted]
+            row = 0
+            for batch in parquet.iter_batches(batch_size=chunk_size, columns=names):
+                if row + batch.num_rows > start_row:
+                    skip = max(start_row - row, 0)
+                    chunk = batch.slice(skip).to_pandas()
+                    chunk.index = pd.RangeIndex(row + skip, row + batch.num_rows)
+                    yield chunk
+                row += batch.num_rows
+            return
+
+        sep = Scorer.sniff_separator(path)
+        reader = pd.read_csv(path,
+                             sep=sep,
+                             usecols=(lambda c: c in wanted) if wanted else None,
+                             skiprows=range(1, start_row + 1),
+                             chunksize=chunk_size)
+        row = start_row
+        for chunk in reader:
+            chunk.index = pd.RangeIndex(row, row + len(chunk))
+            row += len(chunk)
+            yield chunk
+
+
+    @staticmethod
+    def sniff_separator(path: str) -> str:
+        """Returns the field separator of a delimited text file
+
+        marketing_campaign.csv holds tab-separated values despite its name,
+        so the header line decides rather than the file extension.
+        """
+        if path.endswith(".tsv"):
+            return "\t"
+        with open(path, "r", newline="") as f:
+            header = f.readline()
+        return "\t" if "\t" in header else ","
+
+
+    @staticmethod
+    def rows_written(output: str) -> int:
+        """Returns the number of input rows already scored into output
+
+        Only the last complete line of output is read.
+        """
+        if not os.path.isfile(output):
+            return 0
+        with open(output, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(max(size - 4096, 0))
+            lines = f.read().split(b"\n")[:-1]
+        last = lines[-1].split(b",")[0] if lines else b"row"
+        return 0 if last == b"row" else int(last) + 1
+
+
+    @staticmethod
+    def truncate_partial_line(output: str) -> None:
+        """Drops the trailing partial line an interrupted run may have left
+        """
+        with open(output, "rb+") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(max(size - 4096, 0))
+            tail = f.read()
+            if tail and not tail.endswith(b"\n"):
+                f.truncate(size - len(tail) + tail.rfind(b"\n") + 1)
+
+
+    @staticmethod
+    def plan_shards(path: str,
+                    shard_size: int,
+                    start_row: int = 0,
+                    columns: Optional[List[str]] = None) -> List[Shard]:
+        """Splits the rows of a file from start_row on into shards
+
+        Delimited text files are scanned once for the byte offsets of the
+        lines starting a shard (fields must not hold line breaks); Parquet
+        files are split by row group.
+        """
+        columns = columns or []
+        if Dataset.format_of(path) == "parquet":
+            import pyarrow.parquet as pq
+            metadata = pq.ParquetFile(path).metadata
+            shards = []
+            row = 0
+            for i in range(metadata.num_row_groups):
+                n_rows = metadata.row_group(i).num_rows
+                if row + n_rows > start_row:
+                    skip = max(start_row - row, 0)
+                    shards.append(Shard(path, row + skip, n_rows - skip, columns,
+                                        row_group=i, skip=skip))
+                row += n_rows
+            return shards
+
+        sep = Scorer.sniff_separator(path)
+        starts = []
+        with open(path, "rb") as f:
+            header = f.readline().decode("utf-8")
+            names = next(csv.reader([header], delimiter=sep))
+            position = f.tell()
+            row = 0  # row starting at position
+            next_start = start_row
+            if next_start == 0:
+                starts.append((0, position))
+                next_start += shard_size
+            last = b"\n"
+            while True:
+                block = f.read(BLOCK_SIZE)
+                if not block:
+                    break
+                ends = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord("\n"))
+                # Row row + 1 + i starts right after the i-th line end
+                while next_start <= row + len(ends):
+                    starts.append((next_start, position + int(ends[next_start - row - 1]) + 1))
+                    next_start += shard_size
+                row += len(ends)
+                position += len(block)
+                last = block[-1:]
+        n_rows = row if last == b"\n" else row + 1
+
+        starts = [(r, offset) for r, offset in starts if r < n_rows]
+        ends = [r for r, _ in starts[1:]] + [n_rows]
+        return [Shard(path, r, end - r, columns, offset=offset, sep=sep, names=names)
+                for (r, offset), end in zip(starts, ends)]
+
+
+    def score_chunk(self, chunk: pd.DataFrame) -> np.ndarray:
+        """Returns the cluster labels of a chunk of raw or preprocessed rows
+        """
+        raw = "Dt_Customer" in chunk.columns
+        needed = RAW_COLUMNS if raw else FEATURE_COLUMNS
+        labels = np.full(len(chunk), MISSING_LABEL, dtype=np.int32)
+        valid = chunk[needed].notna().all(axis=1).to_numpy()
+        if not valid.any():
+            return labels
+        if not valid.all():
+            chunk = chunk[valid]
+        if raw:
+            engine = self.predictor.feature_engine or FeatureEngine(date.today().year)
+            chunk = engine.transform(chunk)
+        labels[valid] = self.predictor.predict_from_columns(chunk)
+        return labels
+
+
+    def score(self,
+              input_path: str,
+              output_path: str,
+              start_row: int = 0,
+              workers: int = 1) -> Dict:
+        """Scores input_path into output_path, starting at input row start_row
+
+        When resuming (start_row > 0) labels are appended to output_path.
+        With several workers, shards of chunk_size rows are read and scored in
+        worker processes, each loading the model once, and their labels are
+        written out in input order.
+        """
+        logging.info(f"Scoring {input_path} into {output_path} from row {start_row}")
+        columns = ["ID", *RAW_COLUMNS, *FEATURE_COLUMNS]
+        append = start_row > 0 and os.path.isfile(output_path)
+        if append:
+            Scorer.truncate_partial_line(output_path)
+
+        started = time.perf_counter()
+        n_rows = 0
+        n_missing = 0
+        with open(output_path, "a" if append else "w", newline="") as f:
+            writer = csv.writer(f)
+            if not append:
+                writer.writerow(["row", "ID", "Cluster"])
+            for first_row, ids, labels in self._scored(input_path, start_row, columns, workers):
+                writer.writerows(zip(range(first_row, first_row + len(labels)),
+                                     ids, labels.tolist()))
+                f.flush()
+
+                n_rows += len(labels)
+                n_missing += int((labels == MISSING_LABEL).sum())
+                elapsed = time.perf_counter() - started
+                logging.info(f"Scored rows {first_row}-{first_row + len(labels) - 1} "
+                             f"({n_rows / elapsed:,.0f} rows/sec)")
+
+        elapsed = time.perf_counter() - started
+        report = {
+            "rows": n_rows,
+            "missing": n_missing,
+            "seconds": elapsed,
+            "rows_per_sec": n_rows / elapsed if elapsed else 0.0,
+        }
+        logging.info(f"Scoring done: {report}")
+        return report
+
+
+    def _scored(self,
+                input_path: str,
+                start_row: int,
+                columns: List[str],
+                workers: int) -> Iterator[Tuple[int, np.ndarray, np.ndarray]]:
+        """Yields the first row number, IDs and labels of each chunk, in order
+        """
+        if workers <= 1:
+            for chunk in Scorer.read_chunks(input_path, self.chunk_size, start_row, columns):
+                ids = chunk["ID"].to_numpy() if "ID" in chunk.columns else np.full(len(chunk), "")
+                yield chunk.index[0], ids, self.score_chunk(chunk)
+            return
+
+        shards = Scorer.plan_shards(input_path, self.chunk_size, start_row, columns)
+        logging.info(f"Scoring {len(shards)} shards with {workers} workers")
+        # Workers load the artifact the predictor has already downloaded
+        artifact_filename = self.predictor.artifact_filename
+        initargs = (os.path.dirname(artifact_filename) or ".",
+                    artifact_filename,
+                    self.chunk_size)
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=initargs) as pool:
+            for shard, (ids, labels) in zip(shards, pool.map(_score_shard, shards)):
+                yield shard.first_row, ids, labels
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+
+"""Object storage backends: Google Cloud Storage and a local stand-in
+"""
+
+import base64
+import functools
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, NamedTuple, Optional, Tuple
+
+# Objects larger than this are transferred in chunks of this size, in parallel
+CHUNK_SIZE = 32 << 20
+
+# Parallel transfers per object, and HTTP connections per client
+MAX_WORKERS = 8
+
+# Most parts a GCS compose request takes
+MAX_COMPOSE_PARTS = 32
+
+
+class ObjectInfo(NamedTuple):
+    uri: str
+    generation: str
+    md5: Optional[str]  # base64 digest, as reported by GCS
+    size: int
+
+
+def split_uri(uri: str) -> Tuple[str, str]:
+    """Returns the bucket and object name of a gs:// URI
+    """
+    if not uri.startswith("gs://"):
+        raise ValueError(f"Not a gs:// URI: {uri}")
+    bucket, _, name = uri[len("gs://"):].partition("/")
+    return bucket, name
+
+
+def md5_of(filename: str) -> str:
+    """Returns the base64 MD5 digest of a file, as reported by GCS
+    """
+    digest = hashlib.md5()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return base64.b64encode(digest.digest()).decode("ascii")
+
+
+@functools.lru_cache(maxsize=None)
+def default_project_id() -> str:
+    """Returns the default GCP project id, looked up once per process
+
+    The GOOGLE_CLOUD_PROJECT and CLOUD_ML_PROJECT_ID environment variables
+    come first, then the application default credentials, then gcloud.
+    """
+    project_id = os.getenv("GOOGLE_CLOUD_PROJECT") or os.getenv("CLOUD_ML_PROJECT_ID")
+    if not project_id:
+        try:
+            import google.auth
+            _, project_id = google.auth.default()
+        except Exception as e:
+            logging.debug(f"No project id in the application default credentials: {e}")
+    if not project_id:
+        try:
+            output = subprocess.run(["gcloud", "config", "get-value", "project"],
+                                    stdout=subprocess.PIPE, check=True).stdout
+            project_id = output.decode("utf8").strip()
+        except (OSError, subprocess.CalledProcessError) as e:
+            logging.error(f"error={e}")
+    if not project_id:
+        raise Exception("Could not find the default GCP project id. Is Google Cloud SDK installed?")
+    logging.debug(f"project_id={project_id}")
+    return project_id
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def shared_client(project_id: str = None):
+    """Returns the GCS client of a project, created once per process
+
+    Its connection pool is sized for MAX_WORKERS parallel transfers.
+    Processes forked after the client was created get their own, as
+    connections cannot be shared across processes.
+    """
+    key = (os.getpid(), project_id)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            from google.cloud.storage import Client as StorageClient
+            from requests.adapters import HTTPAdapter
+            client = StorageClient(project=project_id)
+            client._http.mount("https://", HTTPAdapter(pool_connections=MAX_WORKERS,
+                                                       pool_maxsize=MAX_WORKERS))
+            _clients[key] = client
+    return client
+
+
+def default_storage(project_id: str = None):
+    """Returns the storage gs:// URIs resolve to
+
+    That is LocalStorage rooted at CUSTSEGM_STORAGE_ROOT when set, to run
+    offline, else GCS.
+    """
+    root = os.getenv("CUSTSEGM_STORAGE_ROOT")
+    if root:
+        return LocalStorage(root)
+    return GCSStorage(project_id)
+
+
+def _ranges(size: int, chunk_size: int):
+    return [(start, min(start + chunk_size, size)) for start in range(0, size, chunk_size)]
+
+
+class GCSStorage:
+    """Google Cloud Storage, through the client shared by the process
+
+    Large objects are downloaded as ranges, and uploaded as parts composed
+    into one object, in MAX_WORKERS parallel transfers.
+    """
+
+    def __init__(self, project_id: str = None, chunk_size: int = CHUNK_SIZE):
+        self.project_id = project_id
+        self.chunk_size = chunk_size
+
+
+    @property
+    def client(self):
+        return shared_client(self.project_id)
+
+
+    def stat(self, uri: str) -> Optional[ObjectInfo]:
+        """Returns the current generation and digest of an object, or None
+        """
+        bucket, name = split_uri(uri)
+        blob = self.client.bucket(bucket).get_blob(name)
+        if blob is None:
+            return None
+        return ObjectInfo(uri, str(blob.generation), blob.md5_hash, blob.size)
+
+
+    def open(self, uri: str) -> BinaryIO:
+        """Returns a file object streaming the content of an object
+        """
+        bucket, name = split_uri(uri)
+        logging.debug(f"Streaming {uri}")
+        return self.client.bucket(bucket).blob(name).open("rb", chunk_size=self.chunk_size)
+
+
+    def download(self, info: ObjectInfo, filename: str) -> None:
+        """Downloads the generation of an object described by info
+        """
+        bucket, name = split_uri(info.uri)
+        logging.debug(f"Downloading {info.uri}#{info.generation} to local file {filename}")
+        blob = self.client.bucket(bucket).blob(name, generation=int(info.generation))
+        if info.size <= self.chunk_size:
+            blob.download_to_filename(filename)
+            return
+
+        with open(filename, "wb") as f:
+            f.truncate(info.size)
+            fd = f.fileno()
+
+            def download_range(start_end):
+                start, end = start_end
+                # Range ends are inclusive
+                os.pwrite(fd, blob.download_as_bytes(start=start, end=end - 1), start)
+
+            with ThreadPoolExecutor(MAX_WORKERS) as pool:
+                list(pool.map(download_range, _ranges(info.size, self.chunk_size)))
+
+
+    def upload(self, filename: str, uri: str) -> None:
+        """Uploads a local file to an object
+        """
+        bucket_name, name = split_uri(uri)
+        logging.debug(f"Uploading local file {filename} to {uri}")
+        bucket = self.client.bucket(bucket_name)
+        size = os.path.getsize(filename)
+        if size <= self.chunk_size:
+            bucket.blob(name).upload_from_filename(filename)
+            return
+
+        part_size = max(self.chunk_size, -(-size // MAX_COMPOSE_PARTS))
+        parts = [bucket.blob(f"{name}.part-{i:02d}")
+                 for i in range(len(_ranges(size, part_size)))]
+
+        def upload_part(part_range):
+            part, (start, end) = part_range
+            with open(filename, "rb") as f:
+                f.seek(start)
+                part.upload_from_string(f.read(end - start))
+
+        try:
+            with ThreadPoolExecutor(MAX_WORKERS) as pool:
+                list(pool.map(upload_part, zip(parts, _ranges(size, part_size))))
+            bucket.blob(name).compose(parts)
+        finally:
+            for part in parts:
+                try:
+                    part.delete()
+                except Exception as e:
+                    logging.warning(f"Could not delete upload part {part.name}: {e}")
+
+
+class LocalStorage:
+    """Stand-in for GCS keeping gs://bucket/name objects in root/bucket/name
+
+    The generation of an object is the modification time of its file.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+
+    def path(self, uri: str) -> str:
+        bucket, name = split_uri(uri)
+        return os.path.join(self.root, bucket, name)
+
+
+    def stat(self, uri: str) -> Optional[ObjectInfo]:
+        path = self.path(uri)
+        if not os.path.isfile(path):
+            return None
+        st = os.stat(path)
+        return ObjectInfo(uri, str(st.st_mtime_ns), md5_of(path), st.st_size)
+
+
+    def open(self, uri: str) -> BinaryIO:
+        return open(self.path(uri), "rb")
+
+
+    def download(self, info: ObjectInfo, filename: str) -> None:
+        logging.debug(f"Copying {info.uri}#{info.generation} to local file {filename}")
+        shutil.copyfile(self.path(info.uri), filename)
+
+
+    def upload(self, filename: str, uri: str) -> None:
+        """Copies a local file to an object, replacing it at once
+        """
+        path = self.path(uri)
+        logging.debug(f"Copying local file {filename} to {uri}")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, partial = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".upload-")
+        os.close(fd)
+        try:
+            shutil.copyfile(filename, partial)
+            os.replace(partial, path)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
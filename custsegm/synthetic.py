@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+"""Synthetic marketing_campaign-shaped data, for offline tests and benchmarks
+"""
+
+import numpy as np
+import pandas as pd
+
+
+EDUCATION = {
+    "Graduation": 0.50,
+    "PhD": 0.22,
+    "Master": 0.16,
+    "2n Cycle": 0.09,
+    "Basic": 0.03,
+}
+
+MARITAL_STATUS = {
+    "Married": 0.386,
+    "Together": 0.259,
+    "Single": 0.214,
+    "Divorced": 0.104,
+    "Widow": 0.034,
+    "Alone": 0.001,
+    "Absurd": 0.001,
+    "YOLO": 0.001,
+}
+
+
+def make_customers(n: int, random_state: int = 0) -> pd.DataFrame:
+    """Returns n raw customer rows with the columns of marketing_campaign.tsv
+    """
+    rng = np.random.RandomState(random_state)
+
+    def choice(distribution):
+        labels = list(distribution)
+        p = np.array([distribution[label] for label in labels])
+        return rng.choice(labels, size=n, p=p / p.sum())
+
+    income = np.clip(rng.normal(52000, 21000, n), 1730, 666666).round()
+    income[rng.rand(n) < 0.01] = np.nan
+
+    year_birth = rng.randint(1940, 1997, n)
+    year_birth[rng.rand(n) < 0.002] = 1899
+
+    first = np.datetime64("2012-07-30")
+    enrolled = first + rng.randint(0, 700, n).astype("timedelta64[D]")
+    dt_customer = pd.to_datetime(enrolled).strftime("%d-%m-%Y")
+
+    data = {
+        "ID": rng.permutation(n * 5)[:n],
+        "Year_Birth": year_birth,
+        "Education": choice(EDUCATION),
+        "Marital_Status": choice(MARITAL_STATUS),
+        "Income": income,
+        "Kidhome": rng.choice([0, 1, 2], n, p=[0.58, 0.40, 0.02]),
+        "Teenhome": rng.choice([0, 1, 2], n, p=[0.52, 0.46, 0.02]),
+        "Dt_Customer": dt_customer,
+        "Recency": rng.randint(0, 100, n),
+        "MntWines": rng.exponential(300, n).astype(int),
+        "MntFruits": rng.exponential(26, n).astype(int),
+        "MntMeatProducts": rng.exponential(166, n).astype(int),
+        "MntFishProducts": rng.exponential(37, n).astype(int),
+        "MntSweetProducts": rng.exponential(27, n).astype(int),
+        "MntGoldProds": rng.exponential(44, n).astype(int),
+        "NumDealsPurchases": rng.poisson(2.3, n),
+        "NumWebPurchases": rng.poisson(4.1, n),
+        "NumCatalogPurchases": rng.poisson(2.7, n),
+        "NumStorePurchases": rng.poisson(5.8, n),
+        "NumWebVisitsMonth": rng.poisson(5.3, n),
+        "AcceptedCmp3": (rng.rand(n) < 0.07).astype(int),
+        "AcceptedCmp4": (rng.rand(n) < 0.07).astype(int),
+        "AcceptedCmp5": (rng.rand(n) < 0.07).astype(int),
+        "AcceptedCmp1": (rng.rand(n) < 0.06).astype(int),
+        "AcceptedCmp2": (rng.rand(n) < 0.01).astype(int),
+        "Complain": (rng.rand(n) < 0.01).astype(int),
+        "Z_CostContact": np.full(n, 3),
+        "Z_Revenue": np.full(n, 11),
+        "Response": (rng.rand(n) < 0.15).astype(int),
+    }
+    return pd.DataFrame(data)
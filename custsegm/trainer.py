@@ -4,97 +4,335 @@
 """
 
 import argparse
+import json
 import logging
 import os
+import time
 import joblib
 from datetime import datetime
-from typing import List, Tuple
+from typing import Dict, List, Tuple
 
+from custsegm.artifact import export_pipeline
 from custsegm.custsegm import CustomerSegmentation
 from custsegm.dataset import Dataset
+from custsegm.drift import training_stats
+from custsegm.sampling import reservoir_sample
+from custsegm.storage import default_storage
 
+import numpy as np
 import pandas as pd
-from google.cloud.storage import Client as StorageClient, Blob
-from google.cloud.logging import Client as LogClient
+from sklearn.cluster import KMeans
+from sklearn.metrics import silhouette_score
 from sklearn.model_selection import train_test_split
 from sklearn.pipeline import Pipeline
 
 
+def fit_kmeans(X: np.ndarray,
+               n_clusters: int,
+               random_state: int,
+               silhouette_sample_size: int) -> Tuple[KMeans, Dict]:
+    """Fits one KMeans model of a sweep and scores it
+
+    The silhouette coefficient is estimated on a sample of at most
+    silhouette_sample_size rows, as it is quadratic in the number of rows.
+    """
+    started = time.perf_counter()
+    kmeans = KMeans(n_clusters=n_clusters, random_state=random_state)
+    kmeans.fit(X)
+    silhouette = silhouette_score(X, kmeans.labels_,
+                                  sample_size=min(len(X), silhouette_sample_size),
+                                  random_state=random_state)
+    # Labels are as many as the training rows, no need to ship them back
+    del kmeans.labels_
+    run = {
+        "n_clusters": n_clusters,
+        "random_state": random_state,
+        "inertia": float(kmeans.inertia_),
+        "silhouette": float(silhouette),
+        "n_iter": int(kmeans.n_iter_),
+        "seconds": time.perf_counter() - started,
+    }
+    return kmeans, run
+
+
+def parse_clusters(value: str) -> List[int]:
+    """Parses the n_clusters of a sweep, such as 2-12 or 3,4,6
+
+    Raises argparse.ArgumentTypeError for values argument parsing rejects:
+    malformed, empty ranges, or fewer than 2 clusters, which no silhouette
+    coefficient scores.
+    """
+    clusters = []
+    for part in value.split(","):
+        first, _, last = part.partition("-")
+        try:
+            first, last = int(first), int(last or first)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"invalid n_clusters: {part!r}")
+        if first > last:
+            raise argparse.ArgumentTypeError(f"empty n_clusters range: {part!r}")
+        if first < 2:
+            raise argparse.ArgumentTypeError(f"n_clusters must be at least 2: {part!r}")
+        clusters.extend(range(first, last + 1))
+    return clusters
+
+
 class Trainer:
     def __init__(self,
                  project_id: str,
                  dataset_uri: str,
-                 model_dir: str):
+                 model_dir: str,
+                 training_mode: str = "full",
+                 chunk_size: int = 100000,
+                 sweep_clusters: List[int] = None,
+                 sweep_seeds: int = 1,
+                 n_jobs: int = -1,
+                 delta_uri: str = None,
+                 sample_size: int = 100000,
+                 subsample_size: int = None,
+                 evaluate_subsample: bool = False,
+                 storage=None):
         self.project_id = project_id
         self.dataset_uri = dataset_uri
         self.model_dir = model_dir
+        self.training_mode = training_mode
+        self.chunk_size = chunk_size
+        self.sweep_clusters = sweep_clusters
+        self.sweep_seeds = sweep_seeds
+        self.n_jobs = n_jobs
+        self.delta_uri = delta_uri
+        self.sample_size = sample_size
+        self.subsample_size = subsample_size
+        self.evaluate_subsample = evaluate_subsample
+        # Shared by all the transfers of the job; a local directory offline
+        self.storage = storage or default_storage(project_id)
         logging.debug(f"Trainer" +
                       f" project_id={project_id}" +
                       f" dataset_uri={dataset_uri}" +
-                      f" model_dir={model_dir}.")
+                      f" model_dir={model_dir}" +
+                      f" training_mode={training_mode}" +
+                      f" chunk_size={chunk_size}" +
+                      f" sweep_clusters={sweep_clusters}" +
+                      f" sweep_seeds={sweep_seeds}" +
+                      f" delta_uri={delta_uri}" +
+                      f" sample_size={sample_size}" +
+                      f" subsample_size={subsample_size}" +
+                      f" evaluate_subsample={evaluate_subsample}.")
         # If you are in a live tutorial session, you might be using a shared
         # test account or project. To avoid name collisions between users on
         # resources created, you create a timestamp for each instance 
         # session, and append it onto the name of local resources you create
         TIMESTAMP = datetime.now().strftime("%Y%m%d%H%M%S")
-        self.dataset_filename = f"dataset-{TIMESTAMP}.tsv"
         self.artifact_filename = f"model-{TIMESTAMP}.joblib"
+        self.compiled_artifact_filename = f"model-{TIMESTAMP}.csgm"
+        self.previous_artifact_filename = f"previous-{TIMESTAMP}.joblib"
+        self.report_filename = f"report-{TIMESTAMP}.json"
+        self.report_name = None
 
 
     def run(self) -> None: 
         logging.info("Custom training job started...")
         
-        # Import the dataset
-        if self.dataset_uri:
-            if self.dataset_uri.startswith("gs://"):
-                self.download_dataset_from_gcs()
-
-        # Split dataset into training and test data
-        logging.debug(f"Loading dataset from local file {self.dataset_filename}")
-        train_data, test_data = Dataset.read_train_test(self.dataset_filename)
-
-        logging.debug("Fitting model")
+        # The dataset is streamed from GCS as it is parsed, not downloaded first
         trainee = CustomerSegmentation()
-        pipeline = trainee.train(train_data)
+        report = None
+        # Training data the drift of the scored rows is measured against
+        train_data = None
+        if self.training_mode == "incremental":
+            pipeline, report = self.retrain(trainee)
+            self.report_name = "retrain.json"
+        elif self.training_mode == "minibatch":
+            # Stream the dataset, which may not fit in memory
+            logging.debug(f"Streaming dataset from {self.dataset_uri}")
+            logging.debug("Fitting model with mini-batches")
+            pipeline = trainee.train_streaming(
+                lambda: Dataset.read_chunks(self.dataset_uri, self.chunk_size, self.storage))
+        elif self.subsample_size:
+            # Hold customers out by ID while streaming the dataset, keeping a
+            # uniform sample of the rest, then fit on a stratified subsample
+            # of it, optionally rated against a fit on all of it
+            train_size = max(self.subsample_size, self.sample_size)
+            logging.debug(f"Sampling {train_size} rows of {self.dataset_uri}, split by customer ID")
+            train_data, test_data = Dataset.read_split(self.dataset_uri,
+                                                       train_size=train_size,
+                                                       chunk_size=self.chunk_size,
+                                                       storage=self.storage)
+            logging.debug(f"Fitting model on a subsample of {self.subsample_size} rows")
+            pipeline, report = trainee.train_subsample(
+                train_data, self.subsample_size,
+                test_data if self.evaluate_subsample else None)
+            self.report_name = "subsample.json"
+        else:
+            # Split dataset into training and test data
+            logging.debug(f"Loading dataset from {self.dataset_uri}")
+            train_data, test_data = Dataset.read_train_test(self.dataset_uri,
+                                                            storage=self.storage)
+
+            if self.sweep_clusters:
+                logging.debug(f"Sweeping n_clusters over {self.sweep_clusters}")
+                pipeline, report = self.sweep(trainee, train_data)
+                self.report_name = "sweep.json"
+            else:
+                logging.debug("Fitting model")
+                pipeline = trainee.train(train_data)
         
+        if train_data is None:
+            # Streamed: summarize a sample of the dataset
+            train_data = reservoir_sample(Dataset.read_chunks(self.dataset_uri, self.chunk_size, self.storage),
+                                          self.sample_size)
+        logging.debug(f"Summarizing {len(train_data)} training rows")
+        pipeline.training_stats_ = training_stats(pipeline, train_data)
+
         # Save model artifact to local filesystem
         logging.debug(f"Saving fitted model to local file {self.artifact_filename}")
         joblib.dump(pipeline, self.artifact_filename)
+        logging.debug(f"Exporting fitted model to local file {self.compiled_artifact_filename}")
+        try:
+            export_pipeline(pipeline, self.compiled_artifact_filename)
+            exported = True
+        except ValueError as e:
+            logging.warning(f"Model not exported to model.csgm: {e}")
+            exported = False
+        if report is not None:
+            with open(self.report_filename, "w") as f:
+                json.dump(report, f, indent=2)
         
         # Export the model
         if self.model_dir:
             if self.model_dir.startswith("gs://"):
                 self.upload_model_to_gcs()
+                if exported:
+                    self.upload_file_to_gcs(self.compiled_artifact_filename, "model.csgm")
+                if report is not None:
+                    self.upload_file_to_gcs(self.report_filename, self.report_name)
 
         # Clean-up
-        if self.dataset_uri:
-            os.remove(self.dataset_filename)
         if self.model_dir:
             os.remove(self.artifact_filename)
+            if exported:
+                os.remove(self.compiled_artifact_filename)
+            if report is not None:
+                os.remove(self.report_filename)
 
         logging.info("Custom training job done")
 
 
-    def download_dataset_from_gcs(self) -> None:
-        """Downloads dataset from GCS
+    def retrain(self, trainee: CustomerSegmentation) -> Tuple[Pipeline, Dict]:
+        """Retrains the model found in model_dir instead of training from scratch
+
+        The clusters are refitted on a reservoir sample of sample_size rows of
+        the dataset plus the new or changed rows found at delta_uri, if any.
+        Changed customers are those of the delta whose ID is in the dataset:
+        their rows replace the sampled ones, and are not counted again in the
+        scaler statistics.
+        """
+        if self.model_dir.startswith("gs://"):
+            self.download_previous_model_from_gcs()
+            previous_filename = self.previous_artifact_filename
+        else:
+            previous_filename = os.path.join(self.model_dir, "model.joblib")
+        logging.debug(f"Loading previous model from local file {previous_filename}")
+        previous = joblib.load(previous_filename)
+
+        delta = None
+        if self.delta_uri:
+            logging.debug(f"Loading new or changed rows from {self.delta_uri}")
+            delta = Dataset.read(self.delta_uri, storage=self.storage)
+
+        logging.debug(f"Sampling {self.sample_size} rows of {self.dataset_uri}")
+        chunks = Dataset.read_chunks(self.dataset_uri, self.chunk_size, self.storage)
+        replaced = set()
+        if delta is not None and "ID" in delta:
+            delta_ids = set(delta["ID"])
+
+            def find_replaced(chunks):
+                for chunk in chunks:
+                    replaced.update(delta_ids.intersection(chunk["ID"]))
+                    yield chunk
+
+            chunks = find_replaced(chunks)
+        data = reservoir_sample(chunks, self.sample_size)
+        if delta is not None:
+            if replaced:
+                # Their new rows replace those sampled
+                data = data[~data["ID"].isin(replaced)]
+            data = pd.concat([data, delta], ignore_index=True)
+
+        logging.debug(f"Fitting model from previous model, {len(replaced)} customers changed")
+        pipeline, report = trainee.train_incremental(data, previous, delta, replaced)
+        logging.info(f"Centroids moved by at most {report['max_centroid_shift']:.4f} "
+                     f"standard deviations")
+
+        if self.model_dir.startswith("gs://"):
+            os.remove(self.previous_artifact_filename)
+        return pipeline, report
+
+
+    def sweep(self,
+              trainee: CustomerSegmentation,
+              train_data: pd.DataFrame,
+              silhouette_sample_size: int = 10000) -> Tuple[Pipeline, Dict]:
+        """Fits KMeans for every n_clusters in sweep_clusters and sweep_seeds seeds
+
+        The data is preprocessed and scaled once, then the models are fitted
+        in n_jobs worker processes sharing the scaled data (joblib memory-maps
+        it rather than copying it to every worker). The pipeline with the best
+        silhouette coefficient is returned along with a report of all runs.
+        """
+        transformer, scaler, X = trainee.fit_preprocessing(train_data)
+
+        started = time.perf_counter()
+        grid = [(k, seed) for k in self.sweep_clusters for seed in range(self.sweep_seeds)]
+        fitted = joblib.Parallel(n_jobs=self.n_jobs)(
+            joblib.delayed(fit_kmeans)(X, k, 42 + seed, silhouette_sample_size)
+            for k, seed in grid)
+        elapsed = time.perf_counter() - started
+
+        runs = [run for _, run in fitted]
+        best = max(range(len(fitted)),
+                   key=lambda i: (runs[i]["silhouette"], -runs[i]["inertia"]))
+        logging.info(f"Best of {len(runs)} runs in {elapsed:.1f}s: {runs[best]}")
+
+        pipeline = trainee.assemble(transformer, scaler, fitted[best][0])
+        report = {
+            "n_rows": len(X),
+            "seconds": elapsed,
+            "best": runs[best],
+            "runs": runs,
+        }
+        return pipeline, report
+
+
+    def download_previous_model_from_gcs(self) -> None:
+        """Downloads the pipeline currently in the model directory in GCS
         """
-        # Download dataset from Cloud Storage
-        storage_path = self.dataset_uri
-        logging.debug(f"Downloading dataset from GCS bucket {storage_path} to local file {self.dataset_filename}")
-        client = StorageClient()
-        blob = Blob.from_string(storage_path, client=client)
-        blob.download_to_filename(self.dataset_filename)
+        storage_path = os.path.join(self.model_dir, "model.joblib")
+        self.download_file_from_gcs(storage_path, self.previous_artifact_filename)
+
+
+    def download_file_from_gcs(self, storage_path: str, filename: str) -> None:
+        """Downloads a GCS object to a local file
+        """
+        logging.debug(f"Downloading GCS object {storage_path} to local file {filename}")
+        info = self.storage.stat(storage_path)
+        if info is None:
+            raise FileNotFoundError(f"No such object: {storage_path}")
+        self.storage.download(info, filename)
 
 
     def upload_model_to_gcs(self) -> None:
         """Uploads trained pipeline to GCS
         """
         # Upload model artifact to Cloud Storage
-        storage_path = os.path.join(self.model_dir, "model.joblib") # file name required by Vertex AI
-        logging.debug(f"Uploading model artifact from local file {self.artifact_filename} to GCS bucket {storage_path}")
-        client = StorageClient()
-        blob = Blob.from_string(storage_path, client=client)
-        blob.upload_from_filename(self.artifact_filename)
+        self.upload_file_to_gcs(self.artifact_filename, "model.joblib") # file name required by Vertex AI
+
+
+    def upload_file_to_gcs(self, filename: str, name: str) -> None:
+        """Uploads a local file to the model directory in GCS
+        """
+        storage_path = os.path.join(self.model_dir, name)
+        logging.debug(f"Uploading local file {filename} to GCS bucket {storage_path}")
+        self.storage.upload(filename, storage_path)
 
 
 # Define all the command line arguments your model can accept for training
@@ -107,7 +345,70 @@ if __name__ == "__main__":
         help="GCP project id for cloud logging.",
         type=str
     )
+    parser.add_argument(
+        "--training_mode",
+        help="full: fit in memory; minibatch: stream the dataset in chunks; " +
+             "incremental: refit the model in model_dir on a sample plus new rows.",
+        choices=["full", "minibatch", "incremental"],
+        default="full",
+        type=str
+    )
+    parser.add_argument(
+        "--chunk_size",
+        help="Number of rows per chunk in minibatch and incremental training modes.",
+        default=100000,
+        type=int
+    )
+    parser.add_argument(
+        "--sweep_clusters",
+        help="n_clusters to sweep over, e.g. 2-12 or 3,4,6, keeping the best model.",
+        type=parse_clusters
+    )
+    parser.add_argument(
+        "--sweep_seeds",
+        help="Number of random seeds to fit for every n_clusters of the sweep.",
+        default=1,
+        type=int
+    )
+    parser.add_argument(
+        "--n_jobs",
+        help="Number of worker processes of the sweep, -1 for one per CPU core.",
+        default=-1,
+        type=int
+    )
+    parser.add_argument(
+        "--delta_uri",
+        help="GCS URI of the new or changed rows, in incremental training mode.",
+        type=str
+    )
+    parser.add_argument(
+        "--sample_size",
+        help="Number of dataset rows sampled in incremental training mode, and " +
+             "that subsamples are drawn from with --subsample_size.",
+        default=100000,
+        type=int
+    )
+    parser.add_argument(
+        "--subsample_size",
+        help="Fit on a stratified subsample of this many rows (full training mode).",
+        type=int
+    )
+    parser.add_argument(
+        "--evaluate_subsample",
+        help="Also fit on all the rows sampled, reporting the accuracy of the subsample " +
+             "model against it in subsample.json.",
+        action="store_true"
+    )
     args = parser.parse_args()
+    if args.subsample_size is not None:
+        if args.subsample_size < 1:
+            parser.error("--subsample_size must be positive")
+        if args.training_mode != "full":
+            parser.error("--subsample_size is for the full training mode only")
+        if args.sweep_clusters:
+            parser.error("--subsample_size and --sweep_clusters cannot be combined")
+    elif args.evaluate_subsample:
+        parser.error("--evaluate_subsample requires --subsample_size")
 
     # Explicit project selection:
     # See: https://cloud.google.com/vertex-ai/docs/training/code-requirements
@@ -117,6 +418,7 @@ if __name__ == "__main__":
     cloud_logging_project_id = args.cloud_logging_project_id or project_id
     if cloud_logging_project_id:
         # Set up the GCP logger
+        from google.cloud.logging import Client as LogClient
         client = LogClient(project=cloud_logging_project_id)
         client.setup_logging(log_level=logging.INFO)
     else:
@@ -146,5 +448,14 @@ if __name__ == "__main__":
     logging.debug(f"AIP_TRAINING_DATA_URI={AIP_TRAINING_DATA_URI}")
     logging.debug(f"AIP_MODEL_DIR={AIP_MODEL_DIR}")
 
-    trainer = Trainer(project_id, AIP_TRAINING_DATA_URI, AIP_MODEL_DIR)
+    trainer = Trainer(project_id, AIP_TRAINING_DATA_URI, AIP_MODEL_DIR,
+                      training_mode=args.training_mode,
+                      chunk_size=args.chunk_size,
+                      sweep_clusters=args.sweep_clusters,
+                      sweep_seeds=args.sweep_seeds,
+                      n_jobs=args.n_jobs,
+                      delta_uri=args.delta_uri,
+                      sample_size=args.sample_size,
+                      subsample_size=args.subsample_size,
+                      evaluate_subsample=args.evaluate_subsample)
     trainer.run()
\ No newline at end of file
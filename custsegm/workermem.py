@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+"""Memory taken by the workers of the prediction service, forked with or without the app preloaded
+"""
+
+import gc
+import json
+import logging
+import multiprocessing
+import os
+from typing import Dict, Sequence
+
+# Configurations measured: whether the app is created before forking the
+# workers, and whether the objects created so far are frozen (gc.freeze)
+CONFIGURATIONS = {
+    "no_preload": (False, False),
+    "preload": (True, False),
+    "preload_freeze": (True, True),
+}
+
+# Memory counters of /proc/<pid>/smaps_rollup (Linux 4.14+) reported, in MiB
+FIELDS = ("Rss", "Pss", "Shared_Clean", "Shared_Dirty", "Private_Clean", "Private_Dirty")
+
+
+def memory(pid: int = None) -> Dict[str, float]:
+    """Returns the memory counters of a process, this one by default, in MiB
+
+    Pss is the process' share of the memory it maps: the pages shared by n
+    processes count for 1/n in each. Private pages are those only it maps.
+    """
+    counters = {}
+    with open(f"/proc/{pid or 'self'}/smaps_rollup") as smaps:
+        for line in smaps:
+            field, _, value = line.partition(":")
+            if field in FIELDS:
+                counters[field] = int(value.split()[0]) / 1024
+    counters["Private"] = counters["Private_Clean"] + counters["Private_Dirty"]
+    return counters
+
+
+def _serve(app, model: str, body: str, requests: int):
+    if app is None:
+        from app.app import create_app
+        from custsegm.predictor import Predictor
+
+        app = create_app(Predictor(os.path.dirname(model) or ".", model))
+    client = app.test_client()
+    for _ in range(requests):
+        response = client.post("/predict", data=body, content_type="application/json")
+        if "predictions" not in response.get_json():
+            raise RuntimeError(f"/predict failed: {response.get_json()}")
+    gc.collect()
+
+
+def measure(model: str,
+            body: str,
+            workers: int = 4,
+            requests: int = 100,
+            preload: bool = True,
+            freeze: bool = True) -> Dict:
+    """Forks workers, which each post body to /predict requests times
+
+    With preload, this process creates the app, loading the model, before
+    forking, as gunicorn.conf.py has gunicorn do; otherwise each worker
+    creates its own. The memory of every process is measured once all the
+    workers have served their requests, so that their pages are shared as
+    when serving side by side.
+    """
+    app = None
+    collecting = gc.isenabled()
+    if preload:
+        from app.app import create_app
+        from custsegm.predictor import Predictor
+
+        if freeze:
+            gc.disable()
+        app = create_app(Predictor(os.path.dirname(model) or ".", model), preload=True)
+        if freeze:
+            gc.freeze()
+
+    ready_read, ready_write = os.pipe()
+    release_read, release_write = os.pipe()
+    pids = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                os.close(ready_read)
+                os.close(release_write)
+                gc.enable()
+                _serve(app, model, body, requests)
+                os.write(ready_write, b"+")
+                # Alive until measured
+                os.read(release_read, 1)
+                status = 0
+            except BaseException:
+                logging.exception("Worker failed")
+                os.write(ready_write, b"!")
+            finally:
+                os._exit(status)
+        pids.append(pid)
+    os.close(ready_write)
+    os.close(release_read)
+
+    try:
+        signals = b""
+        while len(signals) < workers:
+            chunk = os.read(ready_read, workers)
+            if not chunk:
+                break
+            signals += chunk
+        if signals != b"+" * workers:
+            raise RuntimeError("Worker failed")
+        master = memory()
+        per_worker = [memory(pid) for pid in pids]
+    finally:
+        os.close(release_write)
+        os.close(ready_read)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        if freeze:
+            gc.unfreeze()
+        if collecting:
+            gc.enable()
+
+    mean = {field: sum(m[field] for m in per_worker) / workers for field in per_worker[0]}
+    result = {
+        "preload": preload,
+        "freeze": freeze,
+        "workers": workers,
+        "requests": requests,
+        "master_mb": master,
+        "worker_mb": mean,
+        # Memory the master and its workers take together
+        "total_pss_mb": master["Pss"] + sum(m["Pss"] for m in per_worker),
+    }
+    logging.info(f"preload={preload} freeze={freeze}: {mean['Private']:.1f} MiB private "
+                 f"per worker, {result['total_pss_mb']:.1f} MiB in all")
+    return result
+
+
+def run(model: str,
+        configurations: Sequence[str] = tuple(CONFIGURATIONS),
+        workers: int = 4,
+        requests: int = 100,
+        request_rows: int = 100) -> Dict:
+    """Measures every configuration, each in a fresh interpreter
+
+    The requests are of request_rows synthetic customers.
+    """
+    from custsegm.synthetic import make_customers
+
+    for name in configurations:
+        if name not in CONFIGURATIONS:
+            raise ValueError(f"Unknown configuration: {name}")
+    records = json.loads(make_customers(request_rows).dropna().to_json(orient="records"))
+    body = json.dumps({"instances": records})
+
+    results = {}
+    for name in configurations:
+        preload, freeze = CONFIGURATIONS[name]
+        with multiprocessing.get_context("spawn").Pool(1) as pool:
+            results[name] = pool.apply(measure, (model, body, workers, requests, preload, freeze))
+    return {"model": model, "request_rows": request_rows, "results": results}
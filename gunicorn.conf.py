@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+"""Gunicorn configuration of the prediction service, read from the working directory
+
+The app, and so the model, is created and warmed up once, in the master
+process, then the workers are forked from it: they share its pages
+(Python modules, pandas and numpy state, the model) copy-on-write, rather
+than each importing and loading its own copy. Measure the memory each
+worker takes with python -m custsegm workermem.
+"""
+
+import gc
+import os
+
+from app.app import start_worker
+
+wsgi_app = "app.app:create_app(preload=True)"
+preload_app = True
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5050')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+threads = int(os.getenv("THREADS", "8"))
+# Cloud Run handles instance scaling
+timeout = 0
+
+# No collections while the app is created: freed objects would leave holes
+# in the pages to be shared, which the workers would then fill in, copying them
+gc.disable()
+
+
+def pre_fork(server, worker):
+    # Out of the collector's reach: collections in the workers would write
+    # the headers of the objects created so far, copying their pages
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    gc.enable()
+
+
+def post_worker_init(worker):
+    # Background threads of the app, per worker as forking does not copy them
+    start_worker(worker.wsgi)
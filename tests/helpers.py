@@ -0,0 +1,72 @@
+# tests/helpers.py
+
+"""Fixtures shared by the test modules
+"""
+
+import unittest
+import json
+import os
+import tempfile
+import joblib
+from custsegm.artifact import export_pipeline
+from custsegm.custsegm import CustomerSegmentation
+from custsegm.predictor import Predictor
+from custsegm.synthetic import make_customers
+
+
+class TrainedModelTestCase(unittest.TestCase):
+    """Test cases of a model trained on synthetic customers, once per class
+
+    The model is saved to model_path in tmp_dir, as MODEL_FILENAME (a
+    model.joblib or model.csgm), and served by a ready predictor. raw holds
+    SAMPLE_ROWS other customers, without missing values, and data holds them
+    preprocessed.
+    """
+    MODEL_FILENAME = "model.joblib"
+    SAMPLE_ROWS = 50
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        cls.model_path = os.path.join(cls.tmp_dir.name, cls.MODEL_FILENAME)
+        cls.segmentation = CustomerSegmentation(as_of_year=2021)
+        cls.pipeline = cls.segmentation.train(make_customers(2000))
+        if cls.MODEL_FILENAME.endswith(".csgm"):
+            export_pipeline(cls.pipeline, cls.model_path)
+        else:
+            joblib.dump(cls.pipeline, cls.model_path)
+
+        cls.raw = make_customers(cls.SAMPLE_ROWS, random_state=1).dropna()
+        cls.data = cls.segmentation.preprocess(cls.raw)
+
+        cls.predictor = Predictor(cls.tmp_dir.name, cls.model_path)
+        cls.predictor.ready()
+
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp_dir.cleanup()
+
+
+async def request(app, method, path, body=b""):
+    """Sends an HTTP request to the ASGI app, returning the response start
+    message and the response body
+    """
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    await app({"type": "http", "method": method, "path": path}, receive, send)
+    return sent[0], sent[1]["body"]
+
+
+async def call(app, method, path, body=b""):
+    """Sends an HTTP request to the ASGI app, returning the response status
+    and JSON payload
+    """
+    start, content = await request(app, method, path, body)
+    return start["status"], json.loads(content)
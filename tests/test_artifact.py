@@ -0,0 +1,42 @@
+# tests/test_artifact.py
+
+import json
+import os
+from custsegm.artifact import FORMAT_VERSION, read_artifact
+from custsegm.predictor import Predictor
+from tests import helpers
+
+
+class ArtifactTestCase(helpers.TrainedModelTestCase):
+    MODEL_FILENAME = "model.csgm"
+
+    def test_read_artifact(self):
+        artifact = read_artifact(ArtifactTestCase.model_path)
+        self.assertEqual(artifact.header["format_version"], FORMAT_VERSION)
+        self.assertEqual(artifact.compiled.centroids.shape, self.pipeline["km"].cluster_centers_.shape)
+        self.assertFalse(artifact.compiled.centroids.flags.writeable)  # memory-mapped
+        self.assertEqual(artifact.feature_engine.reference_date_,
+                         self.pipeline.feature_engine_.reference_date_)
+
+        data = self.segmentation.preprocess(ArtifactTestCase.raw)
+        self.assertListEqual(artifact.compiled.predict(data).tolist(),
+                             self.pipeline.predict(data).tolist())
+
+
+    def test_predictor_loads_artifact(self):
+        predictor = Predictor(ArtifactTestCase.tmp_dir.name, ArtifactTestCase.model_path)
+        predictor.ready()
+        self.assertIsNone(predictor.pipeline)
+
+        instances = json.loads(ArtifactTestCase.raw.to_json(orient="records"))
+        predictions = predictor.predict_from_json(json.dumps({"instances": instances}))
+        self.assertListEqual(predictions["predictions"],
+                             self.segmentation.predict(ArtifactTestCase.raw).tolist())
+
+
+    def test_reject_other_files(self):
+        path = os.path.join(ArtifactTestCase.tmp_dir.name, "model.joblib")
+        with open(path, "wb") as f:
+            f.write(b"\x80\x04not an artifact")
+        with self.assertRaises(ValueError):
+            read_artifact(path)
@@ -0,0 +1,110 @@
+# tests/test_batching.py
+
+import unittest
+import asyncio
+import json
+import threading
+import numpy as np
+from app.asgi import create_app
+from custsegm.batching import MicroBatcher, Overloaded
+from tests import helpers
+
+
+def _double(columns):
+    return np.asarray(columns["x"], dtype=np.float64) * 2
+
+
+class MicroBatcherTestCase(unittest.TestCase):
+    def test_concurrent_requests_are_batched(self):
+        batches = []
+
+        def score(columns):
+            batches.append(len(columns["x"]))
+            return _double(columns)
+
+        async def run():
+            sut = MicroBatcher(score, max_batch_size=64, max_wait=0.01)
+            requests = [{"x": [i, i + 0.5]} for i in range(100)]
+            results = await asyncio.gather(*[sut.submit(r) for r in requests])
+            await sut.stop()
+            return requests, results, sut.metrics()
+
+        requests, results, metrics = asyncio.run(run())
+        for request, result in zip(requests, results):
+            self.assertListEqual(result.tolist(), [2 * x for x in request["x"]])
+        self.assertLess(len(batches), 10)
+        self.assertLessEqual(max(batches), 64 + 1)
+        self.assertEqual(metrics["requests"], 100)
+        self.assertEqual(metrics["rows"], 200)
+        self.assertEqual(metrics["batches"], len(batches))
+
+
+    def test_bad_request_fails_alone(self):
+        async def run():
+            sut = MicroBatcher(_double, max_wait=0.01)
+            results = await asyncio.gather(sut.submit({"x": [1, 2]}),
+                                           sut.submit({"x": ["a"]}),
+                                           sut.submit({"x": [3]}),
+                                           return_exceptions=True)
+            await sut.stop()
+            return results
+
+        good, bad, other = asyncio.run(run())
+        self.assertListEqual(good.tolist(), [2, 4])
+        self.assertIsInstance(bad, ValueError)
+        self.assertListEqual(other.tolist(), [6])
+
+
+    def test_full_queue_rejects_requests(self):
+        release = threading.Event()
+
+        def score(columns):
+            release.wait(5)
+            return _double(columns)
+
+        async def run():
+            sut = MicroBatcher(score, max_batch_size=1, max_wait=0, max_queue=2)
+            first = asyncio.ensure_future(sut.submit({"x": [1]}))
+            await asyncio.sleep(0.05)  # first one being scored, queue empty
+            queued = [asyncio.ensure_future(sut.submit({"x": [i]})) for i in range(2)]
+            await asyncio.sleep(0)
+            with self.assertRaises(Overloaded):
+                await sut.submit({"x": [9]})
+            release.set()
+            results = await asyncio.gather(first, *queued)
+            metrics = sut.metrics()
+            await sut.stop()
+            return results, metrics
+
+        results, metrics = asyncio.run(run())
+        self.assertEqual(len(results), 3)
+        self.assertEqual(metrics["rejected"], 1)
+        self.assertEqual(metrics["max_queue_depth"], 2)
+
+
+class AsgiTestCase(helpers.TrainedModelTestCase):
+    MODEL_FILENAME = "model.csgm"
+    SAMPLE_ROWS = 100
+
+    def test_predict(self):
+        records = json.loads(AsgiTestCase.data.to_json(orient="records"))
+        bodies = [json.dumps({"instances": records[i:i + 3]}).encode()
+                  for i in range(0, len(records), 3)]
+        bodies.append(json.dumps({"instances": records[:3], "parameters": {"top_n": 2}}).encode())
+        expected = [AsgiTestCase.predictor.predict_from_json(body) for body in bodies]
+
+        async def run():
+            app = create_app(AsgiTestCase.predictor, max_wait=0.01)
+            responses = await asyncio.gather(*[helpers.call(app, "POST", "/predict", body)
+                                               for body in bodies])
+            metrics = await helpers.call(app, "GET", "/batching")
+            bad = await helpers.call(app, "POST", "/predict", b"{")
+            missing = await helpers.call(app, "GET", "/nowhere")
+            await app.batcher.stop()
+            return responses, metrics, bad, missing
+
+        responses, metrics, bad, missing = asyncio.run(run())
+        self.assertListEqual([payload for _, payload in responses], expected)
+        self.assertLess(metrics[1]["batches"], len(bodies))
+        self.assertIn("error", bad[1])
+        self.assertEqual(missing[0], 404)
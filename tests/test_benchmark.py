@@ -0,0 +1,34 @@
+# tests/test_benchmark.py
+
+import unittest
+from custsegm import benchmark
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    def test_run_in_process(self):
+        report = benchmark.run(["preprocess", "pipeline_predict", "vertex_ai", "flask"],
+                               [300], repeat=1, request_rows=50, isolate=False)
+        self.assertEqual([result["case"] for result in report["results"]],
+                         ["preprocess", "pipeline_predict", "vertex_ai", "flask"])
+        for result in report["results"]:
+            self.assertGreater(result["rows"], 250)
+            self.assertGreater(result["rows_per_sec"], 0)
+            self.assertGreater(result["peak_rss_mb"], 0)
+        self.assertListEqual(benchmark.compare(report, report), [])
+
+
+    def test_compare_flags_regressions(self):
+        baseline = {"results": [
+            {"case": "train", "rows": 1000, "rows_per_sec": 1000.0, "peak_rss_mb": 100.0},
+            {"case": "flask", "rows": 1000, "rows_per_sec": 1000.0, "peak_rss_mb": 100.0},
+        ]}
+        report = {"results": [
+            {"case": "train", "rows": 1000, "rows_per_sec": 850.0, "peak_rss_mb": 130.0},
+            {"case": "flask", "rows": 1000, "rows_per_sec": 700.0, "peak_rss_mb": 90.0},
+            {"case": "flask", "rows": 5000, "rows_per_sec": 1.0, "peak_rss_mb": 900.0},
+        ]}
+        regressions = benchmark.compare(report, baseline, tolerance=0.2)
+        self.assertListEqual([(r["case"], r["metric"]) for r in regressions],
+                             [("train", "peak_rss_mb"), ("flask", "rows_per_sec")])
+        self.assertAlmostEqual(regressions[1]["change"], -0.3)
+        self.assertListEqual(benchmark.parse_rows("1k, 10K,2.5m,42"), [1000, 10000, 2500000, 42])
@@ -0,0 +1,100 @@
+# tests/test_cache.py
+
+import unittest
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from custsegm.artifact import export_pipeline
+from custsegm.cache import ArtifactCache
+from custsegm.custsegm import CustomerSegmentation
+from custsegm.predictor import Predictor
+from custsegm.storage import LocalStorage
+from custsegm.synthetic import make_customers
+
+
+class CountingStorage(LocalStorage):
+    """LocalStorage logging its downloads to a file, slowly"""
+
+    def download(self, info, filename):
+        with open(os.path.join(self.root, "downloads.log"), "a") as log:
+            log.write(f"{info.uri}\n")
+        time.sleep(0.2)
+        super().download(info, filename)
+
+
+    def downloads(self):
+        path = os.path.join(self.root, "downloads.log")
+        if not os.path.isfile(path):
+            return 0
+        with open(path) as log:
+            return len(log.readlines())
+
+
+def _fetch(root, cache_dir, uri):
+    return ArtifactCache(cache_dir, CountingStorage(root)).fetch(uri)
+
+
+class ArtifactCacheTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.segmentation = CustomerSegmentation(as_of_year=2021)
+        cls.pipeline = cls.segmentation.train(make_customers(2000))
+
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp_dir, "gcs")
+        self.cache_dir = os.path.join(self.tmp_dir, "cache")
+        os.makedirs(os.path.join(self.root, "bucket", "models"))
+        self.uri = "gs://bucket/models/model.csgm"
+        self.storage = CountingStorage(self.root)
+        export_pipeline(ArtifactCacheTestCase.pipeline, self.storage.path(self.uri))
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+    def test_fetch_downloads_once_per_generation(self):
+        cache = ArtifactCache(self.cache_dir, self.storage)
+        path = cache.fetch(self.uri)
+        self.assertEqual(cache.fetch(self.uri), path)
+        self.assertEqual(self.storage.downloads(), 1)
+
+        # A new generation of the object replaces the cached copy
+        os.utime(self.storage.path(self.uri), ns=(0, 10 ** 18))
+        new_path = cache.fetch(self.uri)
+        self.assertNotEqual(new_path, path)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(self.storage.downloads(), 2)
+
+
+    def test_corrupt_copy_is_downloaded_again(self):
+        cache = ArtifactCache(self.cache_dir, self.storage)
+        path = cache.fetch(self.uri)
+        with open(path, "r+b") as f:
+            f.seek(100)
+            f.write(b"corrupt")
+        self.assertEqual(cache.fetch(self.uri), path)
+        self.assertEqual(self.storage.downloads(), 2)
+        with self.assertRaises(FileNotFoundError):
+            cache.fetch("gs://bucket/models/model.joblib")
+
+
+    def test_processes_share_one_download(self):
+        with multiprocessing.Pool(4) as pool:
+            paths = pool.starmap(_fetch, [(self.root, self.cache_dir, self.uri)] * 4)
+        self.assertEqual(len(set(paths)), 1)
+        self.assertEqual(self.storage.downloads(), 1)
+
+
+    def test_predictor_fetches_through_cache(self):
+        predictor = Predictor("gs://bucket/models", None,
+                              storage=self.storage, cache_dir=self.cache_dir)
+        predictor.ready()
+        self.assertTrue(predictor.artifact_filename.startswith(self.cache_dir))
+        raw = make_customers(20, random_state=1).dropna()
+        self.assertListEqual(predictor.predict_from_columns(raw).tolist(),
+                             ArtifactCacheTestCase.segmentation.predict(raw).tolist())
@@ -0,0 +1,73 @@
+# tests/test_centroid_index.py
+
+import unittest
+import json
+import numpy as np
+from custsegm.centroid_index import CentroidIndex, scores
+from custsegm.compiled import compile_pipeline
+from custsegm.custsegm import CustomerSegmentation
+from custsegm.synthetic import make_customers
+from tests import helpers
+
+
+class CentroidIndexTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        segmentation = CustomerSegmentation(as_of_year=2021)
+        cls.pipeline = segmentation.train(make_customers(3000), n_clusters=200)
+        cls.data = segmentation.preprocess(make_customers(5000, random_state=1).dropna())
+        cls.X = cls.pipeline[:-1].transform(cls.data)
+
+
+    def test_assigns_like_pipeline(self):
+        compiled = compile_pipeline(CentroidIndexTestCase.pipeline)
+        self.assertTrue(compiled.build_index())
+        self.assertIsNotNone(compiled.index)
+        np.testing.assert_array_equal(compiled.predict(CentroidIndexTestCase.data),
+                                      CentroidIndexTestCase.pipeline.predict(CentroidIndexTestCase.data))
+
+
+    def test_ties_are_broken_like_brute_force(self):
+        centroids = CentroidIndexTestCase.pipeline["km"].cluster_centers_
+        sut = CentroidIndex(centroids, block_values=1000)
+        # Midpoints of pairs of centroids, equally far from both
+        X = (centroids[:100] + centroids[100:]) / 2
+        np.testing.assert_array_equal(sut.assign(X),
+                                      scores(X, centroids, (centroids ** 2).sum(axis=1)).argmin(axis=1))
+
+
+    def test_search_nearest_first(self):
+        kmeans = CentroidIndexTestCase.pipeline["km"]
+        X = CentroidIndexTestCase.X
+        expected = np.sort(kmeans.transform(X), axis=1)
+        sut = CentroidIndex(kmeans.cluster_centers_)
+        for n in (1, 3, 12):
+            labels, distances = sut.search(X, n)
+            self.assertEqual(labels.shape, (len(X), n))
+            np.testing.assert_array_equal(labels[:, 0], kmeans.predict(X))
+            np.testing.assert_allclose(distances, expected[:, :n], rtol=1e-9, atol=1e-9)
+            np.testing.assert_allclose(
+                distances, np.linalg.norm(X[:, None, :] - kmeans.cluster_centers_[labels], axis=2),
+                rtol=1e-9, atol=1e-9)
+
+
+class TopNTestCase(helpers.TrainedModelTestCase):
+    def test_top_n_predictions(self):
+        instances = json.loads(TopNTestCase.data.to_json(orient="records"))
+        body = json.dumps({"instances": instances, "parameters": {"top_n": 2}})
+        predictions = TopNTestCase.predictor.predict_from_json(body)["predictions"]
+
+        distances = TopNTestCase.pipeline[-1].transform(TopNTestCase.pipeline[:-1].transform(TopNTestCase.data))
+        self.assertListEqual([p["segment"] for p in predictions],
+                             TopNTestCase.pipeline.predict(TopNTestCase.data).tolist())
+        for prediction, row in zip(predictions, distances):
+            self.assertListEqual(prediction["nearest"], np.argsort(row)[:2].tolist())
+            np.testing.assert_allclose(prediction["distances"], np.sort(row)[:2], rtol=1e-9)
+
+
+    def test_invalid_top_n(self):
+        instances = json.loads(TopNTestCase.data.head(2).to_json(orient="records"))
+        for top_n in (0, "3", 1.5):
+            with self.assertRaises(ValueError):
+                TopNTestCase.predictor.predict_from_vertex_ai({"instances": instances,
+                                                               "parameters": {"top_n": top_n}})
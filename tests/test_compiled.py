@@ -0,0 +1,48 @@
+# tests/test_compiled.py
+
+import unittest
+import copy
+import numpy as np
+from custsegm.custsegm import CustomerSegmentation
+from custsegm.compiled import CompiledPipeline, compile_pipeline
+from custsegm.synthetic import make_customers
+
+
+class CompiledPipelineTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.segmentation = CustomerSegmentation(as_of_year=2021)
+        cls.pipeline = cls.segmentation.train(make_customers(2000))
+        cls.data = cls.segmentation.preprocess(make_customers(5000, random_state=1),
+                                               training=True)
+
+
+    def test_predicts_like_pipeline(self):
+        sut = compile_pipeline(CompiledPipelineTestCase.pipeline)
+        self.assertIsNotNone(sut)
+        np.testing.assert_array_equal(sut.predict(CompiledPipelineTestCase.data),
+                                      CompiledPipelineTestCase.pipeline.predict(CompiledPipelineTestCase.data))
+
+
+    def test_predicts_from_columns(self):
+        sut = compile_pipeline(CompiledPipelineTestCase.pipeline)
+        data = CompiledPipelineTestCase.data
+        columns = {c: data[c].to_numpy() for c in reversed(data.columns)}
+        np.testing.assert_array_equal(sut.predict(columns),
+                                      CompiledPipelineTestCase.pipeline.predict(data))
+
+
+    def test_unknown_category(self):
+        sut = CompiledPipeline.from_pipeline(CompiledPipelineTestCase.pipeline)
+        data = CompiledPipelineTestCase.data.head(2).copy()
+        data["Education"] = ["Graduate", "Kindergarten"]
+        with self.assertRaises(ValueError):
+            sut.predict(data)
+
+
+    def test_pipeline_failing_to_predict_is_not_compiled(self):
+        pipeline = copy.deepcopy(CompiledPipelineTestCase.pipeline)
+        # As unpickled from an older scikit-learn
+        del pipeline["tr"].transformers_[0][1]._missing_indices
+        with self.assertLogs(level="WARNING"):
+            self.assertIsNone(compile_pipeline(pipeline))
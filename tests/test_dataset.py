@@ -0,0 +1,56 @@
+# tests/test_dataset.py
+
+import unittest
+import os
+import shutil
+import tempfile
+import pandas as pd
+from custsegm.dataset import COLUMNS, Dataset
+from custsegm.synthetic import make_customers
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+class DatasetTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.raw = make_customers(1000)
+        cls.tsv = os.path.join(cls.tmp_dir, "dataset.tsv")
+        cls.raw.to_csv(cls.tsv, sep="\t", index=False)
+
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+
+    def test_read_prunes_and_narrows_columns(self):
+        data = Dataset.read(DatasetTestCase.tsv)
+        self.assertListEqual(list(data.columns), [c for c in DatasetTestCase.raw.columns if c in COLUMNS])
+        self.assertEqual(data["Kidhome"].dtype, "int8")
+        self.assertEqual(data["Education"].dtype, "category")
+        self.assertTrue(pd.api.types.is_datetime64_dtype(data["Dt_Customer"]))
+        self.assertLess(data.memory_usage(deep=True).sum(),
+                        DatasetTestCase.raw.memory_usage(deep=True).sum() / 3)
+
+        chunks = list(Dataset.read_chunks(DatasetTestCase.tsv, 300))
+        self.assertListEqual([len(chunk) for chunk in chunks], [300, 300, 300, 100])
+        pd.testing.assert_frame_equal(pd.concat(chunks).astype({"Marital_Status": "category"}),
+                                      data, check_categorical=False)
+        self.assertEqual(len(Dataset.read(DatasetTestCase.tsv, columns=None).columns), 29)
+
+
+    @unittest.skipUnless(pyarrow, "pyarrow is not installed")
+    def test_convert(self):
+        data = Dataset.read(DatasetTestCase.tsv)
+        for name in ("dataset.parquet", "dataset.arrow"):
+            path = os.path.join(DatasetTestCase.tmp_dir, name)
+            self.assertEqual(Dataset.convert(DatasetTestCase.tsv, path, chunk_size=400), 1000)
+            converted = Dataset.read(path)
+            pd.testing.assert_frame_equal(converted, data, check_categorical=False, check_dtype=False)
+            self.assertEqual(converted["Kidhome"].dtype, "int8")
+            self.assertEqual(sum(len(chunk) for chunk in Dataset.read_chunks(path, 300)), 1000)
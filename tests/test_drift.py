@@ -0,0 +1,116 @@
+# tests/test_drift.py
+
+import unittest
+import os
+import tempfile
+import joblib
+import numpy as np
+from custsegm.artifact import export_pipeline
+from custsegm.custsegm import CustomerSegmentation
+from custsegm.drift import PSI_THRESHOLD, DriftMonitor, training_stats
+from custsegm.prediction_cache import PredictionCache
+from custsegm.predictor import Predictor
+from custsegm.synthetic import make_customers
+
+
+class DriftMonitorTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        segmentation = CustomerSegmentation(as_of_year=2021)
+        train = make_customers(5000)
+        cls.pipeline = segmentation.train(train)
+        cls.stats = training_stats(cls.pipeline, train)
+        cls.live = make_customers(5000, random_state=1).dropna()
+        cls.features = cls.pipeline.feature_engine_.transform(cls.live)
+
+
+    def scaled(self, features):
+        X = DriftMonitorTestCase.pipeline[:-1].transform(features)
+        return X, DriftMonitorTestCase.pipeline[-1].predict(X)
+
+
+    def test_no_drift(self):
+        sut = DriftMonitor(DriftMonitorTestCase.stats)
+        X, labels = self.scaled(DriftMonitorTestCase.features)
+        for start in range(0, len(X), 700):
+            sut.update(X[start:start + 700], labels[start:start + 700])
+
+        report = sut.report()
+        self.assertEqual(report["rows"], len(X))
+        self.assertListEqual(report["drifted"], [])
+        self.assertLess(report["max_psi"], 0.05)
+        income = report["features"]["Income"]
+        self.assertLess(abs(income["mean_shift"]), 0.1)
+        self.assertAlmostEqual(sum(report["features"]["Education"]["fractions"].values()), 1)
+        self.assertAlmostEqual(sum(report["clusters"]["fractions"]), 1)
+
+
+    def test_running_moments(self):
+        sut = DriftMonitor(DriftMonitorTestCase.stats)
+        X, labels = self.scaled(DriftMonitorTestCase.features)
+        for start in range(0, len(X), 333):
+            sut.update(X[start:start + 333], labels[start:start + 333])
+        report = sut.report()
+        layout = list(DriftMonitorTestCase.stats["features"])
+        for name in sut.numeric:
+            column = X[:, layout.index(name)]
+            self.assertAlmostEqual(report["features"][name]["mean"], column.mean(), places=9)
+            self.assertAlmostEqual(report["features"][name]["std"], column.std(), places=9)
+        # Quantiles of a continuous feature, from its sketch
+        income = X[:, layout.index("Income")]
+        for q, quantile in report["features"]["Income"]["quantiles"].items():
+            self.assertAlmostEqual(np.mean(income <= quantile), float(q), delta=0.02)
+
+
+    def test_drift(self):
+        sut = DriftMonitor(DriftMonitorTestCase.stats)
+        features = DriftMonitorTestCase.features.copy()
+        features["Income"] *= 1.5
+        features["Education"] = "Postgraduate"
+        X, labels = self.scaled(features)
+        sut.update(X, labels)
+
+        report = sut.report()
+        self.assertIn("Income", report["drifted"])
+        self.assertIn("Education", report["drifted"])
+        self.assertNotIn("Recency", report["drifted"])
+        self.assertGreater(report["features"]["Income"]["psi"], PSI_THRESHOLD)
+        self.assertGreater(report["features"]["Income"]["mean_shift"], 0.5)
+        self.assertEqual(report["features"]["Education"]["fractions"]["Postgraduate"], 1)
+
+
+    def test_predictor_reports_drift(self):
+        pipeline = DriftMonitorTestCase.pipeline
+        pipeline.training_stats_ = DriftMonitorTestCase.stats
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            joblib.dump(pipeline, os.path.join(tmp_dir, "model.joblib"))
+            export_pipeline(pipeline, os.path.join(tmp_dir, "model.csgm"))
+            for name in ("model.joblib", "model.csgm"):
+                predictor = Predictor(tmp_dir, os.path.join(tmp_dir, name))
+                predictor.ready()
+                self.assertEqual(predictor.drift_report()["rows"], 0)
+                predictor.predict_from_dataframe(DriftMonitorTestCase.live.head(100))
+                predictor.predict_from_dataframe(DriftMonitorTestCase.features.head(50))
+                report = predictor.drift_report()
+                self.assertEqual(report["rows"], 150)
+                self.assertTrue(report["version"].startswith(name))
+
+
+    def test_cached_rows_count_in_clusters(self):
+        pipeline = DriftMonitorTestCase.pipeline
+        pipeline.training_stats_ = DriftMonitorTestCase.stats
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            export_pipeline(pipeline, os.path.join(tmp_dir, "model.csgm"))
+            predictor = Predictor(tmp_dir, os.path.join(tmp_dir, "model.csgm"),
+                                  prediction_cache=PredictionCache(1000))
+            predictor.ready()
+            rows = DriftMonitorTestCase.live.head(100)
+            labels = predictor.predict_from_dataframe(rows)
+            predictor.predict_from_dataframe(rows)
+            report = predictor.drift_report()
+
+        self.assertEqual(report["rows"], 100)
+        self.assertEqual(report["cached_rows"], 100)
+        np.testing.assert_allclose(report["clusters"]["fractions"],
+                                   np.bincount(labels, minlength=len(report["clusters"]["fractions"])) / 100)
+        self.assertAlmostEqual(sum(report["features"]["Education"]["fractions"].values()), 1)
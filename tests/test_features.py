@@ -0,0 +1,116 @@
+# tests/test_features.py
+
+import unittest
+import json
+import warnings
+import numpy as np
+import pandas as pd
+from custsegm.custsegm import CustomerSegmentation
+from custsegm.features import FEATURE_COLUMNS, FeatureEngine, parse_dates
+from custsegm.synthetic import make_customers
+
+
+def baseline_preprocess(data: pd.DataFrame, as_of_year: int, training: bool = False) -> pd.DataFrame:
+    """The pandas transformation FeatureEngine replaced, with each date parsed
+    on its own
+    """
+    if training:
+        data = data.dropna()
+    data = data.copy()
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        data["Dt_Customer"] = data["Dt_Customer"].map(pd.to_datetime)
+    data["Customer_For"] = (data["Dt_Customer"].max() - data["Dt_Customer"]).dt.days
+    data["Age"] = as_of_year - data["Year_Birth"]
+    data["Spent"] = data[["MntWines", "MntFruits", "MntMeatProducts",
+                          "MntFishProducts", "MntSweetProducts", "MntGoldProds"]].sum(axis=1)
+    data["Living_With"] = data["Marital_Status"].replace(
+        {"Married": "Partner", "Together": "Partner", "Absurd": "Alone", "Widow": "Alone",
+         "YOLO": "Alone", "Divorced": "Alone", "Single": "Alone"})
+    data["Children"] = data["Kidhome"] + data["Teenhome"]
+    data["Family_Size"] = data["Living_With"].replace({"Alone": 1, "Partner": 2}) + data["Children"]
+    data["Is_Parent"] = np.where(data.Children > 0, 1, 0)
+    data["Education"] = data["Education"].replace(
+        {"Basic": "Undergraduate", "2n Cycle": "Undergraduate", "Graduation": "Graduate",
+         "Master": "Postgraduate", "PhD": "Postgraduate"})
+    if training:
+        data = data[(data["Age"] < 90) & (data["Income"] < 600000)]
+    return data[FEATURE_COLUMNS]
+
+
+class FeatureEngineTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with open("input_10_pre.json") as f:
+            cls.raw_instances = pd.DataFrame(json.load(f)["instances"])
+        with open("input_10_post.json") as f:
+            cls.preprocessed_instances = pd.DataFrame(json.load(f)["instances"])
+
+
+    def test_parse_dates_like_format_inference(self):
+        dates = parse_dates(np.array(["07-05-2014", "16-02-2014", "2014-05-07", np.nan],
+                                     dtype=object))
+        expected = np.array(["2014-07-05", "2014-02-16", "2014-05-07", "NaT"],
+                            dtype="datetime64[D]")
+        np.testing.assert_array_equal(dates, expected)
+
+
+    def test_preprocess_for_prediction(self):
+        sut = CustomerSegmentation(as_of_year=2021)
+        data = sut.preprocess(FeatureEngineTestCase.raw_instances)
+        self.assertListEqual(list(data.columns), FEATURE_COLUMNS)
+        self.assertListEqual(data["Education"].tolist(),
+                             FeatureEngineTestCase.preprocessed_instances["Education"].tolist())
+        self.assertListEqual(data["Living_With"].tolist(),
+                             FeatureEngineTestCase.preprocessed_instances["Living_With"].tolist())
+        self.assertListEqual(data["Spent"].tolist(),
+                             FeatureEngineTestCase.preprocessed_instances["Spent"].tolist())
+
+
+    def test_derived_columns_like_baseline(self):
+        raw = make_customers(1000)
+        for training in (False, True):
+            with self.subTest(training=training):
+                sut = FeatureEngine(as_of_year=2021)
+                if training:
+                    data = sut.fit_transform(raw, age_cap=90, income_cap=600000)
+                else:
+                    data = sut.fit(raw).transform(raw)
+                pd.testing.assert_frame_equal(data, baseline_preprocess(raw, 2021, training),
+                                              check_dtype=False)
+
+        # input_10_post.json counts Customer_For from the latest date of the
+        # whole training set, not of these 10 customers
+        data = FeatureEngine(as_of_year=2021).fit(FeatureEngineTestCase.raw_instances) \
+            .transform(FeatureEngineTestCase.raw_instances)
+        expected = FeatureEngineTestCase.preprocessed_instances[FEATURE_COLUMNS]
+        pd.testing.assert_frame_equal(data.drop(columns="Customer_For"),
+                                      expected.drop(columns="Customer_For"),
+                                      check_dtype=False)
+        self.assertEqual(set(expected["Customer_For"] - data["Customer_For"]), {153})
+
+
+    def test_preprocess_for_training_drops_missing_values_and_outliers(self):
+        raw = make_customers(1000)
+        sut = CustomerSegmentation(as_of_year=2021)
+        data = sut.preprocess(raw, training=True)
+        self.assertListEqual(list(data.columns), FEATURE_COLUMNS)
+        self.assertFalse(data.isna().any().any())
+        self.assertTrue((data["Age"] < sut.age_cap).all())
+        self.assertEqual(data.index.tolist(),
+                         raw[raw["Income"].notna() & (raw["Year_Birth"] > 1900)].index.tolist())
+
+
+    def test_features_do_not_depend_on_batch(self):
+        raw = make_customers(1000)
+        sut = CustomerSegmentation(as_of_year=2021)
+        pipeline = sut.train(raw)
+        self.assertIsNotNone(pipeline.feature_engine_.reference_date_)
+
+        sut = CustomerSegmentation(pipeline)
+        batch = FeatureEngineTestCase.raw_instances
+        in_batch = sut.preprocess(batch)
+        one_by_one = pd.concat([sut.preprocess(batch.iloc[[i]]) for i in range(len(batch))])
+        pd.testing.assert_frame_equal(in_batch, one_by_one)
+        self.assertListEqual(sut.predict(batch).tolist(),
+                             [sut.predict(batch.iloc[[i]])[0] for i in range(len(batch))])
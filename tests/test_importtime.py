@@ -0,0 +1,31 @@
+# tests/test_importtime.py
+
+import unittest
+from custsegm.importtime import SERVING_FORBIDDEN, measure, parse, summarize
+
+
+class ImportTimeTestCase(unittest.TestCase):
+    def test_parse_and_summarize(self):
+        lines = [
+            "import time: self [us] | cumulative | imported package",
+            "import time:       120 |        120 |     numpy.core",
+            "import time:       300 |        420 |   numpy",
+            "import time:        80 |        500 | custsegm.compiled",
+            "Traceback (most recent call last):",
+        ]
+        records = parse(lines)
+        self.assertEqual([r.module for r in records], ["numpy.core", "numpy", "custsegm.compiled"])
+        self.assertEqual([r.depth for r in records], [2, 1, 0])
+
+        summary = summarize(records, forbidden=["numpy"])
+        self.assertEqual(summary["total_ms"], 0.5)
+        self.assertEqual(summary["packages"][0], {"package": "numpy", "ms": 0.42})
+        self.assertEqual(summary["forbidden_imported"], ["numpy.core", "numpy"])
+
+
+    def test_serving_import_graph(self):
+        records = measure("import custsegm.predictor")
+        # pandas only comes with feature engines, or models that are not compiled
+        summary = summarize(records, forbidden=SERVING_FORBIDDEN + ["pandas"])
+        self.assertListEqual(summary["forbidden_imported"], [])
+        self.assertNotIn("sklearn", [p["package"] for p in summary["packages"]])
@@ -0,0 +1,82 @@
+# tests/test_metrics.py
+
+import unittest
+import asyncio
+import json
+from app.asgi import create_app
+from custsegm import metrics
+from custsegm.metrics import MetricsRegistry
+from tests import helpers
+
+
+def _samples(text):
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    return samples
+
+
+class MetricsRegistryTestCase(unittest.TestCase):
+    def test_render(self):
+        sut = MetricsRegistry()
+        sut.counter("requests_total", "Requests.").inc(3)
+        histogram = sut.histogram("latency_seconds", "Latency.", buckets=(0.1, 1.0), stage="a")
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+        sut.callback("queue_depth", "gauge", "Queue depth.", lambda: 7)
+
+        text = sut.render()
+        self.assertIn("# TYPE latency_seconds histogram", text)
+        samples = _samples(text)
+        self.assertEqual(samples["requests_total"], 3)
+        self.assertEqual(samples['latency_seconds_bucket{stage="a",le="0.1"}'], 2)
+        self.assertEqual(samples['latency_seconds_bucket{stage="a",le="1.0"}'], 3)
+        self.assertEqual(samples['latency_seconds_bucket{stage="a",le="+Inf"}'], 4)
+        self.assertEqual(samples['latency_seconds_count{stage="a"}'], 4)
+        self.assertAlmostEqual(samples['latency_seconds_sum{stage="a"}'], 2.65)
+        self.assertEqual(samples["queue_depth"], 7)
+
+
+class ServingMetricsTestCase(helpers.TrainedModelTestCase):
+    MODEL_FILENAME = "model.csgm"
+    SAMPLE_ROWS = 10
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.body = json.dumps({"instances": json.loads(cls.raw.to_json(orient="records"))})
+
+
+    def test_stages_are_timed(self):
+        before = _samples(metrics.REGISTRY.render())
+        ServingMetricsTestCase.predictor.predict_from_json(ServingMetricsTestCase.body)
+        after = _samples(metrics.REGISTRY.render())
+
+        for stage in ("decode", "preprocess", "transform", "assign"):
+            name = f'custsegm_stage_seconds_count{{stage="{stage}"}}'
+            self.assertEqual(after[name] - before.get(name, 0), 1, stage)
+        self.assertEqual(after["custsegm_requests_total"] - before["custsegm_requests_total"], 1)
+
+
+    def test_metrics_route(self):
+        async def run():
+            app = create_app(ServingMetricsTestCase.predictor)
+            # Encoding is timed for prediction responses only
+            for path in ("/model", "/drift", "/batching"):
+                await helpers.call(app, "GET", path)
+            await helpers.call(app, "POST", "/predict", ServingMetricsTestCase.body.encode())
+            response = await helpers.request(app, "GET", "/metrics")
+            await app.batcher.stop()
+            return response
+
+        encodes = 'custsegm_stage_seconds_count{stage="encode"}'
+        before = _samples(metrics.REGISTRY.render()).get(encodes, 0)
+        start, content = asyncio.run(run())
+        self.assertEqual(_samples(metrics.REGISTRY.render())[encodes] - before, 1)
+        self.assertEqual(start["status"], 200)
+        self.assertIn((b"content-type", b"text/plain; version=0.0.4"), start["headers"])
+        samples = _samples(content.decode("utf-8"))
+        self.assertIn("custsegm_batcher_queue_depth", samples)
+        self.assertIn("custsegm_model_reloads_total", samples)
@@ -0,0 +1,106 @@
+# tests/test_prediction_cache.py
+
+import unittest
+import os
+import tempfile
+import time
+import numpy as np
+from custsegm.artifact import export_pipeline
+from custsegm.custsegm import CustomerSegmentation
+from custsegm.prediction_cache import ENTRY_BYTES, PredictionCache
+from custsegm.predictor import Predictor
+from custsegm.synthetic import make_customers
+
+
+class PredictionCacheTestCase(unittest.TestCase):
+    def test_lru_eviction_and_invalidation(self):
+        sut = PredictionCache(max_entries=3)
+        keys = PredictionCache.keys({"x": np.arange(5.0)})
+        sut.store("v1", keys, np.arange(5))  # store without lookup: other version
+        self.assertEqual(sut.metrics()["entries"], 0)
+
+        labels, missed = sut.lookup("v1", keys[:3])
+        self.assertTrue(missed.all())
+        sut.store("v1", keys[:3], np.array([0, 1, 2]))
+        sut.lookup("v1", keys[:1])  # keys[0] most recently used
+        sut.store("v1", keys[3:4], np.array([3]))
+
+        labels, missed = sut.lookup("v1", keys[:4])
+        self.assertListEqual(missed.tolist(), [False, True, False, False])
+        self.assertListEqual(labels[~missed].tolist(), [0, 2, 3])
+        metrics = sut.metrics()
+        self.assertEqual(metrics["evictions"], 1)
+        self.assertEqual(metrics["hits"], 4)
+
+        labels, missed = sut.lookup("v2", keys[:4])
+        self.assertTrue(missed.all())
+        self.assertEqual(sut.metrics()["invalidations"], 1)
+        self.assertEqual(sut.metrics()["entries"], 0)
+
+
+    def test_memory_cap_and_ttl(self):
+        keys = PredictionCache.keys({"x": np.arange(10.0), "y": np.array(list("abcdefghij"), dtype=object)})
+        self.assertEqual(len(set(keys)), 10)
+        sut = PredictionCache(max_bytes=4 * ENTRY_BYTES, ttl=0.05)
+        sut.lookup("v1", keys)
+        sut.store("v1", keys, np.zeros(10, dtype=np.int32))
+        self.assertEqual(sut.metrics()["entries"], 4)
+
+        time.sleep(0.1)
+        labels, missed = sut.lookup("v1", keys)
+        self.assertTrue(missed.all())
+        self.assertEqual(sut.metrics()["expirations"], 4)
+
+
+    def test_predictor_scores_cache_misses_only(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            artifact_path = os.path.join(tmp_dir, "model.csgm")
+            segmentation = CustomerSegmentation(as_of_year=2021)
+            export_pipeline(segmentation.train(make_customers(2000)), artifact_path)
+            sut = Predictor(tmp_dir, artifact_path, prediction_cache=PredictionCache())
+            sut.ready()
+
+            raw = make_customers(200, random_state=1).dropna()
+            first, second = raw.iloc[:100], raw.iloc[50:]
+            expected = segmentation.predict(second).tolist()
+            sut.predict_from_columns({c: first[c].to_numpy() for c in first})
+            predictions = sut.predict_from_columns({c: second[c].to_numpy() for c in second})
+
+        self.assertListEqual(predictions.tolist(), expected)
+        metrics = sut.model_info()["prediction_cache"]
+        self.assertEqual(metrics["hits"], 50)
+        self.assertEqual(metrics["misses"], 100 + len(second) - 50)
+
+
+    def test_rows_are_keyed_by_features(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            artifact_path = os.path.join(tmp_dir, "model.csgm")
+            segmentation = CustomerSegmentation(as_of_year=2021)
+            export_pipeline(segmentation.train(make_customers(2000)), artifact_path)
+            sut = Predictor(tmp_dir, artifact_path, prediction_cache=PredictionCache())
+            sut.ready()
+
+            raw = make_customers(100, random_state=1).dropna()
+            data = segmentation.preprocess(raw)
+            expected = segmentation.predict(raw).tolist()
+            # Raw rows, with fields the model does not use
+            self.assertListEqual(sut.predict_from_columns(raw).tolist(), expected)
+            # The same customers preprocessed, scored by the compiled model
+            self.assertListEqual(sut.predict_from_columns(data).tolist(), expected)
+            shuffled = data.iloc[::-1][data.columns[::-1]]
+            self.assertListEqual(sut.predict_from_columns(shuffled).tolist(), expected[::-1])
+
+        metrics = sut.model_info()["prediction_cache"]
+        self.assertEqual(metrics["misses"], len(raw))
+        self.assertEqual(metrics["hits"], 2 * len(raw))
+
+
+    def test_keys(self):
+        columns = {"x": np.array([1.0, 2.0, 1.0]), "y": np.array(["a", "b", "a"], dtype=object)}
+        keys = PredictionCache.keys(columns)
+        self.assertEqual(keys.dtype, np.uint64)
+        self.assertEqual(keys[0], keys[2])
+        self.assertNotEqual(keys[0], keys[1])
+        self.assertListEqual(PredictionCache.keys(columns, ["y", "x"]).tolist(),
+                             PredictionCache.keys({"y": columns["y"], "x": columns["x"]}).tolist())
+        self.assertNotEqual(PredictionCache.keys(columns, ["x"])[0], keys[0])
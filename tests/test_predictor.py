@@ -0,0 +1,184 @@
+# tests/test_predictor.py
+
+import unittest
+import json
+import os
+import tempfile
+import time
+import joblib
+import numpy as np
+import pandas as pd
+from custsegm import metrics
+from custsegm.artifact import export_pipeline
+from custsegm.custsegm import CustomerSegmentation
+from custsegm.predictor import Predictor
+from custsegm.synthetic import make_customers
+from tests import helpers
+
+
+class PredictorTestCase(helpers.TrainedModelTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.expected = cls.pipeline.predict(cls.data).tolist()
+
+
+    def test_predict_with_vertex_ai_payload(self):
+        instances = json.loads(PredictorTestCase.data.to_json(orient="records"))
+        for payload in ({"instances": instances, "parameters": []}, instances):
+            vertex_ai_output = PredictorTestCase.predictor.predict_from_vertex_ai(payload)
+            self.assertListEqual(vertex_ai_output["predictions"], PredictorTestCase.expected)
+
+
+    def test_predict_from_json_layouts(self):
+        data = PredictorTestCase.data
+        bodies = [
+            data.to_json(orient="records"),
+            json.dumps({"instances": json.loads(data.to_json(orient="records"))}),
+            json.dumps({"instances": json.loads(data.to_json(orient="values"))}),
+            json.dumps({"columns": {c: json.loads(data[c].to_json(orient="values")) for c in data}}),
+            json.dumps({"instances": json.loads(data[data.columns[::-1]].to_json(orient="values")),
+                        "columns": list(data.columns[::-1])}),
+        ]
+        shuffled = json.loads(data.to_json(orient="records"))
+        shuffled[0] = dict(reversed(list(shuffled[0].items())))
+        bodies.append(json.dumps({"instances": shuffled}))
+        for body in bodies:
+            vertex_ai_output = PredictorTestCase.predictor.predict_from_json(body.encode())
+            self.assertListEqual(vertex_ai_output["predictions"], PredictorTestCase.expected)
+
+
+    def test_predict_from_instances_with_extra_fields(self):
+        # Some instances start with a field the model does not use, in varying order
+        instances = json.loads(PredictorTestCase.data.to_json(orient="records"))
+        for i, instance in enumerate(instances):
+            if i % 2 == 0:
+                instances[i] = {"ID": i, **dict(reversed(list(instance.items()))), "Note": [i]}
+        vertex_ai_output = PredictorTestCase.predictor.predict_from_json(
+            json.dumps({"instances": instances}))
+        self.assertListEqual(vertex_ai_output["predictions"], PredictorTestCase.expected)
+
+
+    def test_predict_from_raw_instances(self):
+        body = json.dumps({"instances": json.loads(PredictorTestCase.raw.to_json(orient="records"))})
+        vertex_ai_output = PredictorTestCase.predictor.predict_from_json(body)
+        self.assertListEqual(vertex_ai_output["predictions"], PredictorTestCase.expected)
+
+
+    def test_predict_from_malformed_json(self):
+        instances = json.loads(PredictorTestCase.data.head(2).to_json(orient="records"))
+        del instances[1]["Income"]
+        with self.assertRaises(ValueError):
+            PredictorTestCase.predictor.predict_from_json(json.dumps({"instances": instances}))
+
+        del instances[0]["Income"]
+        with self.assertRaisesRegex(ValueError, "^Column Income is missing$"):
+            PredictorTestCase.predictor.predict_from_json(json.dumps({"instances": instances}))
+        raw = PredictorTestCase.raw.drop(columns="Kidhome")
+        with self.assertRaisesRegex(ValueError, "^Column Kidhome is missing$"):
+            PredictorTestCase.predictor.predict_from_json(raw.to_json(orient="records"))
+
+
+    def test_predict_details(self):
+        pipeline = PredictorTestCase.pipeline
+        features = pipeline[:-1].transform(PredictorTestCase.data)
+        distances = np.sort(pipeline[-1].transform(features), axis=1)
+        instances = json.loads(PredictorTestCase.data.to_json(orient="records"))
+        metrics.stage("transform")  # registered, even when run alone
+        transforms = metrics._stages["transform"]
+
+        before = sum(transforms.counts)
+        predictions = PredictorTestCase.predictor.predict_from_vertex_ai(
+            {"instances": instances, "parameters": {"details": True}})["predictions"]
+        self.assertEqual(sum(transforms.counts) - before, 1)
+
+        self.assertListEqual([p["segment"] for p in predictions], PredictorTestCase.expected)
+        np.testing.assert_allclose([p["features"] for p in predictions], features, rtol=1e-9)
+        np.testing.assert_allclose([p["distance"] for p in predictions], distances[:, 0], rtol=1e-9)
+        np.testing.assert_allclose([p["margin"] for p in predictions],
+                                   distances[:, 1] - distances[:, 0], rtol=1e-9, atol=1e-12)
+        for p in predictions:
+            self.assertTrue(0.5 <= p["membership"] <= 1)
+            self.assertNotIn("nearest", p)
+        self.assertEqual(len(predictions[0]["features"]),
+                         len(PredictorTestCase.predictor.model_info()["features"]))
+
+        # Membership is against the runner-up, however many segments are asked for
+        top = PredictorTestCase.predictor.predict_from_vertex_ai(
+            {"instances": instances, "parameters": {"details": True, "top_n": 4}})["predictions"]
+        self.assertListEqual([p["membership"] for p in top], [p["membership"] for p in predictions])
+
+
+class ReloadTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        cls.artifact_path = os.path.join(cls.tmp_dir.name, "model.csgm")
+        cls.raw = make_customers(2000)
+        cls.body = json.dumps({"instances": json.loads(cls.raw.head(20).dropna().to_json(orient="records"))})
+
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp_dir.cleanup()
+
+
+    def export(self, n_clusters):
+        segmentation = CustomerSegmentation(as_of_year=2021)
+        export_pipeline(segmentation.train(ReloadTestCase.raw, n_clusters=n_clusters),
+                        ReloadTestCase.artifact_path)
+
+
+    def test_reload_swaps_new_model(self):
+        self.export(4)
+        sut = Predictor(ReloadTestCase.tmp_dir.name, ReloadTestCase.artifact_path)
+        sut.ready()
+        self.assertFalse(sut.reload())
+        previous = sut.model
+
+        self.export(3)
+        self.assertTrue(sut.reload())
+        info = sut.model_info()
+        self.assertNotEqual(info["version"], previous.version)
+        self.assertEqual(info["n_clusters"], 3)
+        self.assertEqual(info["reloads"], 1)
+        # Requests which read the previous model still complete on it
+        self.assertEqual(sut.predict_from_columns(ReloadTestCase.raw.dropna(), previous).max(), 3)
+
+
+    def test_polling_local_model_dir(self):
+        # As set by AIP_MODEL_DIR: the artifact file name is not known
+        model_dir = os.path.join(ReloadTestCase.tmp_dir.name, "local")
+        os.makedirs(model_dir)
+        segmentation = CustomerSegmentation(as_of_year=2021)
+        joblib.dump(segmentation.train(ReloadTestCase.raw), os.path.join(model_dir, "model.joblib"))
+        sut = Predictor(model_dir, None)
+        sut.ready()
+        self.assertTrue(sut.model.version.startswith("model.joblib@"))
+        sut.start_polling(0.05)
+        try:
+            export_pipeline(segmentation.train(ReloadTestCase.raw, n_clusters=3),
+                            os.path.join(model_dir, "model.csgm"))
+            deadline = time.monotonic() + 10
+            while sut.reloads == 0 and time.monotonic() < deadline:
+                time.sleep(0.05)
+            self.assertTrue(sut.model.version.startswith("model.csgm@"))
+            self.assertEqual(sut.model_info()["n_clusters"], 3)
+        finally:
+            sut.stop_polling()
+
+
+    def test_polling_reloads_while_serving(self):
+        self.export(4)
+        sut = Predictor(ReloadTestCase.tmp_dir.name, ReloadTestCase.artifact_path)
+        sut.ready()
+        sut.start_polling(0.05)
+        try:
+            self.export(2)
+            deadline = time.monotonic() + 10
+            while sut.reloads == 0 and time.monotonic() < deadline:
+                self.assertEqual(len(sut.predict_from_json(ReloadTestCase.body)["predictions"]),
+                                 len(json.loads(ReloadTestCase.body)["instances"]))
+            self.assertEqual(sut.model_info()["n_clusters"], 2)
+        finally:
+            sut.stop_polling()
@@ -0,0 +1,144 @@
+# tests/test_registry.py
+
+import unittest
+import asyncio
+import gc
+import json
+import os
+import tempfile
+import tracemalloc
+import joblib
+from app.asgi import create_app
+from custsegm.artifact import export_pipeline
+from custsegm.custsegm import CustomerSegmentation
+from custsegm.predictor import Predictor
+from custsegm.registry import MODEL_OVERHEAD_BYTES, ModelNotFound, ModelRegistry, footprint
+from custsegm.synthetic import make_customers
+from tests import helpers
+
+
+class ModelRegistryTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        segmentation = CustomerSegmentation(as_of_year=2021)
+        cls.pipelines = {}
+        for i, name in enumerate(("brand-a", "brand-b", "region_c")):
+            os.makedirs(os.path.join(cls.tmp_dir.name, name))
+            pipeline = segmentation.train(make_customers(1000, random_state=i), n_clusters=3 + i)
+            if name == "region_c":
+                joblib.dump(pipeline, os.path.join(cls.tmp_dir.name, name, "model.joblib"))
+            else:
+                export_pipeline(pipeline, os.path.join(cls.tmp_dir.name, name, "model.csgm"))
+            cls.pipelines[name] = pipeline
+        cls.data = segmentation.preprocess(make_customers(30, random_state=9).dropna())
+
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp_dir.cleanup()
+
+
+    def test_models_are_loaded_on_first_use(self):
+        sut = ModelRegistry(ModelRegistryTestCase.tmp_dir.name)
+        self.assertEqual(sut.info()["models"], {})
+        for name, pipeline in ModelRegistryTestCase.pipelines.items():
+            predictions = sut.get(name).predict_from_dataframe(ModelRegistryTestCase.data)
+            self.assertListEqual(predictions.tolist(),
+                                 pipeline.predict(ModelRegistryTestCase.data).tolist())
+        self.assertIs(sut.get("brand-a"), sut.get("brand-a"))
+        self.assertEqual(sut.counters["loads"], 3)
+        self.assertListEqual(list(sut.info()["models"]), ["brand-b", "region_c", "brand-a"])
+
+        # Shared with the other processes mapping the artifact, not copied
+        compiled = sut.get("brand-b").compiled
+        self.assertFalse(compiled.centroids.flags.owndata)
+        self.assertFalse(compiled.centroids.flags.writeable)
+
+
+    def test_least_recently_used_are_evicted(self):
+        sizes = {}
+        for name in ModelRegistryTestCase.pipelines:
+            sut = ModelRegistry(ModelRegistryTestCase.tmp_dir.name)
+            sut.get(name)
+            sizes[name] = sut.memory
+        self.assertGreater(sizes["brand-a"], MODEL_OVERHEAD_BYTES)
+
+        # Any two models fit, not three
+        sut = ModelRegistry(ModelRegistryTestCase.tmp_dir.name, memory_budget=sum(sizes.values()) - 1)
+        sut.get("brand-a")
+        sut.get("brand-b")
+        sut.get("brand-a")
+        sut.get("region_c")
+        self.assertListEqual(list(sut.info()["models"]), ["brand-a", "region_c"])
+        self.assertEqual(sut.counters["evictions"], 1)
+        self.assertLessEqual(sut.memory, sut.memory_budget)
+        sut.get("brand-b")
+        self.assertListEqual(list(sut.info()["models"]), ["region_c", "brand-b"])
+        self.assertEqual(sut.counters["loads"], 4)
+
+        # The model just used stays, whatever its size
+        sut = ModelRegistry(ModelRegistryTestCase.tmp_dir.name, memory_budget=0)
+        sut.get("brand-a")
+        self.assertListEqual(list(sut.info()["models"]), ["brand-a"])
+        self.assertTrue(sut.evict("brand-a"))
+        self.assertFalse(sut.evict("brand-a"))
+
+
+    def test_footprint_covers_loaded_joblib_model(self):
+        # Compressed, as joblib.dump can: far smaller than the model loaded
+        model_dir = os.path.join(ModelRegistryTestCase.tmp_dir.name, "compressed")
+        os.makedirs(model_dir)
+        artifact_filename = os.path.join(model_dir, "model.joblib")
+        pipeline = CustomerSegmentation(as_of_year=2021).train(make_customers(100000))
+        joblib.dump(pipeline, artifact_filename, compress=3)
+        Predictor(model_dir, artifact_filename).ready()  # imports done
+        gc.collect()
+        tracemalloc.start()
+        try:
+            predictor = Predictor(model_dir, artifact_filename)
+            predictor.ready()
+            loaded = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+        self.assertGreater(loaded, os.path.getsize(artifact_filename) + MODEL_OVERHEAD_BYTES)
+        self.assertGreaterEqual(footprint(predictor.model), loaded)
+
+
+    def test_unknown_models(self):
+        sut = ModelRegistry(ModelRegistryTestCase.tmp_dir.name)
+        for name in ("brand-z", "../brand-a", ".", "", "brand-a/model.csgm"):
+            with self.assertRaises(ModelNotFound):
+                sut.get(name)
+        self.assertEqual(sut.counters["loads"], 0)
+
+
+    def test_asgi_routes(self):
+        sut = ModelRegistry(ModelRegistryTestCase.tmp_dir.name)
+        body = json.dumps({"instances": json.loads(ModelRegistryTestCase.data.to_json(orient="records"))})
+        incomplete = json.dumps({"instances": json.loads(
+            ModelRegistryTestCase.data.drop(columns="Income").to_json(orient="records"))})
+
+        async def run():
+            predictor = Predictor(ModelRegistryTestCase.tmp_dir.name,
+                                  os.path.join(ModelRegistryTestCase.tmp_dir.name, "brand-a", "model.csgm"))
+            predictor.ready()
+            app = create_app(predictor, registry=sut)
+            responses = [await helpers.call(app, "POST", "/models/brand-b/predict", body.encode()),
+                         await helpers.call(app, "POST", "/models/brand-z/predict", body.encode()),
+                         await helpers.call(app, "GET", "/models/brand-b"),
+                         await helpers.call(app, "GET", "/models"),
+                         await helpers.call(app, "POST", "/models/brand-b/predict", incomplete.encode())]
+            await app.batcher.stop()
+            return responses
+
+        predicted, missing, info, models, failed = asyncio.run(run())
+        self.assertEqual(predicted[0], 200)
+        self.assertListEqual(predicted[1]["predictions"],
+                             ModelRegistryTestCase.pipelines["brand-b"].predict(ModelRegistryTestCase.data).tolist())
+        self.assertEqual(missing[0], 404)
+        self.assertEqual(info[1]["n_clusters"], 4)
+        self.assertListEqual(list(models[1]["models"]), ["brand-b"])
+        # Scoring errors are not missing models
+        self.assertEqual(failed[0], 200)
+        self.assertIn("error", failed[1])
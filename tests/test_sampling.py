@@ -0,0 +1,69 @@
+# tests/test_sampling.py
+
+import unittest
+import numpy as np
+import pandas as pd
+from custsegm.sampling import in_holdout, reservoir_sample, split_chunks, stratified_sample
+
+
+class SamplingTestCase(unittest.TestCase):
+    def test_reservoir_sample_is_uniform(self):
+        data = pd.DataFrame({"ID": np.arange(1000)})
+        counts = np.zeros(len(data))
+        for seed in range(200):
+            chunks = (data.iloc[i:i + 70] for i in range(0, len(data), 70))
+            sample = reservoir_sample(chunks, 100, random_state=seed)
+            self.assertEqual(len(sample), 100)
+            self.assertTrue(sample["ID"].is_unique)
+            counts[sample["ID"].to_numpy()] += 1
+        # Every row is drawn 20 times on average, first and last chunks alike
+        self.assertAlmostEqual(counts[:100].mean(), 20, delta=3)
+        self.assertAlmostEqual(counts[-100:].mean(), 20, delta=3)
+
+
+    def test_reservoir_sample_of_small_stream(self):
+        data = pd.DataFrame({"ID": np.arange(10)})
+        sample = reservoir_sample([data.iloc[:4], data.iloc[4:]], 100)
+        self.assertListEqual(sorted(sample["ID"]), list(range(10)))
+
+
+class SplitTestCase(unittest.TestCase):
+    def test_holdout_is_deterministic_by_id(self):
+        ids = np.arange(100000)
+        holdout = in_holdout(ids, 0.1)
+        self.assertAlmostEqual(holdout.mean(), 0.1, delta=0.005)
+        self.assertListEqual(in_holdout(ids[::-1], 0.1).tolist(), holdout[::-1].tolist())
+        self.assertListEqual(in_holdout(ids.astype(np.int32), 0.1).tolist(), holdout.tolist())
+        self.assertFalse((in_holdout(ids, 0.1, salt="other") == holdout).all())
+        self.assertAlmostEqual(in_holdout(ids.astype(str), 0.2).mean(), 0.2, delta=0.005)
+        for values in (ids, ids.astype(str)):
+            self.assertTrue(in_holdout(values, 1.0).all())
+            self.assertFalse(in_holdout(values, 0.0).any())
+
+        data = pd.DataFrame({"ID": ids, "x": 1.0})
+        chunks = (data.iloc[i:i + 7000] for i in range(0, len(data), 7000))
+        train, test = split_chunks(chunks, 0.1)
+        self.assertListEqual(test["ID"].tolist(), ids[holdout].tolist())
+        self.assertEqual(len(train) + len(test), len(data))
+
+        chunks = (data.iloc[i:i + 7000] for i in range(0, len(data), 7000))
+        train, test = split_chunks(chunks, 0.1, train_size=900)
+        self.assertEqual((len(train), len(test)), (900, 100))
+        self.assertTrue(holdout[test["ID"]].all())
+        self.assertFalse(holdout[train["ID"]].any())
+
+
+    def test_stratified_sample_keeps_proportions(self):
+        rng = np.random.RandomState(0)
+        data = pd.DataFrame({
+            "Education": rng.choice(["Basic", "Graduation", "PhD"], 10000, p=[0.03, 0.67, 0.3]),
+            "Income": rng.normal(50000, 20000, 10000),
+        })
+        sample = stratified_sample(data, 1000, ["Education", "Income"])
+        self.assertEqual(len(sample), 1000)
+        self.assertTrue(sample.index.is_monotonic_increasing)
+        self.assertAlmostEqual((sample["Education"] == "Basic").sum(),
+                               (data["Education"] == "Basic").sum() / 10, delta=1)
+        quartiles = np.quantile(data["Income"], [0.25, 0.5, 0.75])
+        counts = np.bincount(np.searchsorted(quartiles, sample["Income"]))
+        self.assertTrue((np.abs(counts - 250) <= 3).all())
@@ -0,0 +1,81 @@
+# tests/test_scorer.py
+
+import os
+import pandas as pd
+from custsegm.scorer import MISSING_LABEL, Scorer
+from custsegm.synthetic import make_customers
+from tests import helpers
+
+
+class ScorerTestCase(helpers.TrainedModelTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # With missing values
+        cls.raw = make_customers(1000, random_state=1)
+        cls.input_path = os.path.join(cls.tmp_dir.name, "customers.csv")
+        cls.raw.to_csv(cls.input_path, sep="\t", index=False)
+
+        valid = cls.raw["Income"].notna()
+        cls.expected = pd.Series(MISSING_LABEL, index=cls.raw.index)
+        cls.expected[valid] = cls.segmentation.predict(cls.raw[valid])
+
+
+    def test_score_in_chunks(self):
+        output_path = os.path.join(ScorerTestCase.tmp_dir.name, "labels.csv")
+        sut = Scorer(ScorerTestCase.predictor, chunk_size=128)
+        report = sut.score(ScorerTestCase.input_path, output_path)
+        self.assertEqual(report["rows"], 1000)
+
+        labels = pd.read_csv(output_path)
+        self.assertListEqual(labels["row"].tolist(), list(range(1000)))
+        self.assertListEqual(labels["ID"].tolist(), ScorerTestCase.raw["ID"].tolist())
+        self.assertListEqual(labels["Cluster"].tolist(), ScorerTestCase.expected.tolist())
+
+
+    def test_resume(self):
+        output_path = os.path.join(ScorerTestCase.tmp_dir.name, "resumed.csv")
+        sut = Scorer(ScorerTestCase.predictor, chunk_size=100)
+        first = next(Scorer.read_chunks(ScorerTestCase.input_path, 300))
+        pd.DataFrame({"row": first.index, "ID": first["ID"], "Cluster": sut.score_chunk(first)}) \
+            .to_csv(output_path, index=False)
+
+        start_row = Scorer.rows_written(output_path)
+        self.assertEqual(start_row, 300)
+        report = sut.score(ScorerTestCase.input_path, output_path, start_row=start_row)
+        self.assertEqual(report["rows"], 700)
+
+        labels = pd.read_csv(output_path)
+        self.assertListEqual(labels["row"].tolist(), list(range(1000)))
+        self.assertListEqual(labels["Cluster"].tolist(), ScorerTestCase.expected.tolist())
+
+
+    def test_score_with_workers(self):
+        output_path = os.path.join(ScorerTestCase.tmp_dir.name, "parallel.csv")
+        sut = Scorer(ScorerTestCase.predictor, chunk_size=128)
+        report = sut.score(ScorerTestCase.input_path, output_path, start_row=100, workers=2)
+        self.assertEqual(report["rows"], 900)
+
+        labels = pd.read_csv(output_path)
+        self.assertListEqual(labels["row"].tolist(), list(range(100, 1000)))
+        self.assertListEqual(labels["ID"].tolist(), ScorerTestCase.raw["ID"].tolist()[100:])
+        self.assertListEqual(labels["Cluster"].tolist(), ScorerTestCase.expected.tolist()[100:])
+
+
+    def test_score_pq_by_row_group(self):
+        input_path = os.path.join(ScorerTestCase.tmp_dir.name, "customers.pq")
+        ScorerTestCase.raw.to_parquet(input_path, index=False, row_group_size=250)
+        shards = Scorer.plan_shards(input_path, 100, start_row=100)
+        self.assertListEqual([shard.row_group for shard in shards], [0, 1, 2, 3])
+
+        output_path = os.path.join(ScorerTestCase.tmp_dir.name, "parallel_pq.csv")
+        sut = Scorer(ScorerTestCase.predictor, chunk_size=128)
+        report = sut.score(input_path, output_path, start_row=100, workers=2)
+        self.assertEqual(report["rows"], 900)
+
+        labels = pd.read_csv(output_path)
+        self.assertListEqual(labels["row"].tolist(), list(range(100, 1000)))
+        self.assertListEqual(labels["Cluster"].tolist(), ScorerTestCase.expected.tolist()[100:])
+        chunks = pd.concat(Scorer.read_chunks(input_path, 300, start_row=100))
+        self.assertListEqual(chunks.index.tolist(), list(range(100, 1000)))
+        self.assertListEqual(chunks["ID"].tolist(), ScorerTestCase.raw["ID"].tolist()[100:])
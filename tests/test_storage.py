@@ -0,0 +1,132 @@
+# tests/test_storage.py
+
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+from custsegm.dataset import Dataset
+from custsegm.predictor import Predictor
+from custsegm.storage import GCSStorage, LocalStorage, ObjectInfo
+from custsegm.synthetic import make_customers
+from custsegm.trainer import Trainer
+
+
+class FakeBlob:
+    """Blob of a FakeBucket, supporting the calls GCSStorage makes"""
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+
+    def download_as_bytes(self, start, end):
+        self.bucket.calls.append("range")
+        return self.bucket.objects[self.name][start:end + 1]
+
+
+    def download_to_filename(self, filename):
+        self.bucket.calls.append("whole")
+        with open(filename, "wb") as f:
+            f.write(self.bucket.objects[self.name])
+
+
+    def upload_from_string(self, data):
+        self.bucket.calls.append("part")
+        self.bucket.objects[self.name] = data
+
+
+    def upload_from_filename(self, filename):
+        self.bucket.calls.append("whole")
+        with open(filename, "rb") as f:
+            self.bucket.objects[self.name] = f.read()
+
+
+    def compose(self, parts):
+        self.bucket.objects[self.name] = b"".join(self.bucket.objects[p.name] for p in parts)
+
+
+    def delete(self):
+        del self.bucket.objects[self.name]
+
+
+class FakeBucket:
+    def __init__(self):
+        self.objects = {}
+        self.calls = []
+
+
+    def blob(self, name, generation=None):
+        return FakeBlob(self, name)
+
+
+class FakeClientStorage(GCSStorage):
+    def __init__(self, chunk_size):
+        super().__init__(chunk_size=chunk_size)
+        self.fake_bucket = FakeBucket()
+
+
+    @property
+    def client(self):
+        return self
+
+
+    def bucket(self, name):
+        return self.fake_bucket
+
+
+class StorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+    def test_chunked_transfers(self):
+        sut = FakeClientStorage(chunk_size=1000)
+        data = np.random.RandomState(0).bytes(10500)
+        filename = os.path.join(self.tmp_dir, "data.bin")
+        with open(filename, "wb") as f:
+            f.write(data)
+
+        sut.upload(filename, "gs://bucket/data.bin")
+        self.assertDictEqual(sut.fake_bucket.objects, {"data.bin": data})
+        self.assertEqual(sut.fake_bucket.calls.count("part"), 11)
+
+        copy = os.path.join(self.tmp_dir, "copy.bin")
+        sut.download(ObjectInfo("gs://bucket/data.bin", "1", None, len(data)), copy)
+        with open(copy, "rb") as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(sut.fake_bucket.calls.count("range"), 11)
+        self.assertNotIn("whole", sut.fake_bucket.calls)
+
+
+    def test_train_and_serve_offline(self):
+        storage = LocalStorage(os.path.join(self.tmp_dir, "gcs"))
+        dataset = os.path.join(self.tmp_dir, "dataset.tsv")
+        make_customers(2000).to_csv(dataset, sep="\t", index=False)
+        storage.upload(dataset, "gs://bucket/data/dataset.tsv")
+
+        chunks = list(Dataset.read_chunks("gs://bucket/data/dataset.tsv", 500, storage))
+        self.assertListEqual([len(chunk) for chunk in chunks], [500] * 4)
+
+        cwd = os.getcwd()
+        os.chdir(self.tmp_dir)
+        try:
+            Trainer(None, "gs://bucket/data/dataset.tsv", "gs://bucket/model",
+                    storage=storage).run()
+        finally:
+            os.chdir(cwd)
+        self.assertIsNotNone(storage.stat("gs://bucket/model/model.joblib"))
+        self.assertIsNotNone(storage.stat("gs://bucket/model/model.csgm"))
+
+        predictor = Predictor("gs://bucket/model", None, storage=storage,
+                              cache_dir=os.path.join(self.tmp_dir, "cache"))
+        predictor.ready()
+        self.assertTrue(predictor.model.version.startswith("model.csgm#"))
+        predictions = predictor.predict_from_dataframe(make_customers(20, random_state=1).dropna())
+        self.assertTrue(set(predictions.tolist()) <= {0, 1, 2, 3})
+        # Training stats saved by the trainer
+        self.assertEqual(predictor.drift_report()["rows"], len(predictions))
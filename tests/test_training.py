@@ -0,0 +1,166 @@
+# tests/test_training.py
+
+import unittest
+import argparse
+import copy
+import os
+import tempfile
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.metrics import adjusted_rand_score
+from custsegm.custsegm import CustomerSegmentation, relabel
+from custsegm.compiled import compile_pipeline
+from custsegm.storage import LocalStorage
+from custsegm.synthetic import make_customers
+
+
+class TrainingTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.train_data = make_customers(4000)
+        cls.test_data = make_customers(1000, random_state=1).dropna()
+        cls.full = CustomerSegmentation(as_of_year=2021)
+        cls.full.train(cls.train_data)
+
+
+    def test_train_streaming(self):
+        data = TrainingTestCase.train_data
+        chunks = lambda: (data.iloc[i:i + 500] for i in range(0, len(data), 500))
+        sut = CustomerSegmentation(as_of_year=2021)
+        pipeline = sut.train_streaming(chunks, batch_size=256)
+
+        full = TrainingTestCase.full.pipeline
+        np.testing.assert_allclose(pipeline["sts"].mean_, full["sts"].mean_)
+        np.testing.assert_allclose(pipeline["sts"].scale_, full["sts"].scale_)
+        self.assertEqual(pipeline.feature_engine_.reference_date_,
+                         full.feature_engine_.reference_date_)
+        self.assertIsNotNone(compile_pipeline(pipeline))
+
+        agreement = adjusted_rand_score(TrainingTestCase.full.predict(TrainingTestCase.test_data),
+                                        sut.predict(TrainingTestCase.test_data))
+        self.assertGreater(agreement, 0.5)
+
+
+    def test_sweep(self):
+        from custsegm.trainer import Trainer
+        sut = Trainer(None, None, None, sweep_clusters=[2, 3, 4], sweep_seeds=2, n_jobs=2)
+        trainee = CustomerSegmentation(as_of_year=2021)
+        pipeline, report = sut.sweep(trainee, TrainingTestCase.train_data)
+
+        self.assertEqual(len(report["runs"]), 6)
+        best = max(run["silhouette"] for run in report["runs"])
+        self.assertEqual(report["best"]["silhouette"], best)
+        self.assertEqual(pipeline["km"].n_clusters, report["best"]["n_clusters"])
+        self.assertIs(trainee.pipeline, pipeline)
+        self.assertIsNotNone(compile_pipeline(pipeline))
+
+
+    def test_parse_clusters(self):
+        from custsegm.trainer import parse_clusters
+        self.assertListEqual(parse_clusters("2-5,8"), [2, 3, 4, 5, 8])
+        for value in ("1-8", "0", "5-3", "a-b"):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                parse_clusters(value)
+
+
+    def test_train_incremental_keeps_cluster_ids(self):
+        previous = TrainingTestCase.full.pipeline
+        delta = make_customers(500, random_state=2)
+        data = pd.concat([TrainingTestCase.train_data.sample(1000, random_state=0), delta])
+        sut = CustomerSegmentation()
+        pipeline, report = sut.train_incremental(data, previous, delta)
+
+        self.assertEqual(sut.as_of_year, 2021)
+        self.assertGreater(pipeline["sts"].n_samples_seen_, previous["sts"].n_samples_seen_)
+        self.assertEqual(len(report["centroid_shift"]), previous["km"].n_clusters)
+        self.assertLess(report["max_centroid_shift"], 1.0)
+        # Same cluster IDs for nearly all customers
+        same = sut.predict(TrainingTestCase.test_data) == \
+            TrainingTestCase.full.predict(TrainingTestCase.test_data)
+        self.assertGreater(same.mean(), 0.95)
+
+
+    def test_train_incremental_new_categories(self):
+        previous = TrainingTestCase.full.pipeline
+        delta = make_customers(300, random_state=3)
+        delta.loc[delta.index[::3], "Education"] = "Doctorate"
+        data = pd.concat([TrainingTestCase.train_data.sample(1000, random_state=0), delta])
+        sut = CustomerSegmentation()
+        pipeline, report = sut.train_incremental(data, previous, delta)
+
+        known = previous["tr"].named_transformers_["oe"].categories_[0]
+        categories = pipeline["tr"].named_transformers_["oe"].categories_[0]
+        self.assertListEqual(categories.tolist(), known.tolist() + ["Doctorate"])
+        self.assertEqual(len(previous["tr"].named_transformers_["oe"].categories_[0]), len(known))
+        # Compiled with its categories out of order
+        compiled = compile_pipeline(pipeline)
+        self.assertIsNotNone(compiled)
+        customers = sut.preprocess(delta.dropna())
+        np.testing.assert_array_equal(compiled.predict(customers), pipeline.predict(customers))
+
+
+    def test_train_incremental_replaced_rows(self):
+        previous = TrainingTestCase.full.pipeline
+        # Changed customers the previous pipeline was trained on
+        delta = TrainingTestCase.train_data.dropna().head(500).copy()
+        delta["Recency"] = 0
+        data = pd.concat([TrainingTestCase.train_data.sample(1000, random_state=0), delta])
+
+        pipeline, _ = CustomerSegmentation().train_incremental(data, previous, delta,
+                                                               replaced=set(delta["ID"]))
+        self.assertEqual(pipeline["sts"].n_samples_seen_, previous["sts"].n_samples_seen_)
+        np.testing.assert_array_equal(pipeline["sts"].mean_, previous["sts"].mean_)
+
+        new = delta.iloc[:100].assign(ID=-np.arange(1, 101))
+        pipeline, _ = CustomerSegmentation().train_incremental(
+            pd.concat([data, new]), previous, pd.concat([delta, new]), replaced=set(delta["ID"]))
+        self.assertEqual(pipeline["sts"].n_samples_seen_, previous["sts"].n_samples_seen_ + 100)
+
+
+    def test_retrain_from_local_files(self):
+        from custsegm.trainer import Trainer
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dataset = os.path.join(tmp_dir, "dataset.tsv")
+            delta = os.path.join(tmp_dir, "delta.tsv")
+            TrainingTestCase.train_data.to_csv(dataset, sep="\t", index=False)
+            make_customers(300, random_state=2).to_csv(delta, sep="\t", index=False)
+            joblib.dump(TrainingTestCase.full.pipeline, os.path.join(tmp_dir, "model.joblib"))
+
+            sut = Trainer(None, dataset, tmp_dir, training_mode="incremental",
+                          delta_uri=delta, sample_size=1000, storage=LocalStorage(tmp_dir))
+            pipeline, report = sut.retrain(CustomerSegmentation())
+        # The scaler was updated with the new rows
+        self.assertGreater(pipeline["sts"].n_samples_seen_,
+                           TrainingTestCase.full.pipeline["sts"].n_samples_seen_)
+        self.assertEqual(len(report["centroid_shift"]), TrainingTestCase.full.pipeline["km"].n_clusters)
+
+
+    def test_relabel(self):
+        kmeans = TrainingTestCase.full.pipeline["km"]
+        shuffled = copy.deepcopy(kmeans)
+        order = np.array([2, 0, 3, 1])
+        shuffled.cluster_centers_ = kmeans.cluster_centers_[order]
+        shuffled.labels_ = np.argsort(order)[kmeans.labels_].astype(kmeans.labels_.dtype)
+
+        relabelled = relabel(shuffled, kmeans.cluster_centers_)
+        np.testing.assert_array_equal(relabelled.cluster_centers_, kmeans.cluster_centers_)
+        np.testing.assert_array_equal(relabelled.labels_, kmeans.labels_)
+
+
+    def test_train_subsample(self):
+        sut = CustomerSegmentation(as_of_year=2021)
+        pipeline, report = sut.train_subsample(TrainingTestCase.train_data, 2000,
+                                               TrainingTestCase.test_data)
+        self.assertEqual(report["n_sample_rows"], 2000)
+        self.assertIs(sut.pipeline, pipeline)
+        self.assertGreater(report["agreement"], 0.5)
+        self.assertLess(report["inertia_ratio"], 1.05)
+        # Clusters relabelled after the reference model
+        same = sut.predict(TrainingTestCase.test_data) == TrainingTestCase.full.predict(TrainingTestCase.test_data)
+        self.assertAlmostEqual(same.mean(), report["agreement"], delta=0.02)
+
+        # No reference model without held-out customers to rate it on
+        pipeline, report = sut.train_subsample(TrainingTestCase.train_data, 2000)
+        self.assertEqual(report["n_sample_rows"], 2000)
+        self.assertNotIn("agreement", report)
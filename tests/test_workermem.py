@@ -0,0 +1,74 @@
+# tests/test_workermem.py
+
+import unittest
+import importlib
+import json
+import os
+import threading
+from unittest import mock
+from app.app import create_app, start_worker
+from custsegm import workermem
+from custsegm.predictor import Predictor
+from tests import helpers
+
+
+class PreloadTestCase(helpers.TrainedModelTestCase):
+    MODEL_FILENAME = "model.csgm"
+    SAMPLE_ROWS = 20
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.body = json.dumps({"instances": json.loads(cls.data.to_json(orient="records"))})
+
+
+    def test_app_factory(self):
+        predictor = Predictor(PreloadTestCase.tmp_dir.name, PreloadTestCase.model_path)
+        client = create_app(predictor).test_client()
+        response = client.post("/predict", data=PreloadTestCase.body, content_type="application/json")
+        self.assertListEqual(response.get_json()["predictions"],
+                             PreloadTestCase.pipeline.predict(PreloadTestCase.data).tolist())
+        self.assertEqual(client.get("/model").get_json()["version"], predictor.model.version)
+
+
+    def test_app_creation_errors_are_not_hidden(self):
+        module = importlib.import_module("app.app")
+        module.__dict__.pop("app", None)
+        with mock.patch("app.app.create_app", side_effect=AttributeError("_missing_indices")):
+            with self.assertRaisesRegex(RuntimeError, "_missing_indices"):
+                from app.app import app  # noqa: F401
+        self.assertNotIn("app", module.__dict__)
+
+
+    def test_polling_starts_in_workers(self):
+        predictor = Predictor(PreloadTestCase.tmp_dir.name, PreloadTestCase.model_path)
+        os.environ["MODEL_POLL_SECONDS"] = "3600"
+        try:
+            app = create_app(predictor, preload=True)
+            self.assertIsNone(predictor._polling)
+
+            # In the master, as if the app had not been preloaded
+            predictor.start_polling(3600)
+            pid = os.fork()
+            if pid == 0:
+                # Forked: the polling thread of the master is not running here
+                polling = predictor._polling
+                start_worker(app)
+                os._exit(0 if predictor._polling is not polling and predictor._polling.is_alive()
+                         and threading.active_count() == 2 else 1)
+            _, status = os.waitpid(pid, 0)
+            self.assertEqual(os.WEXITSTATUS(status), 0)
+        finally:
+            del os.environ["MODEL_POLL_SECONDS"]
+            predictor.stop_polling()
+
+
+    @unittest.skipUnless(os.path.exists("/proc/self/smaps_rollup"), "Linux 4.14+ only")
+    def test_preloaded_workers_take_less_memory(self):
+        report = workermem.run(PreloadTestCase.model_path, ["no_preload", "preload_freeze"],
+                               workers=2, requests=5, request_rows=20)
+        no_preload = report["results"]["no_preload"]
+        preload = report["results"]["preload_freeze"]
+        self.assertEqual(preload["workers"], 2)
+        self.assertLess(preload["worker_mb"]["Private"], no_preload["worker_mb"]["Private"] / 2)
+        self.assertLess(preload["total_pss_mb"], no_preload["total_pss_mb"])